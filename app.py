@@ -1,35 +1,227 @@
+import csv
+import gzip
+import hashlib
+import io
+import json
+import math
 import os
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import lru_cache, partial, wraps
+from itertools import islice
+import click
 from flask import (
     Flask, request, redirect, url_for, session, flash,
-    abort, render_template_string
+    abort, render_template, g, Response, stream_with_context, get_flashed_messages,
+    has_request_context, before_render_template, template_rendered
 )
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
+from jinja2 import DictLoader
+from markupsafe import Markup, escape
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.schema import CreateColumn, CreateTable
+from werkzeug.exceptions import HTTPException
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
 
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
 app = Flask("lol_page")
 app.secret_key = os.environ.get("SECRET_KEY", "zmien_to_w_prod")
 
 DATABASE_URL = os.environ.get("DATABASE_URL")
 if DATABASE_URL and DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+# Under gunicorn's gevent worker psycopg2 has to yield while it waits on Postgres,
+# otherwise one slow query stalls every open live feed on that worker.
+if DATABASE_URL and DATABASE_URL.startswith("postgresql") and "gevent" in sys.modules:
+    from gevent import monkey
+    if monkey.is_module_patched("socket"):
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
 
 app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URL or "sqlite:///dev.db"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-db = SQLAlchemy(app)
-
-BAD_WORDS = [
-    "kurwa", "chuj", "pierdole", "idiota", "głupi", "brzydkie",
-    "słowo1", "słowo2"
+# One pool per worker process, sized by gunicorn.conf.py to the worker's
+# concurrency; pre-ping and recycle drop connections the server has closed.
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "pool_pre_ping": True,
+    "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+}
+if not app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"].update(
+        pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        pool_timeout=int(os.environ.get("DB_POOL_TIMEOUT", 10)),
+    )
+app.config["PAGE_SIZE"] = int(os.environ.get("PAGE_SIZE", 30))
+# Stream /lol and thread pages row by row instead of building them in memory
+app.config["STREAM_PAGES"] = os.environ.get("STREAM_PAGES", "0") == "1"
+app.config["STREAM_BATCH"] = int(os.environ.get("STREAM_BATCH", 100))
+# Search ranks only the newest N matches so very common words stay cheap;
+# older matches are listed after them, newest first
+app.config["SEARCH_WINDOW"] = int(os.environ.get("SEARCH_WINDOW", 5000))
+# LIVE FEEDS: how often each worker looks for new rows, keep-alive interval and
+# how long one event stream stays open before the browser reconnects
+app.config["FEED_POLL_SECONDS"] = float(os.environ.get("FEED_POLL_SECONDS", 1))
+app.config["FEED_KEEPALIVE_SECONDS"] = int(os.environ.get("FEED_KEEPALIVE_SECONDS", 15))
+app.config["FEED_MAX_SECONDS"] = int(os.environ.get("FEED_MAX_SECONDS", 300))
+# how long the feeds wait for a missing id to commit before skipping it
+app.config["FEED_GAP_SECONDS"] = float(os.environ.get("FEED_GAP_SECONDS", 5))
+# Deletes touching more rows than this are hidden at once and purged in the
+# background, PURGE_CHUNK rows per transaction
+app.config["PURGE_INLINE_ROWS"] = int(os.environ.get("PURGE_INLINE_ROWS", 1000))
+app.config["PURGE_CHUNK"] = int(os.environ.get("PURGE_CHUNK", 500))
+app.config["PURGE_PAUSE_SECONDS"] = float(os.environ.get("PURGE_PAUSE_SECONDS", 0.05))
+app.config["PURGE_POLL_SECONDS"] = float(os.environ.get("PURGE_POLL_SECONDS", 30))
+# READ REPLICAS: comma-separated URLs; GET pages marked @replica_reads read from
+# a healthy one. Health is re-checked every REPLICA_CHECK_SECONDS, a replica
+# further behind than REPLICA_MAX_LAG_SECONDS counts as down, and a client that
+# has just written reads from the primary for REPLICA_STICKY_SECONDS.
+app.config["DATABASE_REPLICA_URLS"] = [
+    url.strip().replace("postgres://", "postgresql://", 1)
+    for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if url.strip()
 ]
+app.config["REPLICA_CHECK_SECONDS"] = float(os.environ.get("REPLICA_CHECK_SECONDS", 5))
+app.config["REPLICA_MAX_LAG_SECONDS"] = float(os.environ.get("REPLICA_MAX_LAG_SECONDS", 5))
+app.config["REPLICA_STICKY_SECONDS"] = float(os.environ.get("REPLICA_STICKY_SECONDS", 10))
+app.config["SQLALCHEMY_BINDS"] = {
+    f"replica{n}": {"url": url, **({"connect_args": {"connect_timeout": 2}} if url.startswith("postgresql") else {})}
+    for n, url in enumerate(app.config["DATABASE_REPLICA_URLS"])
+}
+
+class RoutingSession(FlaskSQLAlchemySession):
+    """Sends reads to the replica picked for this request, everything else to the primary."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        replica = g.get("read_replica") if bind is None and has_request_context() else None
+        if replica is not None and not self._flushing and not isinstance(clause, (db.Insert, db.Update, db.Delete)):
+            return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(app, session_options={"class_": RoutingSession})
+
+# SQLite's CURRENT_TIMESTAMP has no fractional seconds; bind values the same way
+# so (created, id) cursors compare correctly against server-filled rows.
+Timestamp = db.DateTime().with_variant(
+    sqlite.DATETIME(storage_format="%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d"),
+    "sqlite",
+)
+
+# MODERATION: BAD_WORDS_FILE (one term per line) replaces the built-in list and
+# is re-read when it changes, checked at most every BAD_WORDS_CHECK_SECONDS.
+app.config["BAD_WORDS_FILE"] = os.environ.get("BAD_WORDS_FILE")
+app.config["BAD_WORDS_CHECK_SECONDS"] = float(os.environ.get("BAD_WORDS_CHECK_SECONDS", 5))
+BAD_WORDS = ["kurwa", "chuj", "pierdole", "idiota", "głupi", "brzydkie"]
+REJECTED_TEXT = "Treść nie jest ładna"
+
+LEET = str.maketrans({"0": "o", "1": "i", "3": "e", "4": "a", "5": "s", "7": "t", "@": "a", "$": "s", "!": "i", "ł": "l"})
+
+def normalize(txt):
+    """Fold text so "G ł u p 1", "k.u.r.w.a" and "GŁUUUPI" all become "glupi"/"kurwa".
+
+    Lowercase, undo leetspeak, strip diacritics, turn every run of other
+    characters into one space, glue runs of single letters back into a word
+    (the spaced-out spellings) and collapse repeated characters. Words stay
+    apart, so a term never matches across the gap between two real words,
+    and digits leetspeak does not cover are kept.
+    """
+    txt = unicodedata.normalize("NFKD", txt.lower().translate(LEET))
+    txt = "".join(ch for ch in txt if not unicodedata.combining(ch))
+    words, run = [], []
+    for word in re.split(r"[\W_]+", txt):
+        if len(word) == 1:
+            run.append(word)
+            continue
+        if run:
+            words.append("".join(run)); run = []
+        if word:
+            words.append(word)
+    if run:
+        words.append("".join(run))
+    txt = " ".join(words)
+    return "".join(ch for i, ch in enumerate(txt) if i == 0 or ch != txt[i - 1])
+
+class WordMatcher:
+    """Aho-Corasick automaton: finds any of thousands of terms in one pass."""
+
+    def __init__(self, words):
+        self.goto, self.fail, self.hit = [{}], [0], [False]
+        for word in filter(None, map(normalize, words)):
+            state = 0
+            for ch in word:
+                if ch not in self.goto[state]:
+                    self.goto.append({}); self.fail.append(0); self.hit.append(False)
+                    self.goto[state][ch] = len(self.goto) - 1
+                state = self.goto[state][ch]
+            self.hit[state] = True
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.hit[nxt] = self.hit[nxt] or self.hit[self.fail[nxt]]
+
+    def search(self, txt):
+        goto, fail, hit, state = self.goto, self.fail, self.hit, 0
+        for ch in normalize(txt):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if hit[state]:
+                return True
+        return False
+
+class Moderator:
+    """Holds the current WordMatcher and rebuilds it when the word file changes."""
+
+    def __init__(self):
+        self.matcher, self.mtime, self.checked = WordMatcher(BAD_WORDS), None, 0.0
+
+    def current(self):
+        path, now = app.config["BAD_WORDS_FILE"], time.monotonic()
+        if path and now - self.checked >= app.config["BAD_WORDS_CHECK_SECONDS"]:
+            self.checked = now
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                app.logger.warning("BAD_WORDS_FILE %s is unreadable, keeping the current list", path)
+                return self.matcher
+            if mtime != self.mtime:
+                with open(path, encoding="utf-8") as f:
+                    self.matcher, self.mtime = WordMatcher(line.strip() for line in f), mtime
+                app.logger.info("Reloaded bad words from %s", path)
+        return self.matcher
+
+moderator = Moderator()
 
 def clean_text(txt):
     if txt is None:
         return txt
     txt_str = str(txt).strip()
-    low = txt_str.lower()
-    for w in BAD_WORDS:
-        if w in low:
-            return "Treść nie jest ładna"
+    if moderator.current().search(txt_str):
+        return REJECTED_TEXT
     return txt_str
 
 class School(db.Model):
@@ -41,86 +233,1666 @@ class School(db.Model):
 
 class User(db.Model):
     __tablename__ = "user"
+    __table_args__ = (
+        db.Index("ix_user_school_role_username", "school_id", "role", "username"),
+        # login prefixes on Postgres; see member_directory
+        db.Index("ix_user_school_role_username_c", "school_id", "role", db.text('username COLLATE "C"')).ddl_if(dialect="postgresql"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     password = db.Column(db.String(200), nullable=False)
     role = db.Column(db.String(20), nullable=False)  # "nauczyciel" / "uczen" / "user"
     school_id = db.Column(db.Integer, db.ForeignKey("school.id"), nullable=True)
-    lol_posts = db.relationship("LOLPost", backref="author", lazy=True)
-    lol_replies = db.relationship("LOLReply", backref="author", lazy=True)
-    posts = db.relationship("Post", backref="author", lazy=True)
-    post_replies = db.relationship("PostReply", backref="author", lazy=True)
-    spotted_replies = db.relationship("SpottedReply", backref="author", lazy=True)
+    deleted = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    lol_posts = db.relationship("LOLPost", backref="author", lazy=True, cascade="all,delete", passive_deletes=True)
+    lol_replies = db.relationship("LOLReply", backref="author", lazy=True, cascade="all,delete", passive_deletes=True)
+    posts = db.relationship("Post", backref="author", lazy=True, passive_deletes=True)
+    post_replies = db.relationship("PostReply", backref="author", lazy=True, cascade="all,delete", passive_deletes=True)
+    spotted_replies = db.relationship("SpottedReply", backref="author", lazy=True, cascade="all,delete", passive_deletes=True)
 
 class LOLPost(db.Model):
     __tablename__ = "lol_post"
+    __table_args__ = (
+        db.Index("ix_lol_post_created_id", "created", "id"), db.Index("ix_lol_post_user_id", "user_id"),
+        db.Index("ix_lol_post_reply_count_id", "reply_count", "id"), db.Index("ix_lol_post_last_activity_id", "last_activity", "id"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    created = db.Column(db.DateTime, server_default=db.func.now())
-    replies = db.relationship("LOLReply", backref="post", lazy=True, cascade="all,delete")
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
+    created = db.Column(Timestamp, server_default=db.func.now())
+    deleted = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    reply_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    last_activity = db.Column(Timestamp, default=db.func.now())
+    last_author_id = db.Column(db.Integer, nullable=True)
+    replies = db.relationship("LOLReply", backref="post", lazy=True, cascade="all,delete", passive_deletes=True)
 
 class LOLReply(db.Model):
     __tablename__ = "lol_reply"
+    __table_args__ = (db.Index("ix_lol_reply_post_created_id", "post_id", "created", "id"), db.Index("ix_lol_reply_user_id", "user_id"))
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
-    post_id = db.Column(db.Integer, db.ForeignKey("lol_post.id"), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    created = db.Column(db.DateTime, server_default=db.func.now())
+    post_id = db.Column(db.Integer, db.ForeignKey("lol_post.id", ondelete="CASCADE"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
+    created = db.Column(Timestamp, server_default=db.func.now())
 
 class Thread(db.Model):
     __tablename__ = "thread"
+    __table_args__ = (
+        db.Index("ix_thread_created_id", "created", "id"),
+        db.Index("ix_thread_reply_count_id", "reply_count", "id"), db.Index("ix_thread_last_activity_id", "last_activity", "id"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(300), nullable=False)
-    created = db.Column(db.DateTime, server_default=db.func.now())
-    posts = db.relationship("Post", backref="thread", lazy=True, cascade="all,delete")
+    created = db.Column(Timestamp, server_default=db.func.now())
+    deleted = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    reply_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    last_activity = db.Column(Timestamp, default=db.func.now())
+    last_author_id = db.Column(db.Integer, nullable=True)
+    posts = db.relationship("Post", backref="thread", lazy=True, cascade="all,delete", passive_deletes=True)
 
 class Post(db.Model):
     __tablename__ = "post"
+    __table_args__ = (db.Index("ix_post_thread_created_id", "thread_id", "created", "id"), db.Index("ix_post_user_id", "user_id"))
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
-    thread_id = db.Column(db.Integer, db.ForeignKey("thread.id"), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True)
-    created = db.Column(db.DateTime, server_default=db.func.now())
-    replies = db.relationship("PostReply", backref="post", lazy=True, cascade="all,delete")
+    thread_id = db.Column(db.Integer, db.ForeignKey("thread.id", ondelete="CASCADE"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="SET NULL"), nullable=True)
+    created = db.Column(Timestamp, server_default=db.func.now())
+    deleted = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    reply_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    last_activity = db.Column(Timestamp, default=db.func.now())
+    last_author_id = db.Column(db.Integer, nullable=True)
+    replies = db.relationship("PostReply", backref="post", lazy=True, cascade="all,delete", passive_deletes=True)
 
 class PostReply(db.Model):
     __tablename__ = "post_reply"
+    __table_args__ = (db.Index("ix_post_reply_post_created_id", "post_id", "created", "id"), db.Index("ix_post_reply_user_id", "user_id"))
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
-    post_id = db.Column(db.Integer, db.ForeignKey("post.id"), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    created = db.Column(db.DateTime, server_default=db.func.now())
+    post_id = db.Column(db.Integer, db.ForeignKey("post.id", ondelete="CASCADE"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
+    created = db.Column(Timestamp, server_default=db.func.now())
 
 class Spotted(db.Model):
     __tablename__ = "spotted"
+    __table_args__ = (
+        db.Index("ix_spotted_school_created_id", "school_id", "created", "id"), db.Index("ix_spotted_user_id", "user_id"),
+        db.Index("ix_spotted_last_activity_id", "last_activity", "id"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
     school_id = db.Column(db.Integer, db.ForeignKey("school.id"), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True)
-    created = db.Column(db.DateTime, server_default=db.func.now())
-    replies = db.relationship("SpottedReply", backref="spotted", lazy=True, cascade="all,delete")
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="SET NULL"), nullable=True)
+    created = db.Column(Timestamp, server_default=db.func.now())
+    deleted = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    reply_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    last_activity = db.Column(Timestamp, default=db.func.now())
+    last_author_id = db.Column(db.Integer, nullable=True)
+    replies = db.relationship("SpottedReply", backref="spotted", lazy=True, cascade="all,delete", passive_deletes=True)
 
 class SpottedReply(db.Model):
     __tablename__ = "spotted_reply"
+    __table_args__ = (db.Index("ix_spotted_reply_spotted_created_id", "spotted_id", "created", "id"), db.Index("ix_spotted_reply_user_id", "user_id"))
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
-    spotted_id = db.Column(db.Integer, db.ForeignKey("spotted.id"), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    created = db.Column(db.DateTime, server_default=db.func.now())
+    spotted_id = db.Column(db.Integer, db.ForeignKey("spotted.id", ondelete="CASCADE"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
+    created = db.Column(Timestamp, server_default=db.func.now())
 
-with app.app_context():
-    db.create_all()
+class CacheVersion(db.Model):
+    __tablename__ = "cache_version"
+    key = db.Column(db.String(100), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated = db.Column(db.DateTime, nullable=False)
 
-BASE_HTML = """
-<!doctype html>
-<html lang="pl">
-<head>
-<meta charset="utf-8">
-<meta name="viewport" content="width=device-width,initial-scale=1">
-<title>LOL page</title>
-<link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css" rel="stylesheet">
-<style>
+class PurgeJob(db.Model):
+    __tablename__ = "purge_job"
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    target_id = db.Column(db.Integer, nullable=False)
+    created = db.Column(Timestamp, server_default=db.func.now())
+    claimed_until = db.Column(db.DateTime, nullable=True)
+
+class ImportJob(db.Model):
+    __tablename__ = "import_job"
+    id = db.Column(db.Integer, primary_key=True)
+    school_id = db.Column(db.Integer, db.ForeignKey("school.id"), nullable=False)
+    total = db.Column(db.Integer, nullable=False)
+    # JSON lists: logins created so far, [line number, login, reason] rejected so far
+    accounts = db.Column(db.Text, nullable=False, default="[]")
+    rejected = db.Column(db.Text, nullable=False, default="[]")
+    created = db.Column(Timestamp, server_default=db.func.now())
+    updated = db.Column(db.DateTime, nullable=True)
+    finished = db.Column(db.DateTime, nullable=True)
+
+# SEARCH: one index over thread titles, posts and post replies, kept in sync by
+# DB triggers. SQLite uses an FTS5 table, Postgres a tsvector column with GIN.
+# doc_id = row id * 4 + kind, so a row's entry is found without a secondary index.
+SEARCH_SOURCES = [
+    # kind, table, text column, column holding the id the result links to
+    (1, "thread", "title", "id"),
+    (2, "post", "content", "id"),
+    (3, "post_reply", "content", "post_id"),
+]
+SEARCH_LINKS = {1: ("thread_view", "thread_id", "Wątek"), 2: ("post_view", "post_id", "Post"), 3: ("post_view", "post_id", "Odpowiedź")}
+SearchHit = namedtuple("SearchHit", "kind link_id snippet")
+
+SQLITE_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE search_fts USING fts5(body, kind UNINDEXED, link_id UNINDEXED, tokenize='unicode61 remove_diacritics 2')",
+]
+# remove_diacritics leaves ł alone (a letter of its own, not l with a mark), so
+# the indexed text and the query have it folded, as unaccent does on Postgres
+SEARCH_FOLD = str.maketrans("łŁ", "lL")
+SQLITE_FOLD = "replace(replace({}, 'ł', 'l'), 'Ł', 'L')"
+SQLITE_SEARCH_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS {table}_search_ai AFTER INSERT ON "{table}" BEGIN
+  INSERT INTO search_fts(rowid, body, kind, link_id) VALUES (new.id*4+{kind}, {folded}, {kind}, new.{link});
+END""",
+    """CREATE TRIGGER IF NOT EXISTS {table}_search_ad AFTER DELETE ON "{table}" BEGIN
+  DELETE FROM search_fts WHERE rowid = old.id*4+{kind};
+END""",
+    """CREATE TRIGGER IF NOT EXISTS {table}_search_au AFTER UPDATE OF {col} ON "{table}" BEGIN
+  UPDATE search_fts SET body = {folded} WHERE rowid = new.id*4+{kind};
+END""",
+]
+# lol_search is "simple" with accents stripped, like remove_diacritics on SQLite
+PG_SEARCH_CONFIG = [
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    "CREATE TEXT SEARCH CONFIGURATION lol_search (COPY = simple)",
+    "ALTER TEXT SEARCH CONFIGURATION lol_search ALTER MAPPING FOR word, hword, hword_part WITH unaccent, simple",
+]
+PG_SEARCH_DDL = [
+    "CREATE TABLE search_doc (doc_id BIGINT PRIMARY KEY, kind SMALLINT NOT NULL, link_id INTEGER NOT NULL, body TEXT NOT NULL, "
+    "tsv tsvector GENERATED ALWAYS AS (to_tsvector('lol_search', body)) STORED)",
+    "CREATE INDEX ix_search_doc_tsv ON search_doc USING GIN (tsv)",
+]
+# an index built before lol_search existed used the plain "simple" configuration
+PG_SEARCH_REBUILD = [
+    "ALTER TABLE search_doc DROP COLUMN tsv",
+    "ALTER TABLE search_doc ADD COLUMN tsv tsvector GENERATED ALWAYS AS (to_tsvector('lol_search', body)) STORED",
+    "CREATE INDEX ix_search_doc_tsv ON search_doc USING GIN (tsv)",
+]
+PG_SEARCH_TRIGGERS = [
+    """CREATE OR REPLACE FUNCTION {table}_search_sync() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    DELETE FROM search_doc WHERE doc_id = OLD.id::bigint*4+{kind}; RETURN OLD;
+  END IF;
+  INSERT INTO search_doc VALUES (NEW.id::bigint*4+{kind}, {kind}, NEW.{link}, NEW.{col})
+  ON CONFLICT (doc_id) DO UPDATE SET body = EXCLUDED.body;
+  RETURN NEW;
+END $$""",
+    'DROP TRIGGER IF EXISTS {table}_search ON "{table}"',
+    """CREATE TRIGGER {table}_search AFTER INSERT OR DELETE OR UPDATE OF {col} ON "{table}"
+  FOR EACH ROW EXECUTE FUNCTION {table}_search_sync()""",
+]
+
+def init_search():
+    """Create the search index and its triggers, backfilling on first run."""
+    sqlite_db = db.engine.dialect.name == "sqlite"
+    index_table = "search_fts" if sqlite_db else "search_doc"
+    fresh = not db.inspect(db.engine).has_table(index_table)
+    with db.engine.begin() as conn:
+        if not sqlite_db and conn.exec_driver_sql("SELECT 1 FROM pg_ts_config WHERE cfgname = 'lol_search'").first() is None:
+            for ddl in PG_SEARCH_CONFIG + ([] if fresh else PG_SEARCH_REBUILD):
+                conn.exec_driver_sql(ddl)
+        if fresh:
+            for ddl in SQLITE_SEARCH_DDL if sqlite_db else PG_SEARCH_DDL:
+                conn.exec_driver_sql(ddl)
+        elif sqlite_db and "replace(" not in (conn.exec_driver_sql(
+                "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'thread_search_ai'").scalar() or "replace("):
+            # an index from before ł was folded: new triggers and a one-off refill
+            for _, table, _, _ in SEARCH_SOURCES:
+                for suffix in ("ai", "ad", "au"):
+                    conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {table}_search_{suffix}")
+            conn.exec_driver_sql("DELETE FROM search_fts")
+            fresh = True
+        for kind, table, col, link in SEARCH_SOURCES:
+            for trigger in SQLITE_SEARCH_TRIGGERS if sqlite_db else PG_SEARCH_TRIGGERS:
+                conn.exec_driver_sql(trigger.format(kind=kind, table=table, col=col, link=link, folded=SQLITE_FOLD.format(f"new.{col}")))
+            if fresh:
+                columns, body = ("rowid, body, kind, link_id", SQLITE_FOLD.format(col)) if sqlite_db else ("doc_id, body, kind, link_id", col)
+                conn.exec_driver_sql(f'INSERT INTO {index_table} ({columns}) SELECT id*4+{kind}, {body}, {kind}, {link} FROM "{table}"')
+
+# hits in a hidden thread or post (deleted, its purge still queued) are left out
+SEARCH_LIVE = (
+    "CASE WHEN kind = 1 THEN EXISTS (SELECT 1 FROM thread WHERE thread.id = link_id AND NOT thread.deleted) "
+    "ELSE EXISTS (SELECT 1 FROM post JOIN thread ON thread.id = post.thread_id "
+    "WHERE post.id = link_id AND NOT post.deleted AND NOT thread.deleted) END"
+)
+
+def search(q, page_no=1):
+    """Hits for `q` on page `page_no`, plus whether another page follows.
+
+    Every word matches as a prefix, accents ignored. Scoring every match of a
+    word that is in half the corpus costs seconds, so only the newest
+    SEARCH_WINDOW matches are ranked and listed first; older matches follow
+    them, newest first.
+    """
+    terms = re.findall(r"\w+", q.translate(SEARCH_FOLD))
+    if not terms:
+        return [], False
+    size, window = app.config["PAGE_SIZE"], app.config["SEARCH_WINDOW"]
+    offset = (page_no - 1) * size
+    if db.engine.dialect.name == "sqlite":
+        params = {"q": " ".join(f'"{t}"*' for t in terms)}
+        source, match, doc, rank = "search_fts", "search_fts MATCH :q", "rowid", "rank"
+        snippet = "snippet(search_fts, 0, char(2), char(3), '…', 16)"
+    else:
+        params = {"q": " & ".join(f"'{t}':*" for t in terms)}
+        source, match, doc, rank = "search_doc, to_tsquery('lol_search', :q) query", "tsv @@ query", "doc_id", "ts_rank(tsv, query) DESC, doc_id DESC"
+        snippet = "ts_headline('lol_search', body, query, 'StartSel=\x02,StopSel=\x03,MaxFragments=1')"
+    boundary, ranked = db.session.execute(db.text(
+        f"SELECT min({doc}), count(*) FROM (SELECT {doc} FROM {source} WHERE {match} AND {SEARCH_LIVE} "
+        f"ORDER BY {doc} DESC LIMIT :window) newest"), dict(params, window=window)).one()
+    if not ranked:
+        return [], False
+    select = f"SELECT kind, link_id, {snippet}, {doc} FROM {source} WHERE {match} AND {SEARCH_LIVE}"
+    rows = []
+    if offset < ranked:
+        rows = db.session.execute(db.text(f"{select} AND {doc} >= :boundary ORDER BY {rank} LIMIT :limit OFFSET :offset"),
+                                  dict(params, boundary=boundary, limit=size + 1, offset=offset)).all()
+    if len(rows) <= size and ranked == window:
+        rows += db.session.execute(db.text(f"{select} AND {doc} < :boundary ORDER BY {doc} DESC LIMIT :limit OFFSET :offset"),
+                                   dict(params, boundary=boundary, limit=size + 1 - len(rows), offset=max(offset - ranked, 0))).all()
+    rows = rows[:size + 1]
+    if db.engine.dialect.name == "sqlite":
+        rows = unfold_snippets(rows)
+    rows = [SearchHit(*r[:3]) for r in rows]
+    return rows[:size], len(rows) > size
+
+def unfold_snippets(rows):
+    """(kind, link_id, snippet, doc id) rows with the ł/Ł folded out of the index
+    put back into their snippets from the indexed rows themselves."""
+    originals = {}
+    for kind, table, col, _ in SEARCH_SOURCES:
+        ids = [doc // 4 for k, _, _, doc in rows if k == kind]
+        if ids:
+            found = db.session.execute(db.text(f'SELECT id, {col} FROM "{table}" WHERE id IN :ids')
+                                       .bindparams(db.bindparam("ids", expanding=True)), {"ids": ids})
+            originals.update({row_id * 4 + kind: text for row_id, text in found})
+    unfolded = []
+    for kind, link_id, snippet, doc in rows:
+        original = originals.get(doc, "")
+        plain = snippet.replace("\x02", "").replace("\x03", "")
+        lead, core = len(plain) - len(plain.lstrip("…")), plain.strip("…")
+        start = original.translate(SEARCH_FOLD).find(core)
+        if core and start >= 0:
+            chars, n = iter(original[start:start + len(core)]), 0
+            out = []
+            for ch in snippet:
+                if ch not in "\x02\x03":
+                    if lead <= n < lead + len(core):
+                        ch = next(chars)
+                    n += 1
+                out.append(ch)
+            snippet = "".join(out)
+        unfolded.append((kind, link_id, snippet, doc))
+    return unfolded
+
+@app.template_filter("highlight")
+def highlight(snippet):
+    """Escape a search snippet, then turn the match markers into <mark> tags."""
+    return Markup(str(escape(snippet)).replace("\x02", "<mark>").replace("\x03", "</mark>"))
+
+# SCHEMA UPGRADES: create_all only creates missing tables, so columns and
+# ON DELETE rules added to existing tables later are applied here at startup.
+@event.listens_for(Engine, "connect")
+def _sqlite_foreign_keys(dbapi_conn, connection_record):
+    # SQLite only enforces foreign keys (and cascades) when asked, per connection
+    if isinstance(dbapi_conn, sqlite3.Connection):
+        dbapi_conn.execute("PRAGMA foreign_keys=ON")
+
+def stale_foreign_keys():
+    """(table, constraint name, column, referred table, referred column, ON DELETE) still missing their rule."""
+    stale = []
+    for table in db.metadata.sorted_tables:
+        wanted = {fk.parent.name: fk.ondelete.upper() for fk in table.foreign_keys if fk.ondelete}
+        if not wanted:
+            continue
+        if db.engine.dialect.name == "sqlite":
+            with db.engine.connect() as conn:
+                rows = conn.exec_driver_sql(f'PRAGMA foreign_key_list("{table.name}")').all()
+            existing = [(None, row[3], row[2], row[4], row[6]) for row in rows]
+        else:
+            existing = [(fk["name"], fk["constrained_columns"][0], fk["referred_table"], fk["referred_columns"][0],
+                         fk["options"].get("ondelete") or "NO ACTION") for fk in db.inspect(db.engine).get_foreign_keys(table.name)]
+        stale += [(table, name, col, ref_table, ref_col, wanted[col])
+                  for name, col, ref_table, ref_col, ondelete in existing if col in wanted and ondelete.upper() != wanted[col]]
+    return stale
+
+def upgrade_schema():
+    """Bring an existing database up to the models; returns the column names it added."""
+    inspector, added = db.inspect(db.engine), set()
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            present = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in present:
+                    ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                    conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN {ddl}')
+                    added.add(column.name)
+    stale = stale_foreign_keys()
+    if not stale:
+        return added
+    if db.engine.dialect.name != "sqlite":
+        # NOT VALID swaps the rule without a table scan; VALIDATE then scans without blocking writes
+        for table, name, col, ref_table, ref_col, ondelete in stale:
+            with db.engine.begin() as conn:
+                conn.exec_driver_sql(f'ALTER TABLE "{table.name}" DROP CONSTRAINT "{name}", ADD CONSTRAINT "{name}" '
+                                     f'FOREIGN KEY ("{col}") REFERENCES "{ref_table}" ("{ref_col}") ON DELETE {ondelete} NOT VALID')
+            with db.engine.begin() as conn:
+                conn.exec_driver_sql(f'ALTER TABLE "{table.name}" VALIDATE CONSTRAINT "{name}"')
+        return added
+    # SQLite cannot alter a constraint: rebuild the table (its indexes and
+    # search triggers are recreated right after, by the startup code below)
+    with db.engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+        conn.commit()
+        for table in {entry[0]: None for entry in stale}:
+            rebuilt = table.to_metadata(db.metadata, name=f"{table.name}__rebuild")
+            db.metadata.remove(rebuilt)
+            columns = ", ".join(f'"{c.name}"' for c in table.columns)
+            conn.execute(CreateTable(rebuilt))
+            conn.exec_driver_sql(f'INSERT INTO "{rebuilt.name}" ({columns}) SELECT {columns} FROM "{table.name}"')
+            conn.exec_driver_sql(f'DROP TABLE "{table.name}"')
+            conn.exec_driver_sql(f'ALTER TABLE "{rebuilt.name}" RENAME TO "{table.name}"')
+            conn.commit()
+        conn.exec_driver_sql("PRAGMA foreign_keys=ON")
+        conn.commit()
+    return added
+
+# MODERATION RESCAN: run `flask --app app rescan-content` after changing the word list
+MODERATED_COLUMNS = [
+    (LOLPost, "content"), (LOLReply, "content"), (Thread, "title"), (Post, "content"),
+    (PostReply, "content"), (Spotted, "content"), (SpottedReply, "content"),
+]
+
+def rescan_content(chunk=1000, dry_run=False):
+    """Re-run moderation over stored content, one id range per transaction.
+
+    Returns {model name: rows replaced}. Chunks are walked by primary key and
+    committed separately, so writers are never blocked for the whole scan.
+    Replacing cannot be undone; `dry_run` only counts what would be replaced.
+    """
+    matcher, replaced = moderator.current(), {}
+    for model, column_name in MODERATED_COLUMNS:
+        column, last_id, model_name = getattr(model, column_name), 0, model.__name__
+        replaced[model_name] = 0
+        while True:
+            rows = db.session.query(model.id, column).filter(model.id > last_id).order_by(model.id).limit(chunk).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            bad = [row_id for row_id, txt in rows if txt != REJECTED_TEXT and matcher.search(txt)]
+            if bad and not dry_run:
+                db.session.query(model).filter(model.id.in_(bad)).update({column: REJECTED_TEXT}, synchronize_session=False)
+            db.session.commit()
+            replaced[model_name] += len(bad)
+    if any(replaced.values()) and not dry_run:
+        bump("all")
+    return replaced
+
+@app.cli.command("rescan-content")
+@click.option("--dry-run", is_flag=True, help="only count what would be replaced")
+def rescan_content_command(dry_run):
+    """Apply the current bad-word list to everything already posted."""
+    for model_name, count in rescan_content(dry_run=dry_run).items():
+        print(f"{model_name}: {count} {'would be replaced' if dry_run else 'replaced'}")
+
+# PURGE: deletes rely on ON DELETE CASCADE, so the database removes the
+# subtree and nothing is loaded into the session. A subtree bigger than
+# PURGE_INLINE_ROWS is flagged `deleted` (hidden everywhere at once) and queued
+# in purge_job; a background thread in any worker, or `flask --app app purge`,
+# then deletes its subtree PURGE_CHUNK rows per transaction, grandchildren
+# before their parents, and finally the row itself, so no statement runs long
+# or holds locks for long.
+PURGE_TREES = {
+    # kind: (model, [(child model, column pointing at its parent, None when that
+    # parent is the model, else (parent model, its column pointing at the model)),
+    # ...]) with grandchildren listed before their parents
+    "thread": (Thread, [(PostReply, "post_id", (Post, "thread_id")), (Post, "thread_id", None)]),
+    "post": (Post, [(PostReply, "post_id", None)]),
+    "lol_post": (LOLPost, [(LOLReply, "post_id", None)]),
+    "spotted": (Spotted, [(SpottedReply, "spotted_id", None)]),
+    # forum posts and Spotted entries outlive their author (user_id is SET NULL):
+    # they carry other people's replies
+    "user": (User, [(LOLReply, "post_id", (LOLPost, "user_id"))]
+             + [(model, "user_id", None) for model in (LOLReply, LOLPost, PostReply, SpottedReply)]),
+}
+PURGE_KINDS = {model: kind for kind, (model, _) in PURGE_TREES.items()}
+PURGE_LEASE = 60
+
+def get_live_or_404(model, ident, archived=False):
+    """The row unless it is gone or hidden; with `archived`, a row moved to the
+    archive answers with a permanent redirect to its archive page."""
+    row = db.session.get(model, ident)
+    if row is None or row.deleted:
+        if archived and db.session.get(ARCHIVED[model], ident) is not None:
+            endpoint, arg = ARCHIVE_URLS[model]
+            abort(redirect(url_for(endpoint, **{arg: ident}), 301))
+        abort(404)
+    return row
+
+def subtree_condition(child, column, via, row_id):
+    """Filter for the `child` rows of a PURGE_TREES entry under `row_id`."""
+    if via is None:
+        return getattr(child, column) == row_id
+    parent, parent_column = via
+    return getattr(child, column).in_(db.select(parent.id).where(getattr(parent, parent_column) == row_id))
+
+def subtree_rows(kind, row_id, limit):
+    """Rows anywhere under `row_id`, counted no further than `limit`."""
+    total = 0
+    for child, column, via in PURGE_TREES[kind][1]:
+        probe = (db.session.query(child.id).filter(subtree_condition(child, column, via, row_id))
+                 .limit(limit + 1 - total).subquery())
+        total += db.session.query(db.func.count()).select_from(probe).scalar()
+        if total > limit:
+            break
+    return total
+
+def delete_tree(row):
+    """Delete `row` and everything under it, in the background if it is big.
+
+    Returns True when the row is already gone, False when it was only hidden.
+    """
+    kind = PURGE_KINDS[type(row)]
+    parent = ACTIVITY_PARENTS.get(type(row))
+    parent_id = getattr(row, parent[1]) if parent else None
+    if subtree_rows(kind, row.id, app.config["PURGE_INLINE_ROWS"]) <= app.config["PURGE_INLINE_ROWS"]:
+        parents = {}
+        if kind == "user":
+            for child, column, via in PURGE_TREES[kind][1]:
+                if via is not None:
+                    continue  # their parents go too
+                for parent_model, ids in activity_parents(child, getattr(child, column) == row.id).items():
+                    parents.setdefault(parent_model, set()).update(ids)
+        db.session.delete(row)
+        db.session.flush()
+        for parent_model, ids in parents.items():
+            refresh_activity(parent_model, ids)
+        if parent:
+            forget_reply(parent[0], parent_id)
+        db.session.commit()
+        return True
+    row.deleted = True
+    db.session.add(PurgeJob(kind=kind, target_id=row.id)); db.session.flush()
+    if parent:
+        forget_reply(parent[0], parent_id)
+    db.session.commit()
+    purger.wake()
+    return False
+
+def purge_step():
+    """Delete one chunk of one queued subtree. Returns False when nothing is left to do."""
+    now = datetime.utcnow()
+    job = (PurgeJob.query.filter(db.or_(PurgeJob.claimed_until.is_(None), PurgeJob.claimed_until < now))
+           .order_by(PurgeJob.id).first())
+    if job is None:
+        return False
+    # claim it with a compare-and-set so two workers never purge the same tree
+    claim = db.update(PurgeJob).where(
+        PurgeJob.id == job.id,
+        PurgeJob.claimed_until.is_(None) if job.claimed_until is None else PurgeJob.claimed_until == job.claimed_until,
+    ).values(claimed_until=now + timedelta(seconds=PURGE_LEASE))
+    if db.session.execute(claim).rowcount != 1:
+        db.session.rollback()
+        return True
+    db.session.commit()
+    model, children = PURGE_TREES[job.kind]
+    for child, column, via in children:
+        ids = [i for (i,) in db.session.query(child.id).filter(subtree_condition(child, column, via, job.target_id))
+               .limit(app.config["PURGE_CHUNK"])]
+        if ids:
+            parents = {} if via else activity_parents(child, child.id.in_(ids), skip=model)
+            db.session.execute(db.delete(child).where(child.id.in_(ids)))
+            for parent_model, parent_ids in parents.items():
+                refresh_activity(parent_model, parent_ids)
+            db.session.execute(db.update(PurgeJob).where(PurgeJob.id == job.id).values(claimed_until=None))
+            db.session.commit()
+            return True
+    db.session.execute(db.delete(model).where(model.id == job.target_id))
+    db.session.execute(db.delete(PurgeJob).where(PurgeJob.id == job.id))
+    db.session.commit()
+    if job.kind == "user":
+        bump("all")
+    return True
+
+class BackgroundLoop:
+    """Thread calling `step` until it returns False, then sleeping until woken
+    or for the `poll` setting; started on first use."""
+
+    def __init__(self, name, step, pause, poll):
+        self.name, self.step, self.pause, self.poll = name, step, pause, poll
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.thread = None
+
+    def wake(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self.thread.start()
+        self.event.set()
+
+    def _run(self):
+        while True:
+            self.event.clear()
+            try:
+                with app.app_context():
+                    while self.step():
+                        time.sleep(app.config[self.pause])
+            except Exception:
+                app.logger.exception("%s failed", self.name)
+            self.event.wait(app.config[self.poll])
+
+purger = BackgroundLoop("purger", purge_step, "PURGE_PAUSE_SECONDS", "PURGE_POLL_SECONDS")
+
+@app.before_request
+def _start_background():
+    # picks up jobs left over by a restarted worker
+    if purger.thread is None:
+        purger.wake()
+    if archiver.thread is None and app.config["ARCHIVE_AFTER_DAYS"]:
+        archiver.wake()
+
+@app.cli.command("purge")
+def purge_command():
+    """Run queued background deletes here until none is left unclaimed."""
+    steps = 0
+    while purge_step():
+        steps += 1
+    print(f"{steps} purge steps done")
+
+# ACTIVITY: Thread, Post, LOLPost and Spotted carry reply_count, last_activity
+# and last_author_id. The write paths adjust them in the same transaction as
+# the reply; `flask --app app rebuild-activity` recounts everything in bulk.
+# A reply to a post is activity in its thread too: it moves the thread's
+# last_activity and last_author_id, though reply_count only counts posts.
+ACTIVITY = {
+    # parent model: (child model, column pointing at the parent)
+    Thread: (Post, "thread_id"),
+    Post: (PostReply, "post_id"),
+    LOLPost: (LOLReply, "post_id"),
+    Spotted: (SpottedReply, "spotted_id"),
+}
+ACTIVITY_PARENTS = {child: (parent, column) for parent, (child, column) in ACTIVITY.items()}
+# ?sort= values for listings, served by the (column, id) indexes
+ACTIVITY_SORTS = {"active": "reply_count", "recent": "last_activity"}
+
+def _live_children(model):
+    child, column = ACTIVITY[model]
+    where = [getattr(child, column) == model.id]
+    if hasattr(child, "deleted"):
+        where.append(~child.deleted)
+    return child, where
+
+def _newest(child, where):
+    newest = db.select(child.created).where(*where).order_by(child.created.desc(), child.id.desc()).limit(1)
+    return newest.scalar_subquery(), newest.with_only_columns(child.user_id).scalar_subquery()
+
+def _newest_reply(model):
+    """Correlated subqueries for the newest live reply's time and author."""
+    child, where = _live_children(model)
+    created, author = _newest(child, where)
+    if child in ACTIVITY:
+        grandchild, column = ACTIVITY[child]
+        below = where + [getattr(grandchild, column) == child.id]
+        if hasattr(grandchild, "deleted"):
+            below.append(~grandchild.deleted)
+        below_created, below_author = _newest(grandchild, below)
+        newer = db.func.coalesce(below_created > created, False)
+        created, author = db.case((newer, below_created), else_=created), db.case((newer, below_author), else_=author)
+    return db.func.coalesce(created, model.created), author
+
+def _refresh_above(model, condition):
+    """Recompute last activity of the rows above the `model` rows matching `condition`."""
+    if model not in ACTIVITY_PARENTS:
+        return
+    parent, column = ACTIVITY_PARENTS[model]
+    last_activity, last_author = _newest_reply(parent)
+    db.session.execute(db.update(parent).where(parent.id.in_(db.select(getattr(model, column)).where(condition)))
+                       .values(last_activity=last_activity, last_author_id=last_author))
+
+def record_reply(model, parent_id, user_id, count=1):
+    """Count `count` replies just added under `parent_id`, the last one by `user_id`;
+    commit it together with the replies."""
+    db.session.execute(db.update(model).where(model.id == parent_id).values(
+        reply_count=model.reply_count + count, last_activity=db.func.now(), last_author_id=user_id))
+    if model in ACTIVITY_PARENTS:
+        parent, column = ACTIVITY_PARENTS[model]
+        db.session.execute(db.update(parent).where(parent.id == db.select(getattr(model, column)).where(model.id == parent_id)
+                                                   .scalar_subquery()).values(last_activity=db.func.now(), last_author_id=user_id))
+
+def forget_reply(model, parent_id):
+    """Uncount a reply removed (or hidden) under `parent_id`."""
+    last_activity, last_author = _newest_reply(model)
+    db.session.execute(db.update(model).where(model.id == parent_id).values(
+        reply_count=db.case((model.reply_count > 0, model.reply_count - 1), else_=0),
+        last_activity=last_activity, last_author_id=last_author))
+    _refresh_above(model, model.id == parent_id)
+
+def refresh_activity(model, ids=None):
+    """Recount the counters of `ids` (every row when None) from their replies."""
+    child, where = _live_children(model)
+    last_activity, last_author = _newest_reply(model)
+    stmt = db.update(model).values(
+        reply_count=db.select(db.func.count()).select_from(child).where(*where).scalar_subquery(),
+        last_activity=last_activity, last_author_id=last_author)
+    if ids is not None:
+        stmt = stmt.where(model.id.in_(list(ids)))
+    db.session.execute(stmt)
+    if ids is not None:
+        _refresh_above(model, model.id.in_(list(ids)))
+
+def activity_parents(child, condition, skip=None):
+    """{parent model: ids} whose counters change when `child` rows matching `condition` go."""
+    if child not in ACTIVITY_PARENTS or ACTIVITY_PARENTS[child][0] is skip:
+        return {}
+    parent, column = ACTIVITY_PARENTS[child]
+    return {parent: {i for (i,) in db.session.query(getattr(child, column)).filter(condition).distinct()}}
+
+def rebuild_activity(chunk=1000):
+    """Recount every counter, `chunk` parents per transaction."""
+    for model in ACTIVITY:
+        last_id = 0
+        while True:
+            ids = [i for (i,) in db.session.query(model.id).filter(model.id > last_id).order_by(model.id).limit(chunk)]
+            if not ids:
+                break
+            refresh_activity(model, ids)
+            db.session.commit()
+            last_id = ids[-1]
+
+@app.cli.command("rebuild-activity")
+def rebuild_activity_command():
+    """Recount reply counts and last activity for threads, posts, LOL and Spotted."""
+    rebuild_activity(); bump("all")
+    print("activity counters rebuilt")
+
+# WRITE COALESCING: with WRITE_COALESCE_MS set, new posts and replies are not
+# committed by the request that made them. The request queues the validated
+# row and waits while a flusher thread in the worker gathers whatever arrives
+# within WRITE_COALESCE_MS (at most WRITE_COALESCE_MAX rows) and commits it in
+# one transaction: one executemany INSERT per table, one counter update per
+# parent, one bump of the union of cache keys. The waiting requests are then
+# released, so the redirect after the POST shows the new row on every worker,
+# while a burst of posts costs one commit (one fsync) per batch instead of one
+# per post. It pays off with the gevent and gthread workers, which have many
+# posts in flight per process; a sync worker only ever queues its own.
+app.config["WRITE_COALESCE_MS"] = float(os.environ.get("WRITE_COALESCE_MS", 0))
+app.config["WRITE_COALESCE_MAX"] = int(os.environ.get("WRITE_COALESCE_MAX", 200))
+
+class PendingWrite:
+    __slots__ = ("model", "values", "parent", "keys", "done", "error")
+
+    def __init__(self, model, values, parent, keys):
+        self.model, self.values, self.parent, self.keys = model, values, parent, keys
+        self.done, self.error = threading.Event(), None
+
+class WriteCoalescer:
+    def __init__(self):
+        self.lock, self.queue, self.thread = threading.Lock(), [], None
+        self.arrived = threading.Event()
+
+    def save(self, model, values, parent, keys):
+        """Queue a `model` row (a reply under `parent`, a (model, id) pair, or None)
+        and return once the batch holding it is committed."""
+        write = PendingWrite(model, values, parent, keys)
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="coalescer", daemon=True)
+                self.thread.start()
+            self.queue.append(write)
+            self.arrived.set()
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+
+    def _run(self):
+        while True:
+            self.arrived.wait()
+            if len(self.queue) < app.config["WRITE_COALESCE_MAX"]:
+                time.sleep(app.config["WRITE_COALESCE_MS"] / 1000)
+            with self.lock:
+                batch = self.queue[:app.config["WRITE_COALESCE_MAX"]]
+                del self.queue[:len(batch)]
+                if not self.queue:
+                    self.arrived.clear()
+            try:
+                with app.app_context():
+                    self.flush(batch)
+            except Exception as exc:  # noqa: BLE001 - handed to the waiting requests
+                app.logger.exception("coalesced write of %d rows failed", len(batch))
+                for write in batch:
+                    write.error = write.error or exc
+            finally:
+                for write in batch:
+                    write.done.set()
+
+    def flush(self, batch):
+        try:
+            self.commit(batch)
+        except IntegrityError:
+            # a row whose parent went away meanwhile must not fail the rest of the batch
+            db.session.rollback()
+            for write in batch:
+                try:
+                    self.commit([write])
+                except IntegrityError as exc:
+                    db.session.rollback()
+                    write.error = exc
+
+    def commit(self, batch):
+        rows, replies = {}, {}
+        for write in batch:
+            rows.setdefault(write.model, []).append(write.values)
+            if write.parent is not None:
+                count, _ = replies.get(write.parent, (0, None))
+                replies[write.parent] = (count + 1, write.values["user_id"])
+        for model, values in rows.items():
+            db.session.execute(db.insert(model), values)
+        for (model, parent_id), (count, user_id) in replies.items():
+            record_reply(model, parent_id, user_id, count)
+        db.session.commit()
+        keys = {key for write in batch for key in write.keys}
+        if keys:
+            bump(*keys)
+
+coalescer = WriteCoalescer()
+
+def save_post(model, values, parent=None, keys=()):
+    """Add a new post or reply, count it under `parent` and commit, then bump the
+    cache `keys`; through the coalescer when WRITE_COALESCE_MS is set."""
+    if app.config["WRITE_COALESCE_MS"]:
+        parent = parent and (type(parent), parent.id)
+        # hand the connection back while waiting, or the waiters drain the pool the flusher needs
+        db.session.close()
+        coalescer.save(model, values, parent, keys)
+        # committed elsewhere, but the redirect must still read from the primary
+        g.wrote = True
+        return
+    db.session.add(model(**values))
+    if parent is not None:
+        record_reply(type(parent), parent.id, values["user_id"])
+    db.session.commit()
+    if keys:
+        bump(*keys)
+
+# ARCHIVE: LOL posts, Spotted entries and threads with no activity for
+# ARCHIVE_AFTER_DAYS (0 turns archiving off) move, together with everything
+# under them, into archive_* tables with the same columns and ids. A
+# background thread in every worker, or `flask --app app archive`, moves
+# ARCHIVE_BATCH trees per transaction: INSERT ... SELECT into the archive,
+# then one DELETE of the roots that cascades through the hot tables. The hot
+# tables and their indexes only hold live content; archived rows are served
+# read-only under /archive and their old URLs redirect there.
+app.config["ARCHIVE_AFTER_DAYS"] = int(os.environ.get("ARCHIVE_AFTER_DAYS", 0))
+app.config["ARCHIVE_BATCH"] = int(os.environ.get("ARCHIVE_BATCH", 100))
+app.config["ARCHIVE_PAUSE_SECONDS"] = float(os.environ.get("ARCHIVE_PAUSE_SECONDS", 0.1))
+app.config["ARCHIVE_POLL_SECONDS"] = float(os.environ.get("ARCHIVE_POLL_SECONDS", 3600))
+
+def archive_model(model):
+    """Mapped copy of `model` in archive_<table>; only links to users and schools are kept."""
+    table, columns = model.__table__, {}
+    for col in table.columns:
+        keep = [db.ForeignKey(fk.target_fullname, ondelete=fk.ondelete) for fk in col.foreign_keys
+                if fk.column.table.name in ("user", "school")]
+        columns[col.key] = db.Column(col.name, col.type, *keep, primary_key=col.primary_key,
+                                     autoincrement=False, nullable=col.nullable)
+    # the archive is only ever read in created order, so counter indexes stay behind
+    indexes = tuple(db.Index(ix.name.replace("ix_", "ix_archive_", 1), *[c.name for c in ix.columns])
+                    for ix in table.indexes if not {"reply_count", "last_activity"} & {c.name for c in ix.columns})
+    return type(f"Archived{model.__name__}", (db.Model,),
+                {"__tablename__": f"archive_{table.name}", "__table_args__": indexes, **columns})
+
+ARCHIVED = {model: archive_model(model) for model in (LOLPost, LOLReply, Thread, Post, PostReply, Spotted, SpottedReply)}
+ARCHIVE_TREES = [
+    # root, [(child, column pointing at its parent, parent), ...] parents first, cache keys of a root
+    (LOLPost, [(LOLReply, "post_id", LOLPost)], lambda row: ["lol"]),
+    (Spotted, [(SpottedReply, "spotted_id", Spotted)], lambda row: [f"spotted:{row.school_id}"]),
+    (Thread, [(Post, "thread_id", Thread), (PostReply, "post_id", Post)], lambda row: ["threads", f"thread:{row.id}"]),
+]
+# where the old URL of an archived row now lives
+ARCHIVE_URLS = {
+    LOLPost: ("archive_lol_view", "post_id"), Spotted: ("archive_spotted_view", "spotted_id"),
+    Thread: ("archive_thread_view", "thread_id"), Post: ("archive_post_view", "post_id"),
+}
+
+def archive_step():
+    """Move one batch of idle trees into the archive. Returns False when none is left."""
+    cutoff = datetime.utcnow() - timedelta(days=app.config["ARCHIVE_AFTER_DAYS"])
+    for root, children, cache_keys in ARCHIVE_TREES:
+        idle = [~root.deleted, db.func.coalesce(root.last_activity, root.created) < cutoff]
+        if root is Thread:
+            idle.append(~db.exists().where(Post.thread_id == Thread.id, Post.last_activity >= cutoff))
+        # inserting a reply takes a key-share lock on its parent row, so holding every
+        # parent being moved until the commit keeps new replies out of the gap between
+        # the copies and the delete; roots a writer is busy with wait for the next batch
+        rows = (root.query.filter(*idle).order_by(root.id).limit(app.config["ARCHIVE_BATCH"])
+                .with_for_update(skip_locked=True).all())
+        if not rows:
+            continue
+        ids = {root: [row.id for row in rows]}
+        for child, column, parent in children:
+            # a child's rows are those under the parents being moved; hidden rows wait for the purge
+            live = [~child.deleted] if "deleted" in child.__table__.c else []
+            ids[child] = db.select(child.id).where(getattr(child, column).in_(ids[parent]), *live)
+        for parent in {parent for _, _, parent in children} - {root}:
+            db.session.execute(db.select(parent.id).where(parent.id.in_(ids[parent])).with_for_update())
+        try:
+            for model in [root] + [child for child, _, _ in children]:
+                names = [c.name for c in model.__table__.columns]
+                db.session.execute(db.insert(ARCHIVED[model]).from_select(
+                    names, db.select(*[model.__table__.c[n] for n in names]).where(model.id.in_(ids[model]))))
+            db.session.execute(db.delete(root).where(root.id.in_(ids[root])))
+            db.session.commit()
+        except IntegrityError:
+            # another worker moved some of these trees first
+            db.session.rollback()
+            return True
+        bump("archive", *{key for row in rows for key in cache_keys(row)})
+        return True
+    return False
+
+archiver = BackgroundLoop("archiver", archive_step, "ARCHIVE_PAUSE_SECONDS", "ARCHIVE_POLL_SECONDS")
+
+@app.cli.command("archive")
+def archive_command():
+    """Archive idle content now, batch by batch, until nothing old enough is left."""
+    if not app.config["ARCHIVE_AFTER_DAYS"]:
+        print("ARCHIVE_AFTER_DAYS is not set"); return
+    steps = 0
+    while archive_step():
+        steps += 1
+    print(f"{steps} archive batches moved")
+
+# AUTHORS: one query per listing instead of User.query.get per row
+def author_names(*rows, column="user_id"):
+    """Map user_id -> username for `rows`, cached for the rest of the request.
+
+    Ids not seen earlier in the request are fetched with a single IN query;
+    deleted or anonymous authors map to "Anon". `column` names the attribute
+    holding the user id.
+    """
+    cache = g.setdefault("author_names", {})
+    missing = {getattr(r, column) for r in rows if getattr(r, column) is not None} - cache.keys()
+    if missing:
+        cache.update(db.session.query(User.id, User.username).filter(User.id.in_(missing)).all())
+        for uid in missing - cache.keys():
+            cache[uid] = "Anon"
+    return cache
+
+# MEMBERS: school directory one role at a time, in username order, with an
+# optional login prefix (?q=); pages and counts come off ix_user_school_role_username
+# (the prefix range off ix_user_school_role_username_c on Postgres).
+MEMBER_ROLES = ("nauczyciel", "uczen")
+MemberDirectory = namedtuple("MemberDirectory", "role prefix counts page")
+
+def member_directory(school_id):
+    """The ?role= / ?q= page of a school's members and the per-role counts for the same prefix."""
+    role, prefix = request.args.get("role", "nauczyciel"), request.args.get("q", "").strip()
+    if role not in MEMBER_ROLES:
+        abort(400)
+    members = [User.school_id == school_id, ~User.deleted]
+    if prefix:
+        members.append(User.username.startswith(prefix, autoescape=True))
+        # compared by code point the range is exact and keeps the scan inside the index
+        # (and the match case-sensitive on both backends); SQLite compares that way
+        # already, Postgres only under the "C" collation, which its index is built with
+        username = {"sqlite": User.username, "postgresql": User.username.collate("C")}.get(db.engine.dialect.name)
+        if username is not None:
+            members += [username >= prefix, username < prefix + "\U0010ffff"]
+    counts = dict(db.session.query(User.role, db.func.count()).filter(*members).group_by(User.role).all())
+    page = keyset_page(User.query.filter(User.role == role, *members), User, newest_first=False, sort=User.username)
+    return MemberDirectory(role, prefix, counts, page)
+
+# READ REPLICAS: see the settings at the top. Reads only leave the primary in
+# views that opt in with @replica_reads, only for GET/HEAD, and never for the
+# client that wrote in the last REPLICA_STICKY_SECONDS (the redirect after a
+# POST sees its own write) or for a cached page whose entities just changed.
+class ReplicaSet:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.health = {}  # bind key -> (healthy, monotonic time of the check)
+
+    def engines(self):
+        return {key: db.engines[key] for key in app.config["SQLALCHEMY_BINDS"] if key.startswith("replica")}
+
+    def pick(self):
+        """A healthy replica engine, or None to stay on the primary."""
+        healthy = [engine for key, engine in self.engines().items() if self.healthy(key, engine)]
+        return random.choice(healthy) if healthy else None
+
+    def healthy(self, key, engine):
+        ok, checked = self.health.get(key, (True, float("-inf")))
+        if time.monotonic() - checked < app.config["REPLICA_CHECK_SECONDS"]:
+            return ok
+        with self.lock:
+            ok = self.check(key, engine)
+            self.health[key] = (ok, time.monotonic())
+        return ok
+
+    def check(self, key, engine):
+        try:
+            with engine.connect() as conn:
+                if engine.dialect.name != "postgresql":
+                    conn.exec_driver_sql("SELECT 1")
+                    return True
+                # caught up with what it received counts as no lag, even if the primary is idle
+                lag = conn.exec_driver_sql(
+                    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                    "ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END").scalar()
+        except Exception as exc:  # noqa: BLE001 - any failure means "do not use it"
+            app.logger.warning("replica %s failed its health check: %s", key, exc)
+            return False
+        if lag is not None and lag > app.config["REPLICA_MAX_LAG_SECONDS"]:
+            app.logger.warning("replica %s is %.1f s behind, using the primary", key, lag)
+            return False
+        return True
+
+    def mark_down(self, engine):
+        for key, known in self.engines().items():
+            if known is engine:
+                self.health[key] = (False, time.monotonic())
+
+replicas = ReplicaSet()
+
+def replica_reads(view):
+    """Serve this GET view from a read replica when that is safe."""
+    @wraps(view)
+    def wrapper(**kwargs):
+        if (request.method not in ("GET", "HEAD") or not app.config["DATABASE_REPLICA_URLS"]
+                or session.get("primary_until", 0) > time.time() or g.get("fresh_reads")):
+            return view(**kwargs)
+        g.read_replica = replicas.pick()
+        if g.read_replica is None:
+            return view(**kwargs)
+        try:
+            return view(**kwargs)
+        except OperationalError:
+            # the replica went away mid-request: answer from the primary instead
+            replicas.mark_down(g.read_replica)
+            db.session.rollback()
+            g.read_replica = None
+            return view(**kwargs)
+    return wrapper
+
+@event.listens_for(RoutingSession, "after_commit")
+def _remember_write(db_session):
+    if has_request_context():
+        g.wrote = True
+
+@app.after_request
+def _stick_to_primary(response):
+    if g.get("wrote") and app.config["DATABASE_REPLICA_URLS"]:
+        session["primary_until"] = time.time() + app.config["REPLICA_STICKY_SECONDS"]
+    return response
+
+# PAGINATION: keyset on (created, id) or (sort column, id), "older"/"newer"
+# cursors in the query string
+Page = namedtuple("Page", "items older newer")
+
+def encode_cursor(row, column="created"):
+    value = getattr(row, column)
+    return f"{value.isoformat() if isinstance(value, datetime) else value}_{row.id}"
+
+def decode_cursor(raw, parse=datetime.fromisoformat):
+    value, _, row_id = raw.rpartition("_")
+    try:
+        return parse(value), int(row_id)
+    except ValueError:
+        abort(400)
+
+class StreamedPage:
+    """A keyset page whose rows are read with yield_per while the template renders.
+
+    `older`/`newer` are filled in as the rows go by, so they are only valid after
+    `items` has been consumed, which is where the templates render the nav.
+    """
+
+    def __init__(self, rows, size, came_from_cursor, newest_first, column="created"):
+        self.older = self.newer = None
+        self._rows, self._size, self._column = rows, size, column
+        self._came_from_cursor, self._newest_first = came_from_cursor, newest_first
+
+    @property
+    def items(self):
+        rows, seen, first, last = iter(self._rows), 0, None, None
+        while seen < self._size:
+            batch = list(islice(rows, min(app.config["STREAM_BATCH"], self._size - seen)))
+            if not batch:
+                break
+            if hasattr(batch[0], "user_id"):
+                author_names(*batch)
+            first, last, seen = first or batch[0], batch[-1], seen + len(batch)
+            yield from batch
+        more = next(rows, None) is not None
+        far = encode_cursor(last, self._column) if more else None
+        near = encode_cursor(first, self._column) if self._came_from_cursor and first else None
+        self.older, self.newer = (far, near) if self._newest_first else (near, far)
+
+def keyset_page(query, model, newest_first=True, stream=False, sort=None):
+    """One page of `query` plus cursors for the neighbouring pages.
+
+    Rows are compared on the (created, id) tuple so every page is a range scan
+    on the matching composite index, however deep the visitor has paged.
+    `sort` swaps `created` for another indexed column, such as reply_count
+    or username.
+    With `stream` the rows come back as a StreamedPage unless the page has to
+    be fetched in reverse (paging towards newer rows on a feed).
+    """
+    size = app.config["PAGE_SIZE"]
+    column = model.created if sort is None else sort
+    parse = {int: int, str: str}.get(column.type.python_type, datetime.fromisoformat)
+    key = db.tuple_(column, model.id)
+    older, newer = request.args.get("older"), request.args.get("newer")
+    if older:
+        query, fetch_desc = query.filter(key < decode_cursor(older, parse)), True
+    elif newer:
+        query, fetch_desc = query.filter(key > decode_cursor(newer, parse)), False
+    else:
+        fetch_desc = newest_first
+    order = (column.desc(), model.id.desc()) if fetch_desc else (column, model.id)
+    query = query.order_by(*order).limit(size + 1)
+    if stream and fetch_desc == newest_first:
+        return StreamedPage(query.yield_per(app.config["STREAM_BATCH"]), size, bool(older or newer), newest_first, column.key)
+    rows = query.all()
+    more, rows = len(rows) > size, rows[:size]
+    came_from_cursor = bool(older or newer)
+    has_older, has_newer = (more, came_from_cursor) if fetch_desc else (came_from_cursor, more)
+    if fetch_desc != newest_first:
+        rows.reverse()
+    if not rows:
+        return Page(rows, None, None)
+    oldest, newest = (rows[-1], rows[0]) if newest_first else (rows[0], rows[-1])
+    return Page(
+        rows,
+        encode_cursor(oldest, column.key) if has_older else None,
+        encode_cursor(newest, column.key) if has_newer else None,
+    )
+
+def stream_page(name, **context):
+    """Render `name` as a chunked response with the request context kept alive.
+
+    Flashed messages are read up front so the session cookie is written before
+    the first byte goes out; the navbar and header flush before any row is read.
+    """
+    get_flashed_messages(with_categories=True)
+    app.update_template_context(context)
+    chunks = app.jinja_env.get_template(name).stream(context)
+    chunks.enable_buffering(app.config["STREAM_BATCH"])
+    return Response(stream_with_context(chunks), mimetype="text/html")
+
+# METRICS: per-request timings in a Server-Timing header and Prometheus text at
+# /metrics. With METRICS_DIR set (gunicorn.conf.py does), each gunicorn worker
+# dumps its series to <pid>-<start>.json there and /metrics sums every file, so
+# any worker can answer. When a worker exits the master folds its file into
+# retired.json, which lists the files it already holds.
+app.config["METRICS_DIR"] = os.environ.get("METRICS_DIR")
+app.config["METRICS_FLUSH_SECONDS"] = float(os.environ.get("METRICS_FLUSH_SECONDS", 1))
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+app.config["SLOW_REQUEST_MS"] = float(os.environ.get("SLOW_REQUEST_MS", 500))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRIC_HELP = {
+    "lol_requests_total": ("counter", "Requests by route, method and status"),
+    "lol_request_duration_seconds": ("histogram", "Time to build the response"),
+    "lol_db_queries_total": ("counter", "SQL statements executed"),
+    "lol_db_query_seconds_total": ("counter", "Time spent in SQL statements"),
+    "lol_template_render_seconds_total": ("counter", "Time spent rendering templates"),
+    "lol_response_bytes_total": ("counter", "Response body bytes (streamed bodies excluded)"),
+    "lol_cache_lookups_total": ("counter", "In-process cache lookups by cache and result (hit/miss)"),
+    "lol_cache_evictions_total": ("counter", "Entries dropped by a full in-process cache"),
+}
+
+def _series(name, **labels):
+    def esc(v):
+        return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return name + "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels.items()) + "}"
+
+class Metrics:
+    """Series for this worker, keyed by their Prometheus text form so merging
+    the files of several workers is a plain sum."""
+
+    def __init__(self):
+        self._forked()
+        os.register_at_fork(after_in_child=self._forked)
+
+    def _forked(self):
+        # a forked worker starts from zero, in a file no earlier process used
+        self.values, self.lock, self.flushed, self.flusher = {}, threading.Lock(), 0.0, None
+        self.file = f"{os.getpid()}-{time.time_ns()}.json"
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(app.config["METRICS_FLUSH_SECONDS"])
+            self.flush(force=True)
+
+    def observe(self, route, method, status, seconds, sql_count, sql_seconds, tpl_seconds, size):
+        with self.lock:
+            v = self.values
+            def inc(key, amount=1):
+                v[key] = v.get(key, 0) + amount
+            inc(_series("lol_requests_total", route=route, method=method, status=status))
+            for le in LATENCY_BUCKETS:
+                inc(_series("lol_request_duration_seconds_bucket", route=route, le=le), int(seconds <= le))
+            inc(_series("lol_request_duration_seconds_bucket", route=route, le="+Inf"))
+            inc(_series("lol_request_duration_seconds_count", route=route))
+            inc(_series("lol_request_duration_seconds_sum", route=route), seconds)
+            inc(_series("lol_db_queries_total", route=route), sql_count)
+            inc(_series("lol_db_query_seconds_total", route=route), sql_seconds)
+            inc(_series("lol_template_render_seconds_total", route=route), tpl_seconds)
+            inc(_series("lol_response_bytes_total", route=route), size)
+
+    def count(self, name, amount=1, **labels):
+        key = _series(name, **labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def flush(self, force=False):
+        folder = app.config["METRICS_DIR"]
+        if folder and self.flusher is None:
+            # requests flush at most every METRICS_FLUSH_SECONDS; this writes out the rest
+            self.flusher = threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True)
+            self.flusher.start()
+        if not folder or (not force and time.monotonic() - self.flushed < app.config["METRICS_FLUSH_SECONDS"]):
+            return
+        with self.lock:
+            data, self.flushed = json.dumps(self.values), time.monotonic()
+        path = os.path.join(folder, self.file)
+        with open(path + ".tmp", "w") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def collect(self):
+        folder = app.config["METRICS_DIR"]
+        if not folder:
+            with self.lock:
+                return dict(self.values)
+        self.flush(force=True)
+        workers = {}
+        for name in os.listdir(folder):
+            if name.endswith(".json") and name != "retired.json":
+                try:
+                    with open(os.path.join(folder, name)) as f:
+                        workers[name] = json.load(f)
+                except (OSError, ValueError):
+                    continue
+        # read after the workers: a file retired meanwhile is then counted once, here
+        retired = self._retired(folder)
+        merged = dict(retired["series"])
+        for name, series in workers.items():
+            if name not in retired["files"]:
+                for key, value in series.items():
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+
+    @staticmethod
+    def _retired(folder):
+        try:
+            with open(os.path.join(folder, "retired.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"files": [], "series": {}}
+
+    def retire(self, pid):
+        """Fold the files of exited worker `pid` into retired.json; gunicorn's master calls this."""
+        folder = app.config["METRICS_DIR"]
+        names = [name for name in os.listdir(folder) if name.startswith(f"{pid}-") and name.endswith(".json")]
+        if not names:
+            return
+        retired = self._retired(folder)
+        for name in names:
+            try:
+                with open(os.path.join(folder, name)) as f:
+                    series = json.load(f)
+            except (OSError, ValueError):
+                series = {}
+            for key, value in series.items():
+                retired["series"][key] = retired["series"].get(key, 0) + value
+            retired["files"].append(name)
+        path = os.path.join(folder, "retired.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(retired, f)
+        os.replace(path + ".tmp", path)
+        for name in names:
+            os.remove(os.path.join(folder, name))
+
+    def render(self):
+        lines, families = [], {}
+        for key, value in self.collect().items():
+            families.setdefault(re.sub(r"_(bucket|count|sum)$", "", key.split("{", 1)[0]), []).append((key, value))
+        for family in sorted(families):
+            kind, help_text = METRIC_HELP.get(family, ("untyped", family))
+            lines += [f"# HELP {family} {help_text}", f"# TYPE {family} {kind}"]
+            lines += [f"{key} {value:g}" for key, value in sorted(families[family])]
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _sql_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_started"] = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _sql_finished(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop("query_started", None)
+    if started is not None and has_request_context() and "sql_log" in g:
+        elapsed = time.perf_counter() - started
+        g.sql_time += elapsed
+        g.sql_log.append((elapsed, statement))
+
+@before_render_template.connect_via(app)
+def _template_started(sender, template, context, **extra):
+    if has_request_context():
+        g.setdefault("tpl_started", []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def _template_finished(sender, template, context, **extra):
+    if has_request_context() and g.get("tpl_started"):
+        g.tpl_time = g.get("tpl_time", 0.0) + time.perf_counter() - g.tpl_started.pop()
+
+@app.before_request
+def _start_timer():
+    g.started, g.sql_time, g.sql_log = time.perf_counter(), 0.0, []
+
+@app.after_request
+def _record_timings(response):
+    if "started" not in g:
+        return response
+    elapsed = time.perf_counter() - g.started
+    tpl_time = g.get("tpl_time", 0.0)
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    size = 0 if response.is_streamed else response.calculate_content_length() or 0
+    response.headers["Server-Timing"] = (
+        f'app;dur={elapsed * 1000:.1f}, db;dur={g.sql_time * 1000:.1f};desc="{len(g.sql_log)} queries", '
+        f"tpl;dur={tpl_time * 1000:.1f}"
+    )
+    metrics.observe(route, request.method, response.status_code, elapsed, len(g.sql_log), g.sql_time, tpl_time, size)
+    metrics.flush()
+    if elapsed * 1000 >= app.config["SLOW_REQUEST_MS"]:
+        app.logger.warning(
+            "Slow request %s %s: %.0f ms, %d queries (%.0f ms)\n%s",
+            request.method, request.full_path, elapsed * 1000, len(g.sql_log), g.sql_time * 1000,
+            "\n".join(f"  {t * 1000:7.1f} ms  {stmt}" for t, stmt in g.sql_log),
+        )
+    return response
+
+@app.route("/metrics")
+def metrics_view():
+    token = app.config["METRICS_TOKEN"]
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        abort(403)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# RESPONSE CACHE: public GET pages are cached whole and revalidated with
+# ETag/Last-Modified. Each page depends on a few entity keys ("thread:7",
+# "schools", ...) whose version counters the write paths bump, so a cached
+# page is only reused while all of its keys are unchanged. CACHE_BACKEND
+# "memory" keeps the counters per worker, so it is only correct for a single
+# process (flask run, tests); "database" keeps them in the cache_version table
+# so every gunicorn worker sees every invalidation, and gunicorn.conf.py
+# selects it whenever it starts more than one worker.
+app.config["CACHE_BACKEND"] = os.environ.get("CACHE_BACKEND", "memory")
+app.config["CACHE_MAX_ENTRIES"] = int(os.environ.get("CACHE_MAX_ENTRIES", 1000))
+
+class MemoryCache:
+    """Rendered pages in an LRU dict; version counters local to this process.
+
+    Lookups and evictions are counted in /metrics under the cache `name`.
+    """
+
+    def __init__(self, max_entries, name="page"):
+        self.pages, self.max_entries, self.lock = OrderedDict(), max_entries, threading.Lock()
+        self.name, self._versions = name, {}
+
+    def get(self, key):
+        with self.lock:
+            page = self.pages.get(key)
+            if page is not None:
+                self.pages.move_to_end(key)
+        metrics.count("lol_cache_lookups_total", cache=self.name, result="miss" if page is None else "hit")
+        return page
+
+    def set(self, key, page):
+        evicted = 0
+        with self.lock:
+            self.pages[key] = page
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.max_entries:
+                self.pages.popitem(last=False)
+                evicted += 1
+        if evicted:
+            metrics.count("lol_cache_evictions_total", evicted, cache=self.name)
+
+    def pop(self, key):
+        with self.lock:
+            self.pages.pop(key, None)
+
+    def versions(self, keys):
+        """{key: (version, last modified)} for `keys`."""
+        return {k: self._versions.get(k, (0, BOOT_TIME)) for k in keys}
+
+    def bump(self, keys):
+        now = datetime.utcnow()
+        with self.lock:
+            for k in keys:
+                self._versions[k] = (self._versions.get(k, (0, now))[0] + 1, now)
+
+class DatabaseCache(MemoryCache):
+    """Pages stay in this worker's LRU, counters live in cache_version."""
+
+    def versions(self, keys):
+        rows = db.session.query(CacheVersion.key, CacheVersion.version, CacheVersion.updated).filter(CacheVersion.key.in_(keys))
+        found = {k: (v, updated) for k, v, updated in rows}
+        return {k: found.get(k, (0, BOOT_TIME)) for k in keys}
+
+    def bump(self, keys):
+        insert = (postgresql if db.engine.dialect.name == "postgresql" else sqlite).insert
+        now = datetime.utcnow()
+        for k in keys:
+            stmt = insert(CacheVersion).values(key=k, version=1, updated=now)
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=[CacheVersion.key], set_={"version": CacheVersion.version + 1, "updated": now}))
+        db.session.commit()
+
+BOOT_TIME = datetime.utcnow().replace(microsecond=0)
+CACHE_BACKENDS = {"memory": MemoryCache, "database": DatabaseCache}
+page_cache = CACHE_BACKENDS[app.config["CACHE_BACKEND"]](app.config["CACHE_MAX_ENTRIES"])
+
+def bump(*keys):
+    """Invalidate every cached page that depends on one of `keys`."""
+    page_cache.bump(set(keys))
+
+def cached_page(*deps, flashes=True):
+    """Serve a GET view from page_cache, answering 304 when the client is current.
+
+    `deps` are entity keys formatted with the view arguments, e.g. "thread:{thread_id}",
+    and with the viewer's school as `viewer_school`.
+    The key also covers the query string and the viewer (role and user id), as
+    the navbar and the delete links differ per user. Requests with pending
+    flash messages are never cached, unless the view does not show them
+    (`flashes=False`).
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            if request.method != "GET" or (flashes and "_flashes" in session):
+                return view(**kwargs)
+            keys = ["all"] + [d.format(**kwargs, viewer_school=session.get("school_id")) for d in deps]
+            versions = page_cache.versions(keys)
+            viewer = f"{session.get('role', 'anon')}:{session.get('user_id', '')}"
+            state = "|".join(f"{k}={versions[k][0]}" for k in keys)
+            etag = hashlib.sha1(f"{request.full_path}|{viewer}|{state}".encode()).hexdigest()
+            last_modified = max(updated for _, updated in versions.values()).replace(microsecond=0)
+            # a replica may not have the change behind a recent bump yet; never cache its view of it
+            g.fresh_reads = datetime.utcnow() - last_modified < timedelta(seconds=app.config["REPLICA_STICKY_SECONDS"])
+            if etag_matches(etag) or (
+                    not request.if_none_match and request.if_modified_since
+                    and request.if_modified_since.replace(tzinfo=None) >= last_modified):
+                response = Response(status=304)
+            else:
+                page = page_cache.get(etag)
+                if page is None:
+                    response = app.make_response(view(**kwargs))
+                    if response.status_code != 200 or response.is_streamed:
+                        return response
+                    page_cache.set(etag, (response.get_data(), response.mimetype))
+                else:
+                    response = Response(page[0], mimetype=page[1])
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            response.vary.add("Cookie")
+            return response
+        return wrapper
+    return decorator
+
+# LIVE FEEDS: /feed/lol and /feed/spotted are Server-Sent Event streams of new
+# entries. One poller thread per worker looks for rows with a higher id every
+# FEED_POLL_SECONDS, renders each new row once and hands it to every waiting
+# stream, so the database cost does not grow with the number of subscribers.
+# Streams resume from Last-Event-ID (or ?since=) so nothing is lost on reconnect.
+# Postgres hands out ids before commit, so id N+1 can be visible while N is
+# still in flight: the poller publishes in id order and stops at the first gap
+# until it fills, or FEED_GAP_SECONDS pass (a rolled back or deleted row).
+class FeedHub:
+    def __init__(self, buffer=200):
+        self.lock = threading.Lock()
+        self.buffer = buffer
+        self.feeds = {}
+        self.last_ids = {}
+        self.gaps = {}  # model -> (first missing id, monotonic time it was seen)
+        self.subscribers = 0
+        self.poller = None
+
+    def _feed(self, name):
+        if name not in self.feeds:
+            self.feeds[name] = (threading.Condition(self.lock), deque(maxlen=self.buffer))
+        return self.feeds[name]
+
+    def subscribe(self, model, since):
+        """Count a stream that has seen `model` rows up to `since`; the first one
+        sets where the poller starts, so nothing after its backlog is missed."""
+        with self.lock:
+            self.subscribers += 1
+            self.last_ids.setdefault(model, since)
+            if self.poller is None:
+                self.poller = threading.Thread(target=self._poll, name="feed-poller", daemon=True)
+                self.poller.start()
+
+    def unsubscribe(self):
+        with self.lock:
+            self.subscribers -= 1
+
+    def publish(self, name, items):
+        """Append (row id, author id, html, html with delete link) items to a feed."""
+        with self.lock:
+            cond, events = self._feed(name)
+            events.extend(items)
+            cond.notify_all()
+
+    def wait(self, name, since, timeout):
+        """Items of feed `name` newer than `since`, waiting up to `timeout` for one."""
+        with self.lock:
+            cond, events = self._feed(name)
+            if not events or events[-1][0] <= since:
+                cond.wait(timeout)
+            return [item for item in events if item[0] > since]
+
+    def _poll(self):
+        while True:
+            time.sleep(app.config["FEED_POLL_SECONDS"])
+            with self.lock:
+                if not self.subscribers:
+                    self.last_ids.clear(); self.gaps.clear()
+                    continue
+            try:
+                with app.test_request_context("/"):
+                    self.collect()
+            except Exception:
+                app.logger.exception("live feed poll failed")
+
+    def collect(self):
+        for model, feed_name in FEED_SOURCES:
+            last = self.last_ids.get(model)
+            if last is None:
+                self.last_ids[model] = db.session.query(db.func.max(model.id)).scalar() or 0
+                continue
+            # hidden rows are read too, so they do not look like gaps
+            rows, ready = model.query.filter(model.id > last).order_by(model.id).limit(app.config["PAGE_SIZE"]).all(), []
+            for row in rows:
+                if row.id != last + 1:
+                    missing, seen = self.gaps.get(model, (None, None))
+                    if missing != last + 1:
+                        missing, seen = last + 1, time.monotonic()
+                        self.gaps[model] = (missing, seen)
+                    if time.monotonic() - seen < app.config["FEED_GAP_SECONDS"]:
+                        break
+                last = row.id
+                ready.append(row)
+            if not ready:
+                continue
+            self.last_ids[model] = last
+            rows = [row for row in ready if not row.deleted]
+            names, grouped = author_names(*rows), {}
+            for row in rows:
+                grouped.setdefault(feed_name(row), []).append(
+                    (row.id, row.user_id, render_feed_item(row, names), render_feed_item(row, names, deletable=True)))
+            for name, items in grouped.items():
+                self.publish(name, items)
+
+FEED_SOURCES = [
+    (LOLPost, lambda row: "lol"),
+    (Spotted, lambda row: f"spotted:{row.school_id}"),
+]
+feed_hub = FeedHub()
+
+def render_feed_item(row, names, deletable=False):
+    entry = app.jinja_env.get_template("macros.html").module.entry
+    if isinstance(row, Spotted):
+        return entry(names.get(row.user_id, "Anon"), row, url_for("spotted_view", spotted_id=row.id),
+                     url_for("teacher_delete_spotted", spotted_id=row.id) if deletable else None)
+    return entry(names.get(row.user_id, "Anon"), row, url_for("lol_view", post_id=row.id),
+                 url_for("lol_delete", post_id=row.id) if deletable else None)
+
+def sse_event(row_id, html):
+    return f"id: {row_id}\n" + "".join(f"data: {line}\n" for line in str(html).splitlines()) + "\n"
+
+@app.route("/feed/<any(lol, spotted):feed>")
+def feed_stream(feed):
+    if "user_id" not in session: abort(403)
+    me, teacher = session.get("user_id"), session.get("role") == "nauczyciel"
+    if feed == "spotted":
+        if session.get("role") not in ("nauczyciel","uczen") or not session.get("school_id"): abort(403)
+        model, name = Spotted, f"spotted:{session.get('school_id')}"
+        query, deletable = Spotted.query.filter_by(school_id=session.get("school_id"), deleted=False), lambda author: teacher
+    else:
+        model, name = LOLPost, "lol"
+        query, deletable = LOLPost.query.filter_by(deleted=False), lambda author: teacher or author == me
+    since = request.headers.get("Last-Event-ID") or request.args.get("since", "")
+    if not since.isdigit(): abort(400)
+    since = int(since)
+    # rows the page missed are sent straight away; later ones come from the hub,
+    # so the backlog stops where the hub is (it may be holding at a gap)
+    backlog = query.filter(model.id > since)
+    if feed_hub.last_ids.get(model) is not None:
+        backlog = backlog.filter(model.id <= feed_hub.last_ids[model])
+    backlog = backlog.order_by(model.id).limit(app.config["PAGE_SIZE"]).all()
+    names = author_names(*backlog)
+    first = [sse_event(row.id, render_feed_item(row, names, deletable(row.user_id))) for row in backlog]
+    since = backlog[-1].id if backlog else since
+    db.session.close()
+
+    def events(since):
+        feed_hub.subscribe(model, since)
+        try:
+            yield "retry: 3000\n\n"
+            yield from first
+            deadline = time.monotonic() + app.config["FEED_MAX_SECONDS"]
+            while time.monotonic() < deadline:
+                items = feed_hub.wait(name, since, app.config["FEED_KEEPALIVE_SECONDS"])
+                if not items:
+                    yield ": ping\n\n"
+                for row_id, author, html, delete_html in items:
+                    since = row_id
+                    yield sse_event(row_id, delete_html if deletable(author) else html)
+        finally:
+            feed_hub.unsubscribe()
+    return Response(events(since), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# SPOTTED CACHE: every member of a school sees the same Spotted feed, so the
+# newest SPOTTED_CACHE_DEPTH entries of each school are kept as an id list
+# and each entry as rendered HTML, in both the student and the teacher
+# (with delete link) variant; the view only picks the variant per viewer.
+# A school's list is tied to the "spotted:<id>" version counter of the
+# response cache (and "all"), so with CACHE_BACKEND=database a write in one
+# worker invalidates it in every worker. An entry's HTML is reused while its
+# reply_count matches the list, so a new reply re-renders just that entry.
+app.config["SPOTTED_CACHE_DEPTH"] = int(os.environ.get("SPOTTED_CACHE_DEPTH", 5 * app.config["PAGE_SIZE"]))
+app.config["SPOTTED_CACHE_SCHOOLS"] = int(os.environ.get("SPOTTED_CACHE_SCHOOLS", 500))
+app.config["SPOTTED_CACHE_ENTRIES"] = int(os.environ.get("SPOTTED_CACHE_ENTRIES", 10000))
+SpottedRef = namedtuple("SpottedRef", "id created reply_count")
+
+class SpottedCache:
+    def __init__(self):
+        self.schools = MemoryCache(app.config["SPOTTED_CACHE_SCHOOLS"], "spotted_school")
+        self.entries = MemoryCache(app.config["SPOTTED_CACHE_ENTRIES"], "spotted_entry")
+
+    def newest(self, school_id):
+        """SpottedRefs of the school's newest live entries, newest first."""
+        versions = page_cache.versions(["all", f"spotted:{school_id}"])
+        state = tuple(version for version, _ in versions.values())
+        cached = self.schools.get(school_id)
+        if cached is not None and cached[0] == state:
+            return cached[1]
+        refs = [SpottedRef(*row) for row in db.session.query(Spotted.id, Spotted.created, Spotted.reply_count)
+                .filter_by(school_id=school_id, deleted=False)
+                .order_by(Spotted.created.desc(), Spotted.id.desc()).limit(app.config["SPOTTED_CACHE_DEPTH"])]
+        # a replica may still miss the write behind a recent bump; do not pin its view
+        updated = max(when for _, when in versions.values())
+        if g.get("read_replica") is None or datetime.utcnow() - updated >= timedelta(seconds=app.config["REPLICA_STICKY_SECONDS"]):
+            self.schools.set(school_id, (state, refs))
+        return refs
+
+    def page(self, school_id):
+        """The requested Spotted page served from the id list, or None when it reaches past it."""
+        if request.args.get("newer"):
+            return None
+        refs, size = self.newest(school_id), app.config["PAGE_SIZE"]
+        older, start = request.args.get("older"), 0
+        if older:
+            key = decode_cursor(older)
+            start = next((n for n, ref in enumerate(refs) if (ref.created, ref.id) < key), len(refs))
+        window = refs[start:start + size + 1]
+        if len(window) <= size and len(refs) == app.config["SPOTTED_CACHE_DEPTH"]:
+            return None
+        items = window[:size]
+        return Page(items, encode_cursor(items[-1]) if len(window) > size else None,
+                    encode_cursor(items[0]) if older and items else None)
+
+    def fragments(self, refs, teacher):
+        """{id: entry HTML for this viewer}, rendering only what is not cached."""
+        # a bump("all") (say, rescan_content rewriting entries) outdates every copy
+        found, missing = {}, []
+        generation = page_cache.versions(["all"])["all"][0]
+        for ref in refs:
+            cached = self.entries.get(ref.id)
+            if cached is not None and cached[0] == (ref.reply_count, generation):
+                found[ref.id] = cached[1][teacher]
+            else:
+                missing.append(ref.id)
+        if missing:
+            rows = Spotted.query.filter(Spotted.id.in_(missing), ~Spotted.deleted).all()
+            names = author_names(*rows)
+            for row in rows:
+                variants = (render_feed_item(row, names), render_feed_item(row, names, deletable=True))
+                self.entries.set(row.id, ((row.reply_count, generation), variants))
+                found[row.id] = variants[teacher]
+        return found
+
+    def forget(self, school_id, *entry_ids):
+        """Drop this worker's copies right away; call with the spotted:<id> bump."""
+        self.schools.pop(school_id)
+        for entry_id in entry_ids:
+            self.entries.pop(entry_id)
+
+spotted_cache = SpottedCache()
+
+# ASSETS: stylesheets are served from memory under content-hashed names
+# (/assets/site.<hash>.css) with a one-year immutable Cache-Control, so browsers
+# fetch them once per deploy instead of receiving the CSS inline on every page.
+# BOOTSTRAP_CSS_FILE serves a local (e.g. trimmed) Bootstrap the same way;
+# without it the layout links BOOTSTRAP_CSS_URL.
+app.config["BOOTSTRAP_CSS_URL"] = os.environ.get(
+    "BOOTSTRAP_CSS_URL", "https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css")
+app.config["BOOTSTRAP_CSS_FILE"] = os.environ.get("BOOTSTRAP_CSS_FILE")
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+ASSETS = {
+"site.css": """\
 :root { --bg:#070708; --card:#0f1112; --muted:#cfcfcf; --accent:#79c8ff; --btn:#2b8cff; --danger:#ff6b6b; }
 body { background:var(--bg); color:#fff; -webkit-font-smoothing:antialiased; font-family:Inter,ui-sans-serif,system-ui,Arial; }
 a { color:var(--accent); text-decoration:none; }
@@ -138,7 +1910,116 @@ a { color:var(--accent); text-decoration:none; }
   .header-title { font-size:1.4rem; }
   .container { padding:8px; }
 }
-</style>
+""",
+}
+if app.config["BOOTSTRAP_CSS_FILE"]:
+    with open(app.config["BOOTSTRAP_CSS_FILE"], encoding="utf-8") as f:
+        ASSETS["bootstrap.css"] = f.read()
+
+ASSET_MIMETYPES = {"css": "text/css", "js": "text/javascript"}
+asset_files, asset_names = {}, {}
+for name, body in ASSETS.items():
+    digest = hashlib.sha1(body.encode()).hexdigest()[:12]
+    stem, ext = name.rsplit(".", 1)
+    asset_names[name] = f"{stem}.{digest}.{ext}"
+    asset_files[asset_names[name]] = (body.encode(), ASSET_MIMETYPES[ext], digest)
+
+@app.template_global()
+def asset_url(name):
+    """Fingerprinted URL of asset `name`, or None when it is not configured."""
+    return url_for("asset", name=asset_names[name]) if name in asset_names else None
+
+@app.route("/assets/<name>")
+def asset(name):
+    if name not in asset_files:
+        abort(404)
+    body, mimetype, digest = asset_files[name]
+    if etag_matches(digest):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype=mimetype)
+    response.set_etag(digest)
+    response.cache_control.public = True
+    response.cache_control.max_age = ASSET_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+# COMPRESSION: text responses of at least COMPRESS_MIN_BYTES go out as brotli
+# (when the brotli package is installed) or gzip, whichever the client prefers
+# in Accept-Encoding. Bodies with an ETag (cached pages, assets) are compressed
+# once per encoding and kept in an LRU; streamed pages are compressed chunk by
+# chunk with a flush after each, so rows still reach the browser as they are
+# rendered. Event streams are never compressed.
+app.config["COMPRESS_MIN_BYTES"] = int(os.environ.get("COMPRESS_MIN_BYTES", 500))
+app.config["COMPRESS_LEVEL"] = int(os.environ.get("COMPRESS_LEVEL", 6))
+app.config["COMPRESS_BROTLI_QUALITY"] = int(os.environ.get("COMPRESS_BROTLI_QUALITY", 5))
+COMPRESS_MIMETYPES = {"text/html", "text/css", "text/javascript", "text/plain", "application/json"}
+ENCODINGS = ["br", "gzip"] if brotli else ["gzip"]
+compressed_bodies = MemoryCache(app.config["CACHE_MAX_ENTRIES"], "compressed")
+
+def etag_matches(etag):
+    """True when If-None-Match holds `etag`, with or without an encoding suffix."""
+    return any(tag.split("-", 1)[0] == etag for tag in request.if_none_match.as_set())
+
+def compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=app.config["COMPRESS_BROTLI_QUALITY"])
+    return gzip.compress(data, app.config["COMPRESS_LEVEL"], mtime=0)
+
+def compress_stream(chunks, encoding):
+    if encoding == "br":
+        encoder = brotli.Compressor(quality=app.config["COMPRESS_BROTLI_QUALITY"])
+        step, finish = lambda chunk: encoder.process(chunk) + encoder.flush(), encoder.finish
+    else:
+        encoder = zlib.compressobj(app.config["COMPRESS_LEVEL"], zlib.DEFLATED, 31)
+        step, finish = lambda chunk: encoder.compress(chunk) + encoder.flush(zlib.Z_SYNC_FLUSH), encoder.flush
+    for chunk in chunks:
+        out = step(chunk)
+        if out:
+            yield out
+    yield finish()
+
+@app.after_request
+def _compress(response):
+    if (response.status_code < 200 or response.status_code in (204, 304) or response.direct_passthrough
+            or "Content-Encoding" in response.headers or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.iter_encoded(), encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config["COMPRESS_MIN_BYTES"]:
+            return response
+        etag, weak = response.get_etag()
+        key = f"{etag}-{encoding}" if etag and not weak else None
+        body = compressed_bodies.get(key) if key else None
+        if body is None:
+            body = compress(data, encoding)
+            if key:
+                compressed_bodies.set(key, body)
+        response.set_data(body)
+        if key:
+            response.set_etag(key)
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+# TEMPLATES: compiled once per process and cached by Flask's Jinja environment;
+# every name ends in .html, so user content is autoescaped.
+TEMPLATES = {
+"layout.html": """
+<!doctype html>
+<html lang="pl">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width,initial-scale=1">
+<title>LOL page</title>
+<link href="{{ asset_url('bootstrap.css') or config.BOOTSTRAP_CSS_URL }}" rel="stylesheet">
+<link href="{{ asset_url('site.css') }}" rel="stylesheet">
 </head>
 <body>
 <nav class="navbar navbar-expand-lg mb-3 py-2">
@@ -172,22 +2053,334 @@ a { color:var(--accent); text-decoration:none; }
       {% endfor %}
     {% endif %}
   {% endwith %}
-  {{ content|safe }}
+  {% block content %}{% endblock %}
 </div>
 </body>
 </html>
-"""
+""",
+
+"macros.html": """
+{% macro entry(author, row, replies_url, delete_url=None) -%}
+<div class="post"><b>{{ author }}</b> <span class="meta">({{ row.created }})</span>: {{ row.content }}
+{%- if delete_url %} <a class="text-danger" href="{{ delete_url }}">[Usuń]</a>{% endif %} <a href="{{ replies_url }}">[odpowiedzi{% if row.reply_count %}: {{ row.reply_count }}{% endif %}]</a></div>
+{%- endmacro %}
+
+{% macro live_feed(feed, since) -%}
+<script>
+(function () {
+  var list = document.getElementById("feed");
+  if (!list || !window.EventSource) return;
+  var source = new EventSource("{{ url_for('feed_stream', feed=feed, since=since) }}");
+  source.onmessage = function (e) { list.insertAdjacentHTML("afterbegin", e.data); };
+})();
+</script>
+{%- endmacro %}
+
+{% macro reply(author, row) -%}
+<div class="mb-1"><b>{{ author }}</b>: {{ row.content }}</div>
+{%- endmacro %}
+
+{% macro sort_links(endpoint, current) -%}
+<div class="mb-2 meta">Sortuj:
+{%- for value, label in [(None, "najnowsze"), ("recent", "ostatnia aktywność"), ("active", "najwięcej odpowiedzi")] %}
+{% if value == current %}<b>{{ label }}</b>{% else %}<a href="{{ url_for(endpoint, sort=value) }}">{{ label }}</a>{% endif %}{% if not loop.last %} ·{% endif %}
+{%- endfor %}</div>
+{%- endmacro %}
+
+{% macro search_form(q="") -%}
+<form class="d-flex mb-2" method="get" action="{{ url_for('search_view') }}"><input class="form-control me-2" name="q" placeholder="Szukaj na forum" value="{{ q }}"><button class="btn btn-outline-light">Szukaj</button></form>
+{%- endmacro %}
+
+{% macro page_nav(page, endpoint, newest_first=True, labels=("Starsze", "Nowsze")) -%}
+{% if page.older or page.newer %}
+{%- set older %}{% if page.older %}<a href="{{ url_for(endpoint, older=page.older, **kwargs) }}">{{ labels[0] }}</a>{% else %}<span></span>{% endif %}{% endset -%}
+{%- set newer %}{% if page.newer %}<a href="{{ url_for(endpoint, newer=page.newer, **kwargs) }}">{{ labels[1] }}</a>{% else %}<span></span>{% endif %}{% endset -%}
+<div class="d-flex justify-content-between my-2">{% if newest_first %}{{ newer }}{{ older }}{% else %}{{ older }}{{ newer }}{% endif %}</div>
+{% endif %}
+{%- endmacro %}
+
+{% macro member_directory(members, endpoint) -%}
+<div class="mb-2 meta">
+{%- for role, label in [("nauczyciel", "Nauczyciele"), ("uczen", "Uczniowie")] %}{% if role == members.role %}<b>{{ label }} ({{ members.counts.get(role, 0) }})</b>{% else %}<a href="{{ url_for(endpoint, role=role, q=members.prefix or None, **kwargs) }}">{{ label }} ({{ members.counts.get(role, 0) }})</a>{% endif %}{% if not loop.last %} · {% endif %}
+{%- endfor %}</div>
+<form class="d-flex mb-2" method="get"><input type="hidden" name="role" value="{{ members.role }}"><input class="form-control me-2" name="q" placeholder="Początek loginu" value="{{ members.prefix }}"><button class="btn btn-outline-light">Szukaj</button></form>
+{% for u in members.page.items %}<div class="mb-1">{{ u.username }}{% if caller %}{{ caller(u) }}{% endif %}</div>
+{% endfor %}{{ page_nav(members.page, endpoint, newest_first=False, labels=("Poprzednie", "Następne"), role=members.role, q=members.prefix or None, **kwargs) }}
+{%- endmacro %}
+""",
+
+"index.html": """{% extends "layout.html" %}{% block content %}
+<div class="header-title">LOL page</div>
+<div class="card">
+  <h4>Witamy — forum, LOL page i Spotted</h4>
+  <p class="small-muted">Zaloguj się lub zarejestruj. Nauczyciele i uczniowie mają dostęp do Spotted.</p>
+</div>
+{% endblock %}""",
+
+"register.html": """{% extends "layout.html" %}{% block content %}
+<div class="card">
+  <h3>Rejestracja</h3>
+  <form method="post">
+    <input class="form-control mb-2" name="username" placeholder="Login">
+    <input class="form-control mb-2" name="password" placeholder="Hasło" type="password">
+    <select class="form-select mb-2" name="role">
+      <option value="user">User</option>
+      <option value="uczen">Uczeń</option>
+      <option value="nauczyciel">Nauczyciel</option>
+    </select>
+    <input class="form-control mb-2" name="school" placeholder="Szkoła (opcjonalnie)">
+    <button class="btn btn-primary">Zarejestruj</button>
+  </form>
+</div>
+{% endblock %}""",
+
+"login.html": """{% extends "layout.html" %}{% block content %}
+<div class="card">
+  <h3>Logowanie</h3>
+  <form method="post">
+    <input class="form-control mb-2" name="username" placeholder="Login">
+    <input class="form-control mb-2" name="password" placeholder="Hasło" type="password">
+    <button class="btn btn-primary">Zaloguj</button>
+  </form>
+</div>
+{% endblock %}""",
+
+"schools.html": """{% extends "layout.html" %}{% block content %}
+<div class="card"><h3>Szkoły</h3><a class="btn btn-success mb-2" href="{{ url_for('register_school') }}">Zarejestruj szkołę</a>
+{% for s in schools %}<div class="p-2 mb-2 post"><a href="{{ url_for('school_view', school_id=s.id) }}">{{ s.name }}</a></div>
+{% endfor %}</div>
+{% endblock %}""",
+
+"register_school.html": """{% extends "layout.html" %}{% block content %}
+<div class="card">
+  <h3>Rejestracja szkoły</h3>
+  <form method="post">
+    <input class="form-control mb-2" name="school_name" placeholder="Nazwa szkoły">
+    <input class="form-control mb-2" name="teacher_login" placeholder="Login pierwszego nauczyciela">
+    <input class="form-control mb-2" name="teacher_password" placeholder="Hasło" type="password">
+    <button class="btn btn-primary">Utwórz szkołę i konto nauczyciela</button>
+  </form>
+</div>
+{% endblock %}""",
+
+"school.html": """{% extends "layout.html" %}{% from "macros.html" import member_directory %}{% block content %}
+<div class="card"><h3>{{ school.name }}</h3>
+{{ member_directory(members, 'school_view', school_id=school.id) }}</div>
+{% endblock %}""",
+
+"spotted.html": """{% extends "layout.html" %}{% from "macros.html" import page_nav, live_feed %}{% block content %}
+<div class="card"><h3>Spotted — {{ session.get('school_name') }}</h3>
+<form method="post"><textarea class="form-control mb-2" name="content" placeholder="Napisz spotted..."></textarea><button class="btn btn-primary">Dodaj</button></form><hr>
+<a class="meta" href="{{ url_for('archive_spotted') }}">Archiwum</a>
+{% set ns = namespace(last=0) %}
+<div id="feed">{% for s in page.items %}{{ fragments.get(s.id, "") }}{% if s.id > ns.last %}{% set ns.last = s.id %}{% endif %}
+{% endfor %}</div>{{ page_nav(page, 'spotted') }}</div>
+{% if not page.newer %}{{ live_feed('spotted', ns.last) }}{% endif %}
+{% endblock %}""",
+
+"replies.html": """{% extends "layout.html" %}{% from "macros.html" import reply, page_nav %}{% block content %}
+<div class="card"><h4>{{ names.get(parent.user_id, "Anon") }}: {{ parent.content }}</h4>
+{% for r in page.items %}{{ reply(names.get(r.user_id, "Anon"), r) }}
+{% endfor %}{{ page_nav(page, request.endpoint, newest_first=False, **request.view_args) }}
+<form method="post"><input class="form-control mb-2" name="reply" placeholder="Twoja odpowiedź"><button class="btn btn-primary">Odpowiedz</button></form></div>
+{% endblock %}""",
+
+"teacher_panel.html": """{% extends "layout.html" %}{% from "macros.html" import member_directory %}{% block content %}
+<div class="card"><h3>Panel nauczyciela</h3>
+<h5>Dodaj ucznia</h5><form method="post" action="{{ url_for('teacher_add_student') }}"><input class="form-control mb-2" name="stu_login" placeholder="login"><input class="form-control mb-2" name="stu_pass" placeholder="hasło" type="password"><button class="btn btn-success">Dodaj ucznia</button></form>
+<h5 class="mt-3">Import uczniów</h5><form method="post" action="{{ url_for('teacher_import_students') }}" enctype="multipart/form-data">
+<textarea class="form-control mb-2" name="rows" rows="4" placeholder="login,hasło — jeden uczeń w linii"></textarea>
+<input class="form-control mb-2" type="file" name="csv" accept=".csv,text/csv,text/plain"><button class="btn btn-success">Importuj</button></form>
+<h5 class="mt-3">Dodaj nauczyciela</h5><form method="post" action="{{ url_for('teacher_add_teacher') }}"><input class="form-control mb-2" name="t_login" placeholder="login"><input class="form-control mb-2" name="t_pass" placeholder="hasło" type="password"><button class="btn btn-success">Dodaj nauczyciela</button></form>
+<hr><h5>Użytkownicy szkoły</h5>
+{% call(u) member_directory(members, 'teacher_panel') %}
+{%- if u.role == 'uczen' %} | <a href="{{ url_for('teacher_reset_password', user_id=u.id) }}">Resetuj hasło</a> | <a class="text-danger" href="{{ url_for('teacher_delete_user', user_id=u.id) }}">Usuń</a>
+{%- elif u.role == 'nauczyciel' and u.id != session.get('user_id') %} | <a class="text-danger" href="{{ url_for('teacher_delete_user', user_id=u.id) }}">Usuń nauczyciela</a>
+{%- endif %}
+{%- endcall %}</div>
+{% endblock %}""",
+
+"import_report.html": """{% extends "layout.html" %}{% block content %}
+<div class="card"><h3>Import uczniów</h3>
+{% if stalled %}<div class="alert alert-danger">Import przerwany — sprawdź listę utworzonych kont i zaimportuj pozostałe wiersze ponownie</div>
+{% elif not job.finished %}<meta http-equiv="refresh" content="2"><div class="alert alert-info">Import trwa… gotowe {{ created|length }} z {{ job.total }}</div>{% endif %}
+<p>Utworzono: {{ created|length }}, odrzucono: {{ rejected|length }}</p>
+{% if rejected %}<h5>Odrzucone</h5>
+{% for line_no, login, reason in rejected %}<div class="mb-1 text-danger">Linia {{ line_no }}: {{ login or "—" }} — {{ reason }}</div>
+{% endfor %}{% endif %}
+{% if created %}<h5 class="mt-3">Utworzone konta</h5>
+{% for login in created %}<div class="mb-1">{{ login }}</div>
+{% endfor %}{% endif %}
+<a href="{{ url_for('teacher_panel') }}">« Panel nauczyciela</a></div>
+{% endblock %}""",
+
+"teacher_reset.html": """{% extends "layout.html" %}{% block content %}
+<div class="card"><h4>Reset hasła dla {{ user.username }}</h4><form method="post"><input class="form-control mb-2" name="password" placeholder="Nowe hasło" type="password"><button class="btn btn-primary">Zapisz</button></form></div>
+{% endblock %}""",
+
+"lol.html": """{% extends "layout.html" %}{% from "macros.html" import entry, page_nav, live_feed, sort_links %}{% block content %}
+<div class="card"><h3>LOL page</h3><form method="post"><textarea class="form-control mb-2" name="content" placeholder="Dodaj wpis..."></textarea><button class="btn btn-primary">Dodaj</button></form><hr>
+{{ sort_links('lol_page', sort) }}<a class="meta" href="{{ url_for('archive_lol') }}">Archiwum</a>
+{% set teacher, me, ns = session.get('role') == 'nauczyciel', session.get('user_id'), namespace(last=0) %}
+<div id="feed">{% for p in page.items %}{{ entry(names.get(p.user_id, "Anon"), p, url_for('lol_view', post_id=p.id),
+    url_for('lol_delete', post_id=p.id) if teacher or me == p.user_id) }}{% if p.id > ns.last %}{% set ns.last = p.id %}{% endif %}
+{% endfor %}</div>{{ page_nav(page, 'lol_page', sort=sort) }}</div>
+{% if not page.newer and not sort %}{{ live_feed('lol', ns.last) }}{% endif %}
+{% endblock %}""",
+
+"threads.html": """{% extends "layout.html" %}{% from "macros.html" import page_nav, search_form, sort_links %}{% block content %}
+<div class="card"><h3>Forum</h3>{{ search_form() }}
+<a class="btn btn-success mb-2" href="{{ url_for('thread_new') }}">Nowy wątek</a>
+{{ sort_links('threads', sort) }}<a class="meta" href="{{ url_for('archive_threads') }}">Archiwum</a>
+{% for t in page.items %}<div class="post"><a href="{{ url_for('thread_view', thread_id=t.id) }}">{{ t.title }}</a> <span class="meta">({{ t.created }})
+{%- if t.reply_count %} · {{ t.reply_count }} odp., ostatnia {{ t.last_activity }} — {{ names.get(t.last_author_id, "Anon") }}{% endif %}</span></div>
+{% endfor %}{{ page_nav(page, 'threads', sort=sort) }}</div>
+{% endblock %}""",
+
+"search.html": """{% extends "layout.html" %}{% from "macros.html" import search_form %}{% block content %}
+<div class="card"><h3>Szukaj</h3>{{ search_form(q) }}
+{% for hit in hits %}{% set endpoint, arg, label = links[hit.kind] %}
+<div class="post"><span class="meta">{{ label }}</span> <a href="{{ url_for(endpoint, **{arg: hit.link_id}) }}">{{ hit.snippet|highlight }}</a></div>
+{% else %}{% if q %}<p class="small-muted">Brak wyników</p>{% endif %}
+{% endfor %}<div class="d-flex justify-content-between my-2">
+{%- if page_no > 1 %}<a href="{{ url_for('search_view', q=q, page=page_no - 1) }}">Poprzednie</a>{% else %}<span></span>{% endif %}
+{%- if has_next %}<a href="{{ url_for('search_view', q=q, page=page_no + 1) }}">Następne</a>{% endif %}</div></div>
+{% endblock %}""",
+
+"thread_new.html": """{% extends "layout.html" %}{% block content %}
+<div class="card"><h4>Nowy wątek</h4>
+<form method="post"><input class="form-control mb-2" name="title" placeholder="Tytuł"><button class="btn btn-primary">Utwórz</button></form></div>
+{% endblock %}""",
+
+"archive.html": """{% extends "layout.html" %}{% from "macros.html" import page_nav %}{% block content %}
+<div class="card"><h3>Archiwum — {{ title }}</h3><p class="small-muted">Archiwum jest tylko do odczytu.</p>
+{% if parent %}<h4>{% if parent.title %}{{ parent.title }}{% else %}{{ names.get(parent.user_id, "Anon") }}: {{ parent.content }}{% endif %}</h4>{% endif %}
+{% for row in page.items %}<div class="post">
+{%- if row.title %}<a href="{{ url_for(link, **{arg: row.id}) }}">{{ row.title }}</a> <span class="meta">({{ row.created }}){% if row.reply_count %} · {{ row.reply_count }} odp.{% endif %}</span>
+{%- else %}<b>{{ names.get(row.user_id, "Anon") }}</b> <span class="meta">({{ row.created }})</span>: {{ row.content }}
+{%- if link %} <a href="{{ url_for(link, **{arg: row.id}) }}">[odpowiedzi{% if row.reply_count %}: {{ row.reply_count }}{% endif %}]</a>{% endif %}{% endif %}</div>
+{% else %}<p class="small-muted">Pusto</p>
+{% endfor %}{{ page_nav(page, request.endpoint, newest_first=not parent, **request.view_args) }}</div>
+{% endblock %}""",
+
+"thread.html": """{% extends "layout.html" %}{% from "macros.html" import entry, page_nav %}{% block content %}
+<div class="card"><h4>{{ thread.title }}</h4>
+{% set teacher, me = session.get('role') == 'nauczyciel', session.get('user_id') %}
+{% for p in page.items %}{{ entry(names.get(p.user_id, "Anon"), p, url_for('post_view', post_id=p.id),
+    url_for('post_delete', post_id=p.id) if teacher or me == p.user_id) }}
+{% endfor %}{{ page_nav(page, 'thread_view', newest_first=False, thread_id=thread.id) }}
+  <form method="post">
+    <textarea class="form-control mb-2" name="content" placeholder="Dodaj odpowiedź..."></textarea>
+    <button class="btn btn-primary">Dodaj</button>
+  </form>
+</div>
+{% endblock %}""",
+}
+
+app.jinja_loader = DictLoader(TEMPLATES)
+for name in TEMPLATES:
+    app.jinja_env.get_template(name)
 
 @app.route("/")
 def index():
-    content = """
-    <div class="header-title">LOL page</div>
-    <div class="card">
-      <h4>Witamy — forum, LOL page i Spotted</h4>
-      <p class="small-muted">Zaloguj się lub zarejestruj. Nauczyciele i uczniowie mają dostęp do Spotted.</p>
-    </div>
-    """
-    return render_template_string(BASE_HTML, content=content)
+    return render_template("index.html")
+
+# PASSWORDS: checks and hashes run on AUTH_THREADS real threads (hashlib
+# releases the GIL); at most AUTH_QUEUE logins wait for one, and a login that
+# cannot get in line within AUTH_QUEUE_WAIT seconds gets a 503 instead of
+# piling up. Failed logins are counted per client IP and per username in this
+# worker; past LOGIN_IP_FAILURES / LOGIN_USER_FAILURES in LOGIN_FAILURE_WINDOW
+# seconds the next attempt is refused with 429 before any hashing. Hashes made
+# with an older PASSWORD_METHOD are replaced at the next successful login.
+app.config["PASSWORD_METHOD"] = os.environ.get("PASSWORD_METHOD", "scrypt")
+app.config["AUTH_THREADS"] = int(os.environ.get("AUTH_THREADS", len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1))
+app.config["AUTH_QUEUE"] = int(os.environ.get("AUTH_QUEUE", 4 * app.config["AUTH_THREADS"]))
+app.config["AUTH_QUEUE_WAIT"] = float(os.environ.get("AUTH_QUEUE_WAIT", 3))
+app.config["LOGIN_IP_FAILURES"] = int(os.environ.get("LOGIN_IP_FAILURES", 30))
+app.config["LOGIN_USER_FAILURES"] = int(os.environ.get("LOGIN_USER_FAILURES", 5))
+app.config["LOGIN_FAILURE_WINDOW"] = int(os.environ.get("LOGIN_FAILURE_WINDOW", 300))
+# Number of reverse proxies in front of the app, so remote_addr is the client
+app.config["PROXY_HOPS"] = int(os.environ.get("PROXY_HOPS", 0))
+if app.config["PROXY_HOPS"]:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["PROXY_HOPS"], x_proto=app.config["PROXY_HOPS"])
+
+def hash_password(password):
+    return generate_password_hash(password, method=app.config["PASSWORD_METHOD"])
+
+@lru_cache(maxsize=None)
+def reference_hash(method):
+    """A throwaway hash made with `method`; its prefix marks current hashes."""
+    return generate_password_hash(os.urandom(16).hex(), method=method)
+
+def check_login(stored, password):
+    """check_password_hash, against a throwaway hash when the user does not
+    exist so that unknown logins cost (and take) as long as wrong passwords."""
+    return check_password_hash(stored or reference_hash(app.config["PASSWORD_METHOD"]), password) and stored is not None
+
+def needs_rehash(stored):
+    return stored.split("$", 1)[0] != reference_hash(app.config["PASSWORD_METHOD"]).split("$", 1)[0]
+
+class AuthBusy(Exception):
+    """Every hashing thread is taken and the queue stayed full."""
+
+class AuthPool:
+    def __init__(self):
+        self.lock, self.pid = threading.Lock(), None
+
+    def run(self, fn, *args):
+        """fn(*args) on a hashing thread; raises AuthBusy when the queue is full."""
+        with self.lock:
+            if self.pid != os.getpid():
+                # threads do not survive gunicorn's fork; start them in the worker
+                executor_class = ThreadPoolExecutor
+                if "gevent" in sys.modules:
+                    from gevent import monkey
+                    if monkey.is_module_patched("threading"):
+                        # patched threads are greenlets; hash on real ones
+                        from gevent.threadpool import ThreadPoolExecutor as executor_class
+                self.executor = executor_class(max_workers=app.config["AUTH_THREADS"])
+                self.slots = threading.BoundedSemaphore(app.config["AUTH_QUEUE"])
+                self.pid = os.getpid()
+                self.executor.submit(reference_hash, app.config["PASSWORD_METHOD"])
+        if not self.slots.acquire(timeout=app.config["AUTH_QUEUE_WAIT"]):
+            raise AuthBusy()
+        try:
+            return self.executor.submit(fn, *args).result()
+        finally:
+            self.slots.release()
+
+auth_pool = AuthPool()
+
+class Throttle:
+    """Failures per key in fixed windows, counted in this process only."""
+
+    def __init__(self, limit, window, max_keys=100000):
+        self.limit, self.window, self.max_keys = limit, window, max_keys
+        self.counts, self.lock = OrderedDict(), threading.Lock()
+
+    def retry_after(self, key):
+        """Seconds until `key` may try again, 0 when it is not blocked."""
+        with self.lock:
+            started, count = self.counts.get(key, (0.0, 0))
+            left = started + self.window - time.monotonic()
+            return math.ceil(left) if count >= self.limit and left > 0 else 0
+
+    def fail(self, key):
+        now = time.monotonic()
+        with self.lock:
+            started, count = self.counts.pop(key, (now, 0))
+            if now - started >= self.window:
+                started, count = now, 0
+            self.counts[key] = (started, count + 1)
+            while len(self.counts) > self.max_keys:
+                self.counts.popitem(last=False)
+
+    def clear(self, key):
+        with self.lock:
+            self.counts.pop(key, None)
+
+ip_failures = Throttle(app.config["LOGIN_IP_FAILURES"], app.config["LOGIN_FAILURE_WINDOW"])
+user_failures = Throttle(app.config["LOGIN_USER_FAILURES"], app.config["LOGIN_FAILURE_WINDOW"])
 
 # AUTH
 @app.route("/register", methods=["GET","POST"])
@@ -206,53 +2399,43 @@ def register():
             school = School.query.filter_by(name=school_name).first()
             if not school:
                 flash("Szkoła nie istnieje. Zarejestruj szkołę najpierw.", "warning"); return redirect(url_for("register"))
-        hashed = generate_password_hash(password)
+        hashed = hash_password(password)
         u = User(username=username, password=hashed, role=role, school_id=school.id if school else None)
         db.session.add(u); db.session.commit()
+        if school: bump(f"school:{school.id}")
         flash("Konto utworzone — zaloguj się", "info"); return redirect(url_for("login"))
-    content = """
-    <div class="card">
-      <h3>Rejestracja</h3>
-      <form method="post">
-        <input class="form-control mb-2" name="username" placeholder="Login">
-        <input class="form-control mb-2" name="password" placeholder="Hasło" type="password">
-        <select class="form-select mb-2" name="role">
-          <option value="user">User</option>
-          <option value="uczen">Uczeń</option>
-          <option value="nauczyciel">Nauczyciel</option>
-        </select>
-        <input class="form-control mb-2" name="school" placeholder="Szkoła (opcjonalnie)">
-        <button class="btn btn-primary">Zarejestruj</button>
-      </form>
-    </div>
-    """
-    return render_template_string(BASE_HTML, content=content)
+    return render_template("register.html")
 
 @app.route("/login", methods=["GET","POST"])
 def login():
     if request.method == "POST":
         username = request.form.get("username","").strip()
         password = request.form.get("password","")
-        user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password, password):
+        ip, login_key = request.remote_addr or "", username.lower()
+        wait = max(ip_failures.retry_after(ip), user_failures.retry_after(login_key))
+        if wait:
+            flash(f"Za dużo nieudanych prób logowania, spróbuj ponownie za {wait} s", "warning")
+            return render_template("login.html"), 429, {"Retry-After": str(wait)}
+        user, school_name = (db.session.query(User, School.name).outerjoin(School, User.school_id == School.id)
+                             .filter(User.username == username, ~User.deleted).first()) or (None, None)
+        try:
+            ok = auth_pool.run(check_login, user.password if user else None, password)
+            if ok and needs_rehash(user.password):
+                user.password = auth_pool.run(hash_password, password); db.session.commit()
+        except AuthBusy:
+            flash("Serwer jest przeciążony, spróbuj za chwilę", "warning")
+            return render_template("login.html"), 503, {"Retry-After": "5"}
+        if ok:
+            user_failures.clear(login_key)
             session["user_id"] = user.id
             session["username"] = user.username
             session["role"] = user.role
             session["school_id"] = user.school_id
-            session["school_name"] = user.school.name if user.school else None
+            session["school_name"] = school_name
             flash("Zalogowano", "info"); return redirect(url_for("index"))
+        ip_failures.fail(ip); user_failures.fail(login_key)
         flash("Błędny login lub hasło", "warning")
-    content = """
-    <div class="card">
-      <h3>Logowanie</h3>
-      <form method="post">
-        <input class="form-control mb-2" name="username" placeholder="Login">
-        <input class="form-control mb-2" name="password" placeholder="Hasło" type="password">
-        <button class="btn btn-primary">Zaloguj</button>
-      </form>
-    </div>
-    """
-    return render_template_string(BASE_HTML, content=content)
+    return render_template("login.html")
 
 @app.route("/logout")
 def logout():
@@ -260,13 +2443,11 @@ def logout():
 
 # SCHOOLS LIST & REGISTER
 @app.route("/schools")
+@cached_page("schools")
+@replica_reads
 def schools_list():
     schools = School.query.order_by(School.name).all()
-    html = '<div class="card"><h3>Szkoły</h3><a class="btn btn-success mb-2" href="%s">Zarejestruj szkołę</a>' % url_for("register_school")
-    for s in schools:
-        html += '<div class="p-2 mb-2 post"><a href="%s">%s</a></div>' % (url_for("school_view", school_id=s.id), s.name)
-    html += "</div>"
-    return render_template_string(BASE_HTML, content=html)
+    return render_template("schools.html", schools=schools)
 
 @app.route("/register_school", methods=["GET","POST"])
 def register_school():
@@ -279,37 +2460,22 @@ def register_school():
         if School.query.filter_by(name=name).first():
             flash("Taka szkoła już istnieje", "warning"); return redirect(url_for("register_school"))
         school = School(name=name); db.session.add(school); db.session.commit()
-        hashed = generate_password_hash(teacher_pass)
+        hashed = hash_password(teacher_pass)
         t = User(username=teacher_login, password=hashed, role="nauczyciel", school_id=school.id)
-        db.session.add(t); db.session.commit()
+        db.session.add(t); db.session.commit(); bump("schools", f"school:{school.id}")
         flash("Szkoła i konto nauczyciela utworzone", "info"); return redirect(url_for("login"))
-    content = """
-    <div class="card">
-      <h3>Rejestracja szkoły</h3>
-      <form method="post">
-        <input class="form-control mb-2" name="school_name" placeholder="Nazwa szkoły">
-        <input class="form-control mb-2" name="teacher_login" placeholder="Login pierwszego nauczyciela">
-        <input class="form-control mb-2" name="teacher_password" placeholder="Hasło" type="password">
-        <button class="btn btn-primary">Utwórz szkołę i konto nauczyciela</button>
-      </form>
-    </div>
-    """
-    return render_template_string(BASE_HTML, content=content)
+    return render_template("register_school.html")
 
 @app.route("/schools/<int:school_id>")
+@cached_page("school:{school_id}")
+@replica_reads
 def school_view(school_id):
     s = School.query.get_or_404(school_id)
-    teachers = User.query.filter_by(school_id=s.id, role="nauczyciel").all()
-    students = User.query.filter_by(school_id=s.id, role="uczen").all()
-    html = f'<div class="card"><h3>{s.name}</h3><h5>Nauczyciele</h5>'
-    for t in teachers: html += f'<div class="mb-1">{t.username}</div>'
-    html += "<h5>Uczniowie</h5>"
-    for st in students: html += f'<div class="mb-1">{st.username}</div>'
-    html += "</div>"
-    return render_template_string(BASE_HTML, content=html)
+    return render_template("school.html", school=s, members=member_directory(s.id))
 
 # SPOTTED (school-only)
 @app.route("/spotted", methods=["GET","POST"])
+@replica_reads
 def spotted():
     if "user_id" not in session or session.get("role") not in ("nauczyciel","uczen"):
         abort(403)
@@ -318,69 +2484,43 @@ def spotted():
         flash("Nie jesteś przypisany do szkoły", "warning"); return redirect(url_for("index"))
     if request.method == "POST":
         content = clean_text(request.form.get("content",""))
-        sp = Spotted(content=content, school_id=school_id, user_id=session.get("user_id"))
-        db.session.add(sp); db.session.commit(); return redirect(url_for("spotted"))
-    spots = Spotted.query.filter_by(school_id=school_id).order_by(Spotted.created.desc()).all()
-    html = f'<div class="card"><h3>Spotted — {session.get("school_name")}</h3>'
-    html += '<form method="post"><textarea class="form-control mb-2" name="content" placeholder="Napisz spotted..."></textarea><button class="btn btn-primary">Dodaj</button></form><hr>'
-    for s in spots:
-        usr = User.query.get(s.user_id); author = usr.username if usr else "Anon"
-        rem = ''
-        if session.get("role")=="nauczyciel":
-            rem = f' <a class="text-danger" href="{url_for("teacher_delete_spotted", spotted_id=s.id)}">[Usuń]</a>'
-        html += f'<div class="post"><b>{author}</b> <span class="meta">({s.created})</span>: {s.content} {rem} <a href="{url_for("spotted_view", spotted_id=s.id)}">[odpowiedzi]</a></div>'
-    html += "</div>"
-    return render_template_string(BASE_HTML, content=html)
+        save_post(Spotted, dict(content=content, school_id=school_id, user_id=session.get("user_id")), keys=[f"spotted:{school_id}"])
+        spotted_cache.forget(school_id)
+        return redirect(url_for("spotted"))
+    page = spotted_cache.page(school_id) or keyset_page(Spotted.query.filter_by(school_id=school_id, deleted=False), Spotted)
+    fragments = spotted_cache.fragments(page.items, session.get("role") == "nauczyciel")
+    return render_template("spotted.html", page=page, fragments=fragments)
 
 @app.route("/spotted/<int:spotted_id>", methods=["GET","POST"])
+@replica_reads
 def spotted_view(spotted_id):
     if "user_id" not in session or session.get("role") not in ("nauczyciel","uczen"):
         abort(403)
-    sp = Spotted.query.get_or_404(spotted_id)
+    sp = get_live_or_404(Spotted, spotted_id, archived=True)
     if sp.school_id != session.get("school_id"):
         abort(403)
     if request.method == "POST":
         txt = clean_text(request.form.get("reply",""))
         if txt:
-            r = SpottedReply(content=txt, spotted_id=sp.id, user_id=session.get("user_id"))
-            db.session.add(r); db.session.commit()
+            save_post(SpottedReply, dict(content=txt, spotted_id=sp.id, user_id=session.get("user_id")), sp, [f"spotted:{sp.school_id}"])
+            spotted_cache.forget(sp.school_id, sp.id)
         return redirect(url_for("spotted_view", spotted_id=sp.id))
-    replies = SpottedReply.query.filter_by(spotted_id=sp.id).order_by(SpottedReply.created).all()
-    author = User.query.get(sp.user_id); an = author.username if author else "Anon"
-    html = f'<div class="card"><h4>{an}: {sp.content}</h4>'
-    for r in replies:
-        u = User.query.get(r.user_id); name = u.username if u else "Anon"
-        html += f'<div class="mb-1"><b>{name}</b>: {r.content}</div>'
-    html += f'<form method="post"><input class="form-control mb-2" name="reply" placeholder="Twoja odpowiedź"><button class="btn btn-primary">Odpowiedz</button></form></div>'
-    return render_template_string(BASE_HTML, content=html)
+    page = keyset_page(SpottedReply.query.filter_by(spotted_id=sp.id), SpottedReply, newest_first=False)
+    return render_template("replies.html", parent=sp, page=page, names=author_names(sp, *page.items))
 
 @app.route("/teacher/delete_spotted/<int:spotted_id>")
 def teacher_delete_spotted(spotted_id):
     if session.get("role")!="nauczyciel": abort(403)
-    sp = Spotted.query.get_or_404(spotted_id)
+    sp = get_live_or_404(Spotted, spotted_id)
     if sp.school_id != session.get("school_id"): abort(403)
-    db.session.delete(sp); db.session.commit(); flash("Wpis usunięty", "info"); return redirect(url_for("spotted"))
+    delete_tree(sp); spotted_cache.forget(sp.school_id, spotted_id); bump(f"spotted:{sp.school_id}")
+    flash("Wpis usunięty", "info"); return redirect(url_for("spotted"))
 
 # TEACHER PANEL
 @app.route("/teacher/panel")
 def teacher_panel():
     if session.get("role")!="nauczyciel": abort(403)
-    school_id = session.get("school_id")
-    users = User.query.filter_by(school_id=school_id).all()
-    html = '<div class="card"><h3>Panel nauczyciela</h3>'
-    html += '<h5>Dodaj ucznia</h5><form method="post" action="%s"><input class="form-control mb-2" name="stu_login" placeholder="login"><input class="form-control mb-2" name="stu_pass" placeholder="hasło" type="password"><button class="btn btn-success">Dodaj ucznia</button></form>' % url_for("teacher_add_student")
-    html += '<h5 class="mt-3">Dodaj nauczyciela</h5><form method="post" action="%s"><input class="form-control mb-2" name="t_login" placeholder="login"><input class="form-control mb-2" name="t_pass" placeholder="hasło" type="password"><button class="btn btn-success">Dodaj nauczyciela</button></form>' % url_for("teacher_add_teacher")
-    html += "<hr><h5>Użytkownicy szkoły</h5>"
-    for u in users:
-        html += f'<div class="mb-1">{u.username} — {u.role} '
-        if u.role == "uczen":
-            html += f'| <a href="{url_for("teacher_reset_password", user_id=u.id)}">Resetuj hasło</a> | <a class="text-danger" href="{url_for("teacher_delete_user", user_id=u.id)}">Usuń</a>'
-        elif u.role == "nauczyciel":
-            if u.id != session.get("user_id"):
-                html += f'| <a class="text-danger" href="{url_for("teacher_delete_user", user_id=u.id)}">Usuń nauczyciela</a>'
-        html += "</div>"
-    html += "</div>"
-    return render_template_string(BASE_HTML, content=html)
+    return render_template("teacher_panel.html", members=member_directory(session.get("school_id")))
 
 @app.route("/teacher/add_student", methods=["POST"])
 def teacher_add_student():
@@ -388,8 +2528,144 @@ def teacher_add_student():
     login = request.form.get("stu_login","").strip(); pw = request.form.get("stu_pass","")
     if not login or not pw: flash("Wypełnij pola", "warning"); return redirect(url_for("teacher_panel"))
     if User.query.filter_by(username=login).first(): flash("Login już istnieje", "warning"); return redirect(url_for("teacher_panel"))
-    hashed = generate_password_hash(pw); u = User(username=login, password=hashed, role="uczen", school_id=session.get("school_id"))
-    db.session.add(u); db.session.commit(); flash("Uczeń dodany", "info"); return redirect(url_for("teacher_panel"))
+    hashed = hash_password(pw); u = User(username=login, password=hashed, role="uczen", school_id=session.get("school_id"))
+    db.session.add(u); db.session.commit(); bump(f"school:{u.school_id}"); flash("Uczeń dodany", "info"); return redirect(url_for("teacher_panel"))
+
+# BULK IMPORT: "login,password" rows; hashing fans out over a process pool.
+# Hashing a school's worth of passwords outlasts the request timeout, so it runs
+# in a thread of the worker that took the upload (the passwords never leave its
+# memory) and the report page polls the import_job row, batch by batch.
+app.config["IMPORT_MAX_ROWS"] = int(os.environ.get("IMPORT_MAX_ROWS", 5000))
+app.config["IMPORT_BATCH"] = int(os.environ.get("IMPORT_BATCH", 100))
+app.config["IMPORT_PROCESSES"] = int(os.environ.get("IMPORT_PROCESSES", app.config["AUTH_THREADS"]))
+# an unfinished import without progress for this long died with its worker
+app.config["IMPORT_STALL_SECONDS"] = int(os.environ.get("IMPORT_STALL_SECONDS", 300))
+_hash_pool, _hash_pool_users, _hash_pool_lock = None, 0, threading.Lock()
+
+@contextmanager
+def hashing():
+    """Keep the hashing pool for the block; the last import to leave shuts it down."""
+    global _hash_pool, _hash_pool_users
+    with _hash_pool_lock:
+        _hash_pool_users += 1
+    try:
+        yield
+    finally:
+        with _hash_pool_lock:
+            _hash_pool_users -= 1
+            pool = None
+            if not _hash_pool_users:
+                pool, _hash_pool = _hash_pool, None
+        if pool is not None:
+            pool.shutdown()
+
+def hash_passwords(passwords):
+    """hash_password for many passwords, spread over IMPORT_PROCESSES processes.
+
+    Call it inside `with hashing():` so the processes go away afterwards.
+    """
+    global _hash_pool
+    if len(passwords) < 8:
+        return [hash_password(pw) for pw in passwords]
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            # created on first use, so a preloading gunicorn master never owns it
+            _hash_pool = ProcessPoolExecutor(max_workers=app.config["IMPORT_PROCESSES"])
+        pool = _hash_pool
+    return list(pool.map(partial(generate_password_hash, method=app.config["PASSWORD_METHOD"]), passwords, chunksize=max(len(passwords) // (4 * app.config["IMPORT_PROCESSES"]), 1)))
+
+def parse_import(text):
+    """Split pasted or uploaded text into (valid rows, rejected rows).
+
+    Valid rows are (line number, login, password); rejected ones are
+    (line number, login, reason). Commas, semicolons and tabs all work as
+    separators and a "login,password" header line is skipped.
+    """
+    try:
+        dialect = csv.Sniffer().sniff(text[:2048], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    valid, rejected, seen = [], [], set()
+    for line_no, row in enumerate(csv.reader(io.StringIO(text), dialect), start=1):
+        row = [cell.strip() for cell in row]
+        if not any(row):
+            continue
+        login, pw = (row + ["", ""])[:2]
+        if line_no == 1 and login.lower() in ("login", "username") and pw.lower() in ("password", "haslo", "hasło"):
+            continue
+        if not login or not pw:
+            rejected.append((line_no, login, "brak loginu lub hasła"))
+        elif len(login) > User.username.type.length:
+            rejected.append((line_no, login, "login za długi"))
+        elif login in seen:
+            rejected.append((line_no, login, "powtórzony w pliku"))
+        else:
+            seen.add(login); valid.append((line_no, login, pw))
+    return valid, rejected
+
+def run_import(job_id, school_id, valid):
+    """Hash and insert `valid` rows batch by batch, recording progress in import job `job_id`."""
+    with app.app_context(), hashing():
+        first = 0
+        try:
+            for first in range(0, len(valid), app.config["IMPORT_BATCH"]):
+                batch = valid[first:first + app.config["IMPORT_BATCH"]]
+                hashes = hash_passwords([pw for _, _, pw in batch])
+                rows = [{"username": login, "password": h, "role": "uczen", "school_id": school_id}
+                        for (_, login, _), h in zip(batch, hashes)]
+                rejected = []
+                try:
+                    db.session.execute(db.insert(User), rows)
+                except IntegrityError:
+                    # someone created one of these logins since the upload was checked
+                    db.session.rollback()
+                    taken = {u for (u,) in db.session.query(User.username).filter(User.username.in_([r["username"] for r in rows]))}
+                    rejected = [(line_no, login, "login już istnieje") for line_no, login, _ in batch if login in taken]
+                    rows = [r for r in rows if r["username"] not in taken]
+                    if rows:
+                        db.session.execute(db.insert(User), rows)
+                job = db.session.get(ImportJob, job_id)
+                job.accounts = json.dumps(json.loads(job.accounts) + [r["username"] for r in rows])
+                job.rejected = json.dumps(json.loads(job.rejected) + rejected)
+                job.updated = datetime.utcnow()
+                db.session.commit()
+        except Exception:  # noqa: BLE001 - the rows left over are reported as rejected
+            db.session.rollback()
+            app.logger.exception("student import %s failed", job_id)
+            job = db.session.get(ImportJob, job_id)
+            job.rejected = json.dumps(json.loads(job.rejected) + [(line_no, login, "błąd importu — spróbuj ponownie")
+                                                                  for line_no, login, _ in valid[first:]])
+        db.session.execute(db.update(ImportJob).where(ImportJob.id == job_id).values(finished=datetime.utcnow()))
+        db.session.commit()
+        bump(f"school:{school_id}")
+
+@app.route("/teacher/import_students", methods=["POST"])
+def teacher_import_students():
+    if session.get("role")!="nauczyciel": abort(403)
+    upload = request.files.get("csv")
+    text = upload.read().decode("utf-8-sig", "replace") if upload and upload.filename else request.form.get("rows","")
+    valid, rejected = parse_import(text)
+    if len(valid) > app.config["IMPORT_MAX_ROWS"]:
+        flash(f"Maksymalnie {app.config['IMPORT_MAX_ROWS']} uczniów naraz", "warning"); return redirect(url_for("teacher_panel"))
+    taken = {u for (u,) in db.session.query(User.username).filter(User.username.in_([login for _, login, _ in valid]))}
+    rejected += [(line_no, login, "login już istnieje") for line_no, login, _ in valid if login in taken]
+    valid = [row for row in valid if row[1] not in taken]
+    job = ImportJob(school_id=session.get("school_id"), total=len(valid), rejected=json.dumps(rejected),
+                    updated=datetime.utcnow(), finished=None if valid else datetime.utcnow())
+    db.session.add(job); db.session.commit()
+    if valid:
+        threading.Thread(target=run_import, args=(job.id, job.school_id, valid), name=f"import-{job.id}", daemon=True).start()
+    return redirect(url_for("teacher_import_report", job_id=job.id))
+
+@app.route("/teacher/import/<int:job_id>")
+def teacher_import_report(job_id):
+    if session.get("role")!="nauczyciel": abort(403)
+    job = db.session.get(ImportJob, job_id)
+    if job is None: abort(404)
+    if job.school_id != session.get("school_id"): abort(403)
+    stalled = job.finished is None and datetime.utcnow() - job.updated > timedelta(seconds=app.config["IMPORT_STALL_SECONDS"])
+    return render_template("import_report.html", job=job, created=json.loads(job.accounts),
+                           rejected=sorted(tuple(r) for r in json.loads(job.rejected)), stalled=stalled)
 
 @app.route("/teacher/add_teacher", methods=["POST"])
 def teacher_add_teacher():
@@ -397,160 +2673,377 @@ def teacher_add_teacher():
     login = request.form.get("t_login","").strip(); pw = request.form.get("t_pass","")
     if not login or not pw: flash("Wypełnij pola", "warning"); return redirect(url_for("teacher_panel"))
     if User.query.filter_by(username=login).first(): flash("Login już istnieje", "warning"); return redirect(url_for("teacher_panel"))
-    hashed = generate_password_hash(pw); u = User(username=login, password=hashed, role="nauczyciel", school_id=session.get("school_id"))
-    db.session.add(u); db.session.commit(); flash("Nauczyciel dodany", "info"); return redirect(url_for("teacher_panel"))
+    hashed = hash_password(pw); u = User(username=login, password=hashed, role="nauczyciel", school_id=session.get("school_id"))
+    db.session.add(u); db.session.commit(); bump(f"school:{u.school_id}"); flash("Nauczyciel dodany", "info"); return redirect(url_for("teacher_panel"))
 
 @app.route("/teacher/reset/<int:user_id>", methods=["GET","POST"])
 def teacher_reset_password(user_id):
     if session.get("role")!="nauczyciel": abort(403)
-    user = User.query.get_or_404(user_id)
+    user = get_live_or_404(User, user_id)
     if user.school_id != session.get("school_id"): abort(403)
     if request.method=="POST":
         newpw = request.form.get("password","")
         if not newpw: flash("Wpisz hasło", "warning"); return redirect(url_for("teacher_reset_password", user_id=user_id))
-        user.password = generate_password_hash(newpw); db.session.commit(); flash("Hasło zresetowane", "info"); return redirect(url_for("teacher_panel"))
-    html = f'<div class="card"><h4>Reset hasła dla {user.username}</h4><form method="post"><input class="form-control mb-2" name="password" placeholder="Nowe hasło" type="password"><button class="btn btn-primary">Zapisz</button></form></div>'
-    return render_template_string(BASE_HTML, content=html)
+        user.password = hash_password(newpw); db.session.commit(); flash("Hasło zresetowane", "info"); return redirect(url_for("teacher_panel"))
+    return render_template("teacher_reset.html", user=user)
 
 @app.route("/teacher/delete_user/<int:user_id>")
 def teacher_delete_user(user_id):
     if session.get("role")!="nauczyciel": abort(403)
-    user = User.query.get_or_404(user_id)
+    user = get_live_or_404(User, user_id)
     if user.school_id != session.get("school_id"): abort(403)
     if user.id == session.get("user_id"): flash("Nie możesz usunąć siebie", "warning"); return redirect(url_for("teacher_panel"))
-    db.session.delete(user); db.session.commit(); flash("Użytkownik usunięty", "info"); return redirect(url_for("teacher_panel"))
+    school_id = user.school_id
+    own = [i for (i,) in db.session.query(Spotted.id).filter_by(user_id=user.id)]
+    delete_tree(user); spotted_cache.forget(school_id, *own); bump(f"school:{school_id}", f"spotted:{school_id}", "users", "archive")
+    flash("Użytkownik usunięty", "info"); return redirect(url_for("teacher_panel"))
 
 # LOL page (only logged-in)
 @app.route("/lol", methods=["GET","POST"])
+@replica_reads
 def lol_page():
     if "user_id" not in session:
         flash("Zaloguj się aby zobaczyć LOL page", "warning"); return redirect(url_for("login"))
     if request.method=="POST":
         txt = clean_text(request.form.get("content",""))
         if txt:
-            lp = LOLPost(content=txt, user_id=session.get("user_id"))
-            db.session.add(lp); db.session.commit()
+            save_post(LOLPost, dict(content=txt, user_id=session.get("user_id")), keys=["lol"])
         return redirect(url_for("lol_page"))
-    posts = LOLPost.query.order_by(LOLPost.created.desc()).all()
-    html = '<div class="card"><h3>LOL page</h3><form method="post"><textarea class="form-control mb-2" name="content" placeholder="Dodaj wpis..."></textarea><button class="btn btn-primary">Dodaj</button></form><hr>'
-    for p in posts:
-        author = User.query.get(p.user_id)
-        author_name = author.username if author else "Anon"
-        delete_btn = ''
-        if session.get("role")=="nauczyciel" or session.get("user_id")==p.user_id:
-            delete_btn = f' <a class="text-danger" href="{url_for("lol_delete", post_id=p.id)}">[Usuń]</a>'
-        html += f'<div class="post"><b>{author_name}</b> <span class="meta">({p.created})</span>: {p.content}{delete_btn} <a href="{url_for("lol_view", post_id=p.id)}">[odpowiedzi]</a></div>'
-    html += "</div>"
-    return render_template_string(BASE_HTML, content=html)
+    sort = request.args.get("sort") if request.args.get("sort") in ACTIVITY_SORTS else None
+    column = getattr(LOLPost, ACTIVITY_SORTS[sort]) if sort else None
+    if app.config["STREAM_PAGES"]:
+        page = keyset_page(LOLPost.query.filter_by(deleted=False), LOLPost, stream=True, sort=column)
+        return stream_page("lol.html", page=page, sort=sort, names=author_names())
+    page = keyset_page(LOLPost.query.filter_by(deleted=False), LOLPost, sort=column)
+    return render_template("lol.html", page=page, sort=sort, names=author_names(*page.items))
 
 @app.route("/lol/<int:post_id>", methods=["GET","POST"])
+@replica_reads
 def lol_view(post_id):
     if "user_id" not in session: abort(403)
-    post = LOLPost.query.get_or_404(post_id)
+    post = get_live_or_404(LOLPost, post_id, archived=True)
     if request.method=="POST":
         txt = clean_text(request.form.get("reply",""))
         if txt:
-            rep = LOLReply(content=txt, post_id=post.id, user_id=session.get("user_id"))
-            db.session.add(rep); db.session.commit()
+            save_post(LOLReply, dict(content=txt, post_id=post.id, user_id=session.get("user_id")), post, ["lol"])
         return redirect(url_for("lol_view", post_id=post_id))
-    replies = LOLReply.query.filter_by(post_id=post.id).order_by(LOLReply.created).all()
-    author = User.query.get(post.user_id); auth = author.username if author else "Anon"
-    html = f'<div class="card"><h4>{auth}: {post.content}</h4>'
-    for r in replies:
-        u = User.query.get(r.user_id); name = u.username if u else "Anon"
-        html += f'<div class="mb-1"><b>{name}</b>: {r.content}</div>'
-    html += f'<form method="post"><input class="form-control mb-2" name="reply" placeholder="Twoja odpowiedź"><button class="btn btn-primary">Odpowiedz</button></form></div>'
-    return render_template_string(BASE_HTML, content=html)
+    page = keyset_page(LOLReply.query.filter_by(post_id=post.id), LOLReply, newest_first=False)
+    return render_template("replies.html", parent=post, page=page, names=author_names(post, *page.items))
 
 @app.route("/lol/delete/<int:post_id>")
 def lol_delete(post_id):
-    p = LOLPost.query.get_or_404(post_id)
+    p = get_live_or_404(LOLPost, post_id)
     if session.get("role")!="nauczyciel" and session.get("user_id")!=p.user_id: abort(403)
-    db.session.delete(p); db.session.commit(); flash("Wpis usunięty", "info"); return redirect(url_for("lol_page"))
+    delete_tree(p); bump("lol"); flash("Wpis usunięty", "info"); return redirect(url_for("lol_page"))
 
 # FORUM: threads/posts/replies/search
 @app.route("/threads")
+@cached_page("threads")
+@replica_reads
 def threads():
     q = request.args.get("q","").strip()
-    if q:
-        threads = Thread.query.filter(Thread.title.ilike(f"%{q}%")).order_by(Thread.created.desc()).all()
-    else:
-        threads = Thread.query.order_by(Thread.created.desc()).all()
-    html = '<div class="card"><h3>Forum</h3><form class="d-flex mb-2" method="get" action="%s"><input class="form-control me-2" name="q" placeholder="Szukaj wątków"><button class="btn btn-outline-light">Szukaj</button></form>' % url_for("threads")
-    html += '<a class="btn btn-success mb-2" href="%s">Nowy wątek</a>' % url_for("thread_new")
-    for t in threads:
-        html += f'<div class="post"><a href="{url_for("thread_view", thread_id=t.id)}">{t.title}</a> <span class="meta">({t.created})</span></div>'
-    html += "</div>"
-    return render_template_string(BASE_HTML, content=html)
+    if q: return redirect(url_for("search_view", q=q))
+    sort = request.args.get("sort") if request.args.get("sort") in ACTIVITY_SORTS else None
+    page = keyset_page(Thread.query.filter_by(deleted=False), Thread, sort=getattr(Thread, ACTIVITY_SORTS[sort]) if sort else None)
+    return render_template("threads.html", page=page, sort=sort, names=author_names(*page.items, column="last_author_id"))
+
+@app.route("/search")
+@replica_reads
+def search_view():
+    q = request.args.get("q","").strip()
+    page_no = max(request.args.get("page", 1, type=int), 1)
+    hits, has_next = search(q, page_no)
+    return render_template("search.html", q=q, hits=hits, has_next=has_next, page_no=page_no, links=SEARCH_LINKS)
 
 @app.route("/threads/new", methods=["GET","POST"])
 def thread_new():
     if request.method=="POST":
         title = clean_text(request.form.get("title",""))
         if not title: flash("Podaj tytuł", "warning"); return redirect(url_for("thread_new"))
-        th = Thread(title=title); db.session.add(th); db.session.commit(); return redirect(url_for("threads"))
-    return render_template_string(BASE_HTML, content="""
-    <div class="card"><h4>Nowy wątek</h4>
-    <form method="post"><input class="form-control mb-2" name="title" placeholder="Tytuł"><button class="btn btn-primary">Utwórz</button></form></div>
-    """)
+        th = Thread(title=title); db.session.add(th); db.session.commit(); bump("threads"); return redirect(url_for("threads"))
+    return render_template("thread_new.html")
 
 @app.route("/threads/<int:thread_id>", methods=["GET","POST"])
+@cached_page("thread:{thread_id}", "users")
+@replica_reads
 def thread_view(thread_id):
-    th = Thread.query.get_or_404(thread_id)
+    th = get_live_or_404(Thread, thread_id, archived=True)
     if request.method=="POST":
         if "user_id" not in session: flash("Zaloguj się by pisać", "warning"); return redirect(url_for("login"))
         content = clean_text(request.form.get("content",""))
         if content:
-            db.session.add(Post(content=content, thread_id=th.id, user_id=session.get("user_id"))); db.session.commit()
+            save_post(Post, dict(content=content, thread_id=th.id, user_id=session.get("user_id")), th, ["threads", f"thread:{th.id}"])
         return redirect(url_for("thread_view", thread_id=thread_id))
-    posts = Post.query.filter_by(thread_id=thread_id).order_by(Post.created).all()
-    html = f'<div class="card"><h4>{th.title}</h4>'
-    for p in posts:
-        u = User.query.get(p.user_id); author = u.username if u else "Anon"
-        controls = ""
-        if session.get("user_id")==p.user_id or session.get("role")=="nauczyciel":
-            controls = f' | <a class="text-danger" href="{url_for("post_delete", post_id=p.id)}">Usuń</a>'
-        html += f'<div class="post"><b>{author}</b> <span class="meta">({p.created})</span>: {p.content}{controls} <a href="{url_for("post_view", post_id=p.id)}">[odpowiedzi]</a></div>'
-    html += f"""
-      <form method="post">
-        <textarea class="form-control mb-2" name="content" placeholder="Dodaj odpowiedź..."></textarea>
-        <button class="btn btn-primary">Dodaj</button>
-      </form>
-    </div>
-    """
-    return render_template_string(BASE_HTML, content=html)
+    posts = Post.query.filter_by(thread_id=thread_id, deleted=False)
+    if app.config["STREAM_PAGES"]:
+        page = keyset_page(posts, Post, newest_first=False, stream=True)
+        return stream_page("thread.html", thread=th, page=page, names=author_names())
+    page = keyset_page(posts, Post, newest_first=False)
+    return render_template("thread.html", thread=th, page=page, names=author_names(*page.items))
 
 @app.route("/post/<int:post_id>", methods=["GET","POST"])
+@replica_reads
 def post_view(post_id):
-    p = Post.query.get_or_404(post_id)
+    p = get_live_or_404(Post, post_id, archived=True)
+    if p.thread.deleted: abort(404)
     if request.method=="POST":
         if "user_id" not in session: flash("Zaloguj się by pisać", "warning"); return redirect(url_for("login"))
         txt = clean_text(request.form.get("reply",""))
         if txt:
-            r = PostReply(content=txt, post_id=p.id, user_id=session.get("user_id"))
-            db.session.add(r); db.session.commit()
+            save_post(PostReply, dict(content=txt, post_id=p.id, user_id=session.get("user_id")), p, [f"thread:{p.thread_id}", "threads", "posts"])
         return redirect(url_for("post_view", post_id=post_id))
-    replies = PostReply.query.filter_by(post_id=p.id).order_by(PostReply.created).all()
-    author = User.query.get(p.user_id); an = author.username if author else "Anon"
-    html = f'<div class="card"><h4>{an}: {p.content}</h4>'
-    for r in replies:
-        u = User.query.get(r.user_id); name = u.username if u else "Anon"
-        html += f'<div class="mb-1"><b>{name}</b>: {r.content}</div>'
-    html += f'<form method="post"><input class="form-control mb-2" name="reply" placeholder="Twoja odpowiedź"><button class="btn btn-primary">Odpowiedz</button></form></div>'
-    return render_template_string(BASE_HTML, content=html)
+    page = keyset_page(PostReply.query.filter_by(post_id=p.id), PostReply, newest_first=False)
+    return render_template("replies.html", parent=p, page=page, names=author_names(p, *page.items))
 
 @app.route("/post/delete/<int:post_id>")
 def post_delete(post_id):
-    p = Post.query.get_or_404(post_id)
+    p = get_live_or_404(Post, post_id)
     if session.get("role")!="nauczyciel" and session.get("user_id")!=p.user_id: abort(403)
     tid = p.thread_id
-    db.session.delete(p); db.session.commit(); flash("Post usunięty", "info"); return redirect(url_for("thread_view", thread_id=tid))
+    delete_tree(p); bump("threads", f"thread:{tid}"); flash("Post usunięty", "info"); return redirect(url_for("thread_view", thread_id=tid))
 
 @app.route("/threads/delete/<int:thread_id>")
 def thread_delete(thread_id):
     if session.get("role")!="nauczyciel": abort(403)
-    th = Thread.query.get_or_404(thread_id)
-    db.session.delete(th); db.session.commit(); flash("Wątek usunięty", "info"); return redirect(url_for("threads"))
+    th = get_live_or_404(Thread, thread_id)
+    delete_tree(th); bump("threads", f"thread:{thread_id}"); flash("Wątek usunięty", "info"); return redirect(url_for("threads"))
+
+# ARCHIVE (read-only): same access rules as the live pages
+def render_archive(title, query, model, parent=None, link=None, arg=None):
+    page = keyset_page(query, model, newest_first=parent is None)
+    names = author_names(*[row for row in (parent, *page.items) if hasattr(row, "user_id")])
+    return render_template("archive.html", title=title, page=page, parent=parent, names=names, link=link, arg=arg)
+
+@app.route("/archive/lol")
+@cached_page("archive")
+@replica_reads
+def archive_lol():
+    if "user_id" not in session:
+        flash("Zaloguj się aby zobaczyć LOL page", "warning"); return redirect(url_for("login"))
+    model = ARCHIVED[LOLPost]
+    return render_archive("LOL page", model.query, model, link="archive_lol_view", arg="post_id")
+
+@app.route("/archive/lol/<int:post_id>")
+@cached_page("archive")
+@replica_reads
+def archive_lol_view(post_id):
+    if "user_id" not in session: abort(403)
+    post, model = db.get_or_404(ARCHIVED[LOLPost], post_id), ARCHIVED[LOLReply]
+    return render_archive("LOL page", model.query.filter_by(post_id=post.id), model, parent=post)
+
+@app.route("/archive/threads")
+@cached_page("archive")
+@replica_reads
+def archive_threads():
+    model = ARCHIVED[Thread]
+    return render_archive("Forum", model.query, model, link="archive_thread_view", arg="thread_id")
+
+@app.route("/archive/threads/<int:thread_id>")
+@cached_page("archive")
+@replica_reads
+def archive_thread_view(thread_id):
+    th, model = db.get_or_404(ARCHIVED[Thread], thread_id), ARCHIVED[Post]
+    return render_archive("Forum", model.query.filter_by(thread_id=th.id), model, parent=th,
+                          link="archive_post_view", arg="post_id")
+
+@app.route("/archive/post/<int:post_id>")
+@cached_page("archive")
+@replica_reads
+def archive_post_view(post_id):
+    p, model = db.get_or_404(ARCHIVED[Post], post_id), ARCHIVED[PostReply]
+    return render_archive("Forum", model.query.filter_by(post_id=p.id), model, parent=p)
+
+@app.route("/archive/spotted")
+@replica_reads
+def archive_spotted():
+    if "user_id" not in session or session.get("role") not in ("nauczyciel","uczen"):
+        abort(403)
+    model = ARCHIVED[Spotted]
+    return render_archive("Spotted", model.query.filter_by(school_id=session.get("school_id")), model,
+                          link="archive_spotted_view", arg="spotted_id")
+
+@app.route("/archive/spotted/<int:spotted_id>")
+@replica_reads
+def archive_spotted_view(spotted_id):
+    if "user_id" not in session or session.get("role") not in ("nauczyciel","uczen"):
+        abort(403)
+    sp, model = db.get_or_404(ARCHIVED[Spotted], spotted_id), ARCHIVED[SpottedReply]
+    if sp.school_id != session.get("school_id"):
+        abort(403)
+    return render_archive("Spotted", model.query.filter_by(spotted_id=sp.id), model, parent=sp)
+
+# JSON API: read-only /api/v1 over the rows and access rules of the HTML pages.
+# Lists page with the same older/newer cursors (and ?sort= where the page has
+# one); ?ids=3,1,2 fetches up to API_MAX_IDS rows by id in one query instead.
+# ?include=author adds the authors and ?include=replies the first
+# API_INCLUDE_REPLIES replies of every row (a thread's replies are its posts),
+# each looked up for the whole page at once. Responses go through the
+# response cache, so polling with If-None-Match answers 304 without running
+# the view while nothing the list depends on has changed.
+app.config["API_MAX_IDS"] = int(os.environ.get("API_MAX_IDS", 100))
+app.config["API_INCLUDE_REPLIES"] = int(os.environ.get("API_INCLUDE_REPLIES", 3))
+API_INCLUDES = {"author", "replies"}
+
+@app.errorhandler(HTTPException)
+def _api_errors(exc):
+    if not request.path.startswith("/api/"):
+        return exc
+    return {"error": exc.name, "status": exc.code}, exc.code
+
+def api_row(row, names=None):
+    """The row's columns as JSON values; with `names`, its author objects too."""
+    data = {}
+    for column in row.__table__.columns:
+        if column.key != "deleted":
+            value = getattr(row, column.key)
+            data[column.key] = value.isoformat() if isinstance(value, datetime) else value
+    if names is not None:
+        for column, field in (("user_id", "author"), ("last_author_id", "last_author")):
+            if column in data:
+                uid = data[column]
+                data[field] = None if uid is None else {"id": uid, "username": names[uid]}
+    return data
+
+def api_replies(model, rows):
+    """{row id: its first API_INCLUDE_REPLIES live replies} for all of `rows` in one query."""
+    child, column = ACTIVITY[model]
+    parent = getattr(child, column)
+    live = [~child.deleted] if hasattr(child, "deleted") else []
+    rank = db.func.row_number().over(partition_by=parent, order_by=(child.created, child.id)).label("rank")
+    ranked = db.select(child, rank).where(parent.in_([row.id for row in rows]), *live).subquery()
+    reply = db.aliased(child, ranked)
+    found = {row.id: [] for row in rows}
+    for r in db.session.scalars(db.select(reply).where(ranked.c.rank <= app.config["API_INCLUDE_REPLIES"])
+                                .order_by(ranked.c.created, ranked.c.id)):
+        found[getattr(r, column)].append(r)
+    return found
+
+def api_list(model, query, newest_first=True, sortable=False):
+    """JSON for a page of `query`, or for the rows of it named in ?ids=."""
+    include = set(filter(None, request.args.get("include", "").split(",")))
+    if include - API_INCLUDES or ("replies" in include and model not in ACTIVITY):
+        abort(400)
+    if "ids" in request.args:
+        try:
+            wanted = list(dict.fromkeys(int(i) for i in request.args["ids"].split(",")))
+        except ValueError:
+            abort(400)
+        if len(wanted) > app.config["API_MAX_IDS"]:
+            abort(400)
+        found = {row.id: row for row in query.filter(model.id.in_(wanted))} if wanted else {}
+        rows, extra = [found[i] for i in wanted if i in found], {"missing": [i for i in wanted if i not in found]}
+    else:
+        sort = request.args.get("sort") if sortable and request.args.get("sort") in ACTIVITY_SORTS else None
+        page = keyset_page(query, model, newest_first, sort=getattr(model, ACTIVITY_SORTS[sort]) if sort else None)
+        rows, extra = page.items, {"older": page.older, "newer": page.newer}
+    replies = api_replies(model, rows) if "replies" in include and rows else {}
+    names = None
+    if "author" in include:
+        everyone = rows + [r for found in replies.values() for r in found]
+        names = author_names(*[row for row in everyone if hasattr(row, "user_id")])
+        author_names(*[row for row in everyone if hasattr(row, "last_author_id")], column="last_author_id")
+    items = []
+    for row in rows:
+        item = api_row(row, names)
+        if "replies" in include:
+            item["replies"] = [api_row(r, names) for r in replies.get(row.id, [])]
+        items.append(item)
+    return {"items": items, **extra}
+
+def api_school():
+    """The viewer's school, checked the way the Spotted pages check it."""
+    if "user_id" not in session or session.get("role") not in ("nauczyciel","uczen") or not session.get("school_id"):
+        abort(403)
+    return session["school_id"]
+
+@app.route("/api/v1/lol")
+@cached_page("lol", "users", flashes=False)
+@replica_reads
+def api_lol():
+    if "user_id" not in session: abort(403)
+    return api_list(LOLPost, LOLPost.query.filter_by(deleted=False), sortable=True)
+
+@app.route("/api/v1/lol/<int:post_id>/replies")
+@cached_page("lol", "users", flashes=False)
+@replica_reads
+def api_lol_replies(post_id):
+    if "user_id" not in session: abort(403)
+    post = get_live_or_404(LOLPost, post_id)
+    return api_list(LOLReply, LOLReply.query.filter_by(post_id=post.id), newest_first=False)
+
+@app.route("/api/v1/threads")
+@cached_page("threads", "users", flashes=False)
+@replica_reads
+def api_threads():
+    return api_list(Thread, Thread.query.filter_by(deleted=False), sortable=True)
+
+@app.route("/api/v1/threads/<int:thread_id>/posts")
+@cached_page("thread:{thread_id}", "users", flashes=False)
+@replica_reads
+def api_thread_posts(thread_id):
+    th = get_live_or_404(Thread, thread_id)
+    return api_list(Post, Post.query.filter_by(thread_id=th.id, deleted=False), newest_first=False)
+
+@app.route("/api/v1/posts")
+@cached_page("threads", "posts", "users", flashes=False)
+@replica_reads
+def api_posts():
+    # posts only have a listing per thread; this is the batch fetch across threads
+    if "ids" not in request.args: abort(400)
+    return api_list(Post, Post.query.join(Thread).filter(~Post.deleted, ~Thread.deleted))
+
+@app.route("/api/v1/posts/<int:post_id>/replies")
+@cached_page("threads", "posts", "users", flashes=False)
+@replica_reads
+def api_post_replies(post_id):
+    p = get_live_or_404(Post, post_id)
+    if p.thread.deleted: abort(404)
+    return api_list(PostReply, PostReply.query.filter_by(post_id=p.id), newest_first=False)
+
+@app.route("/api/v1/spotted")
+@cached_page("spotted:{viewer_school}", "users", flashes=False)
+@replica_reads
+def api_spotted():
+    return api_list(Spotted, Spotted.query.filter_by(school_id=api_school(), deleted=False))
+
+@app.route("/api/v1/spotted/<int:spotted_id>/replies")
+@cached_page("spotted:{viewer_school}", "users", flashes=False)
+@replica_reads
+def api_spotted_replies(spotted_id):
+    school_id = api_school()
+    sp = get_live_or_404(Spotted, spotted_id)
+    if sp.school_id != school_id: abort(403)
+    return api_list(SpottedReply, SpottedReply.query.filter_by(spotted_id=sp.id), newest_first=False)
+
+# APP FACTORY: importing this module touches no database. create_app() creates
+# and upgrades the schema, so gunicorn.conf.py calls it once in the master
+# (preload_app) and the forked workers share the loaded code copy-on-write.
+def init_db():
+    """Create missing tables and indexes, apply upgrades and build the search index."""
+    db.create_all()
+    added_columns = upgrade_schema()
+    # create_all skips tables that already exist, so add indexes introduced later
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    init_search()
+    # counters added to an existing database start out at zero
+    if "reply_count" in added_columns:
+        rebuild_activity()
+
+def create_app():
+    with app.app_context():
+        init_db()
+        # connections opened here must not be inherited by forked workers
+        for engine in db.engines.values():
+            engine.dispose()
+    return app
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create or upgrade the schema without starting a server."""
+    init_db()
+    print("database ready")
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
+    create_app().run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
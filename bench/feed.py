@@ -0,0 +1,122 @@
+"""Hold many live-feed subscribers open and measure how fast new posts reach them.
+
+    python bench/generate.py --scale 0.1                      # once, writes bench_manifest.json
+    PORT=8000 gunicorn -c gunicorn.conf.py &
+    python bench/feed.py --url http://127.0.0.1:8000 --subscribers 1000 --posts 20
+
+Every subscriber is one open /feed/lol event stream (all share one logged-in
+session). Once they are connected, one writer adds --posts LOL entries, one
+every --interval seconds, and deletes them again at the end. The report gives
+how many subscribers saw each post and the delivery latency from the moment
+the POST returned, plus the connect time for the whole crowd.
+"""
+import argparse
+import asyncio
+import http.cookiejar
+import json
+import re
+import statistics
+import time
+import urllib.parse
+import urllib.request
+
+
+class Writer:
+    """Logged-in urllib client used for the login and the posts."""
+
+    def __init__(self, base):
+        self.base = base.rstrip("/")
+        self.jar = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.jar))
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        with self.opener.open(urllib.request.Request(self.base + path, data=body, method=method), timeout=30) as resp:
+            return resp.read().decode("utf-8", "replace")
+
+    def cookie_header(self):
+        return "; ".join(f"{c.name}={c.value}" for c in self.jar)
+
+
+async def subscribe(host, port, cookie, since, seen, ready):
+    """Read one event stream, recording when each event id first arrives."""
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write((f"GET /feed/lol?since={since} HTTP/1.1\r\nHost: {host}\r\nCookie: {cookie}\r\n"
+                  "Accept: text/event-stream\r\n\r\n").encode())
+    await writer.drain()
+    status = await reader.readline()
+    ready.append(status.split()[1] == b"200" if status else False)
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            found = re.search(rb"^id: (\d+)", line)
+            if found:
+                seen.setdefault(int(found.group(1)), []).append(time.perf_counter())
+    finally:
+        writer.close()
+
+
+async def run(args):
+    url = urllib.parse.urlsplit(args.url)
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    writer = Writer(args.url)
+    username, _ = manifest["users"]["user"][0]
+    await asyncio.to_thread(writer.request, "POST", "/login", {"username": username, "password": manifest["password"]})
+    page = await asyncio.to_thread(writer.request, "GET", "/lol")
+    since = int(re.search(r"since=(\d+)", page).group(1))
+
+    seen, ready = {}, []
+    started = time.perf_counter()
+    tasks = [asyncio.create_task(subscribe(url.hostname, url.port or 80, writer.cookie_header(), since, seen, ready))
+             for _ in range(args.subscribers)]
+    while len(ready) < args.subscribers:
+        await asyncio.sleep(0.05)
+    connected = time.perf_counter() - started
+
+    posted = []
+    for n in range(args.posts):
+        tok = f"feedbench{n}x{int(time.time())}"
+        await asyncio.to_thread(writer.request, "POST", "/lol", {"content": tok})
+        posted.append((tok, time.perf_counter()))
+        await asyncio.sleep(args.interval)
+    await asyncio.sleep(args.settle)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    page = await asyncio.to_thread(writer.request, "GET", "/lol")
+    ids = {tok: int(m) for tok in (t for t, _ in posted)
+           for m in re.findall(re.escape(tok) + r".*?/lol/delete/(\d+)", page)}
+    latencies, reach = [], []
+    for tok, at in posted:
+        arrivals = seen.get(ids.get(tok), [])
+        reach.append(len(arrivals))
+        latencies += [(a - at) * 1000 for a in arrivals]
+    for post_id in ids.values():
+        await asyncio.to_thread(writer.request, "GET", f"/lol/delete/{post_id}")
+
+    latencies.sort()
+    print(f"{sum(ready)}/{args.subscribers} subscribers connected in {connected:.2f} s")
+    print(f"{len(ids)}/{len(posted)} posts found, each reached {min(reach, default=0)}-{max(reach, default=0)} subscribers")
+    if latencies:
+        pick = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)]  # noqa: E731
+        print(f"delivery ms: mean {statistics.fmean(latencies):.0f}  p50 {pick(.5):.0f}  "
+              f"p95 {pick(.95):.0f}  p99 {pick(.99):.0f}  max {latencies[-1]:.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--manifest", default="bench_manifest.json")
+    parser.add_argument("--subscribers", type=int, default=500)
+    parser.add_argument("--posts", type=int, default=10)
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between posts")
+    parser.add_argument("--settle", type=float, default=3.0, help="seconds to wait for the last deliveries")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""Populate the database with synthetic schools, users and content.
+
+    DATABASE_URL=postgresql://localhost/lol python bench/generate.py --scale 2
+    python bench/generate.py --scale 0.1 --manifest bench_manifest.json
+
+Works against whatever DATABASE_URL points at (the app default is
+sqlite:///dev.db). Activity is skewed the way a real site is: a few schools
+and users write most of the content and a few threads get most of the posts.
+Every generated account uses the password given with --password, and the
+manifest written at the end is what bench/load.py uses to log in and pick ids.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.security import generate_password_hash  # noqa: E402
+from app import (  # noqa: E402
+    create_app, db, School, User, LOLPost, LOLReply, Thread, Post, PostReply, Spotted, SpottedReply, rebuild_activity,
+)
+
+# Row counts at --scale 1
+BASE = {
+    "schools": 20, "teachers_per_school": 4, "students": 2000, "users": 500,
+    "lol_posts": 10000, "lol_replies": 20000, "threads": 500, "posts": 20000,
+    "post_replies": 20000, "spotted": 5000, "spotted_replies": 10000,
+}
+WORDS = (
+    "sprawdzian matma klasa lekcja przerwa szkoła nauczyciel wycieczka boisko kino mem "
+    "śmieszne zadanie domowe kartkówka wf biologia historia polski angielski stołówka "
+    "pizza autobus piątek weekend sesja ocena jedynka szóstka dyrektor apel wagary"
+).split()
+CHUNK = 5000
+
+
+def zipf_picker(rng, items, s=1.1):
+    """Return a function picking from `items` with Zipf-like skew (first = hottest)."""
+    cum = list(itertools.accumulate(1 / (rank + 1) ** s for rank in range(len(items))))
+    return lambda: rng.choices(items, cum_weights=cum)[0]
+
+
+def text(rng, lo, hi):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(lo, hi)))
+
+
+def next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+
+def insert(model, rows):
+    """Bulk insert `rows` (dicts with explicit ids) in chunks; returns the ids."""
+    for first in range(0, len(rows), CHUNK):
+        db.session.execute(db.insert(model), rows[first:first + CHUNK])
+        db.session.commit()
+    return [r["id"] for r in rows]
+
+
+def fix_sequences():
+    if db.engine.dialect.name == "postgresql":
+        for model in (School, User, LOLPost, LOLReply, Thread, Post, PostReply, Spotted, SpottedReply):
+            table = model.__tablename__
+            db.session.execute(db.text(
+                f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), (SELECT max(id) FROM \"{table}\"))"
+            ))
+        db.session.commit()
+
+
+def generate(scale, password, seed, days):
+    rng = random.Random(seed)
+    counts = {k: max(int(v * scale), 1) for k, v in BASE.items()}
+    now = datetime.utcnow().replace(microsecond=0)
+    start = now - timedelta(days=days)
+
+    def when(after=None):
+        lo = after or start
+        return lo + timedelta(seconds=rng.randint(0, max(int((now - lo).total_seconds()), 1)))
+
+    run = f"{int(time.time()) % 100000}"
+    hashed = generate_password_hash(password)
+    school_id = next_id(School)
+    schools = [{"id": school_id + i, "name": f"Bench {run} Szkoła {i}"} for i in range(counts["schools"])]
+    school_ids = insert(School, schools)
+    hot_school = zipf_picker(rng, school_ids)
+
+    uid = itertools.count(next_id(User))
+    users = []
+    for sid in school_ids:
+        users += [{"id": next(uid), "username": f"b{run}_t{sid}_{n}", "password": hashed, "role": "nauczyciel",
+                   "school_id": sid} for n in range(counts["teachers_per_school"])]
+    users += [{"id": next(uid), "username": f"b{run}_s{n}", "password": hashed, "role": "uczen",
+               "school_id": hot_school()} for n in range(counts["students"])]
+    users += [{"id": next(uid), "username": f"b{run}_u{n}", "password": hashed, "role": "user",
+               "school_id": None} for n in range(counts["users"])]
+    insert(User, users)
+    rng.shuffle(users)
+    active_user = zipf_picker(rng, [u["id"] for u in users], s=0.8)
+    members = {sid: [u["id"] for u in users if u["school_id"] == sid] for sid in school_ids}
+    active_member = {sid: zipf_picker(rng, ids, s=0.8) for sid, ids in members.items()}
+
+    lid = next_id(LOLPost)
+    lol = [{"id": lid + n, "content": text(rng, 3, 25), "user_id": active_user(), "created": when()}
+           for n in range(counts["lol_posts"])]
+    insert(LOLPost, lol)
+    hot_lol = zipf_picker(rng, lol)
+    rid = next_id(LOLReply)
+    lol_replies = []
+    for n in range(counts["lol_replies"]):
+        parent = hot_lol()
+        lol_replies.append({"id": rid + n, "content": text(rng, 2, 12), "post_id": parent["id"],
+                            "user_id": active_user(), "created": when(parent["created"])})
+    insert(LOLReply, lol_replies)
+
+    tid = next_id(Thread)
+    threads = [{"id": tid + n, "title": text(rng, 2, 8), "created": when()} for n in range(counts["threads"])]
+    insert(Thread, threads)
+    hot_thread = zipf_picker(rng, threads)
+    pid = next_id(Post)
+    posts = []
+    for n in range(counts["posts"]):
+        parent = hot_thread()
+        posts.append({"id": pid + n, "content": text(rng, 5, 40), "thread_id": parent["id"],
+                      "user_id": active_user(), "created": when(parent["created"])})
+    insert(Post, posts)
+    hot_post = zipf_picker(rng, posts)
+    prid = next_id(PostReply)
+    replies = []
+    for n in range(counts["post_replies"]):
+        parent = hot_post()
+        replies.append({"id": prid + n, "content": text(rng, 2, 15), "post_id": parent["id"],
+                        "user_id": active_user(), "created": when(parent["created"])})
+    insert(PostReply, replies)
+
+    sid_ = next_id(Spotted)
+    spotted = []
+    for n in range(counts["spotted"]):
+        school = hot_school()
+        spotted.append({"id": sid_ + n, "content": text(rng, 4, 20), "school_id": school,
+                        "user_id": active_member[school](), "created": when()})
+    insert(Spotted, spotted)
+    hot_spotted = zipf_picker(rng, spotted)
+    srid = next_id(SpottedReply)
+    spotted_replies = []
+    for n in range(counts["spotted_replies"]):
+        parent = hot_spotted()
+        spotted_replies.append({"id": srid + n, "content": text(rng, 2, 12), "spotted_id": parent["id"],
+                                "user_id": active_member[parent["school_id"]](), "created": when(parent["created"])})
+    insert(SpottedReply, spotted_replies)
+    fix_sequences()
+    # bulk inserts bypass the reply counters, so recount them once at the end
+    rebuild_activity()
+
+    def sample(rows, k=200):
+        return rng.sample(rows, min(k, len(rows)))
+
+    return {
+        "password": password,
+        "users": {role: [[u["username"], u["school_id"]] for u in sample([u for u in users if u["role"] == role])]
+                  for role in ("user", "uczen", "nauczyciel")},
+        "school_ids": school_ids,
+        "lol_post_ids": [p["id"] for p in sample(lol, 500)],
+        "thread_ids": [t["id"] for t in sample(threads, 500)],
+        "post_ids": [p["id"] for p in sample(posts, 500)],
+        "spotted_ids": {str(sid): [s["id"] for s in spotted if s["school_id"] == sid][:100] for sid in school_ids},
+        "search_terms": WORDS,
+        "counts": counts,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier for the row counts in BASE")
+    parser.add_argument("--password", default="bench", help="password for every generated account")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--days", type=int, default=365, help="spread created timestamps over this many days")
+    parser.add_argument("--manifest", default="bench_manifest.json", help="where to write logins and sample ids")
+    args = parser.parse_args()
+    started = time.perf_counter()
+    app = create_app()
+    with app.app_context():
+        manifest = generate(args.scale, args.password, args.seed, args.days)
+        manifest["database"] = db.engine.url.render_as_string(hide_password=True)
+    with open(args.manifest, "w") as f:
+        json.dump(manifest, f)
+    total = sum(v for k, v in manifest["counts"].items() if k != "teachers_per_school")
+    print(f"Generated ~{total} rows in {time.perf_counter() - started:.1f} s into {manifest['database']}")
+    print(f"Manifest written to {args.manifest}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""Drive mixed anonymous and logged-in traffic at the app and report latency.
+
+    python bench/generate.py --scale 0.2                      # once, writes bench_manifest.json
+    gunicorn app:app -b 127.0.0.1:8000 &                      # or any server
+    python bench/load.py --url http://127.0.0.1:8000 --users 20 --duration 60
+    python bench/load.py --in-process --users 4 --duration 20 # no server, Flask test client
+
+Each virtual user is anonymous, a plain user, a student or a teacher, logs in
+from the manifest and loops over the scenarios for its role until time is up.
+Between them the scenarios hit every route in app.py, including the write and
+delete paths; content a scenario creates is deleted again where the app allows
+it. Results are per endpoint: requests, errors, throughput and p50/p95/p99.
+--json saves the same numbers so runs can be compared release over release.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+
+ROLE_MIX = {"anon": 4, "user": 3, "uczen": 3, "nauczyciel": 1}
+
+
+class Client:
+    """Minimal HTTP client that keeps cookies and does not follow redirects."""
+
+    class _NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, base):
+        self.base = base.rstrip("/")
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), self._NoRedirect)
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        req = urllib.request.Request(self.base + path, data=body, method=method)
+        try:
+            with self.opener.open(req, timeout=30) as resp:
+                return resp.status, resp.read().decode("utf-8", "replace")
+        except urllib.error.HTTPError as e:
+            return e.code, e.read().decode("utf-8", "replace")
+
+
+class InProcessClient:
+    """Same interface as Client, backed by the Flask test client."""
+
+    def __init__(self, flask_app):
+        self.client = flask_app.test_client()
+
+    def request(self, method, path, data=None):
+        resp = self.client.open(path, method=method, data=data)
+        return resp.status_code, resp.get_data(as_text=True)
+
+
+class VirtualUser:
+    def __init__(self, client, role, manifest, rng, record):
+        self.client, self.role, self.m, self.rng, self.record = client, role, manifest, rng, record
+        self.school_id = None
+
+    def call(self, endpoint, method, path, data=None, ok=(200, 302)):
+        start = time.perf_counter()
+        try:
+            status, body = self.client.request(method, path, data)
+        except Exception:  # noqa: BLE001 - connection errors count as failures
+            status, body = 0, ""
+        self.record(endpoint, (time.perf_counter() - start) * 1000, status in ok)
+        return body
+
+    def token(self):
+        # digits only: nothing the moderation filter could turn into a bad word
+        return f"bench{self.rng.randrange(10**12)}"
+
+    def login(self):
+        if self.role == "anon":
+            return
+        username, self.school_id = self.rng.choice(self.m["users"][self.role])
+        self.call("login", "POST", "/login", {"username": username, "password": self.m["password"]}, ok=(302,))
+
+    # scenarios -------------------------------------------------------------
+    def browse_public(self):
+        r = self.rng
+        self.call("index", "GET", "/")
+        self.call("threads", "GET", "/threads")
+        thread = r.choice(self.m["thread_ids"])
+        self.call("thread_view", "GET", f"/threads/{thread}", ok=(200, 404))
+        self.call("post_view", "GET", f"/post/{r.choice(self.m['post_ids'])}", ok=(200, 404))
+        self.call("search_view", "GET", "/search?" + urllib.parse.urlencode({"q": r.choice(self.m["search_terms"])}))
+        self.call("schools_list", "GET", "/schools")
+        self.call("school_view", "GET", f"/schools/{r.choice(self.m['school_ids'])}")
+
+    def open_forms(self):
+        for endpoint, path in (("login", "/login"), ("register", "/register"),
+                               ("register_school", "/register_school"), ("thread_new", "/threads/new")):
+            self.call(endpoint, "GET", path)
+        self.call("metrics_view", "GET", "/metrics", ok=(200, 403))
+
+    def sign_up(self):
+        tok = self.token()
+        self.call("register", "POST", "/register", {"username": tok, "password": "x", "role": "user", "school": ""}, ok=(302,))
+        self.call("register_school", "POST", "/register_school",
+                  {"school_name": f"Szkoła {tok}", "teacher_login": f"t{tok}", "teacher_password": "x"}, ok=(302,))
+
+    def lol(self):
+        r, tok = self.rng, self.token()
+        self.call("lol_page", "GET", "/lol")
+        self.call("lol_view", "GET", f"/lol/{r.choice(self.m['lol_post_ids'])}", ok=(200, 404))
+        self.call("lol_view", "POST", f"/lol/{r.choice(self.m['lol_post_ids'])}", {"reply": tok}, ok=(302, 404))
+        self.call("lol_page", "POST", "/lol", {"content": tok}, ok=(302,))
+        body = self.call("lol_page", "GET", "/lol")
+        found = re.search(re.escape(tok) + r'.*?/lol/delete/(\d+)', body)
+        if found:
+            self.call("lol_delete", "GET", f"/lol/delete/{found.group(1)}", ok=(302,))
+
+    def discuss(self):
+        tok = self.token()
+        self.call("thread_new", "POST", "/threads/new", {"title": tok}, ok=(302,))
+        body = self.call("threads", "GET", "/threads")
+        thread = re.search(r'/threads/(\d+)">' + re.escape(tok), body)
+        if not thread:
+            return
+        path = f"/threads/{thread.group(1)}"
+        self.call("thread_view", "POST", path, {"content": tok}, ok=(302,))
+        body = self.call("thread_view", "GET", path)
+        post = re.search(re.escape(tok) + r'.*?/post/delete/(\d+)', body)
+        if post:
+            self.call("post_view", "POST", f"/post/{post.group(1)}", {"reply": tok}, ok=(302,))
+            self.call("post_view", "GET", f"/post/{post.group(1)}")
+            self.call("post_delete", "GET", f"/post/delete/{post.group(1)}", ok=(302,))
+        if self.role == "nauczyciel":
+            self.call("thread_delete", "GET", f"/threads/delete/{thread.group(1)}", ok=(302,))
+
+    def spotted(self):
+        tok, ids = self.token(), self.m["spotted_ids"].get(str(self.school_id)) or []
+        self.call("spotted", "GET", "/spotted")
+        if ids:
+            sid = self.rng.choice(ids)
+            self.call("spotted_view", "GET", f"/spotted/{sid}", ok=(200, 404))
+            self.call("spotted_view", "POST", f"/spotted/{sid}", {"reply": tok}, ok=(302, 404))
+        self.call("spotted", "POST", "/spotted", {"content": tok}, ok=(302,))
+        if self.role == "nauczyciel":
+            body = self.call("spotted", "GET", "/spotted")
+            found = re.search(re.escape(tok) + r'.*?/teacher/delete_spotted/(\d+)', body)
+            if found:
+                self.call("teacher_delete_spotted", "GET", f"/teacher/delete_spotted/{found.group(1)}", ok=(302,))
+
+    def api(self):
+        r = self.rng
+        self.call("api_threads", "GET", "/api/v1/threads?include=author")
+        self.call("api_thread_posts", "GET", f"/api/v1/threads/{r.choice(self.m['thread_ids'])}/posts?include=replies,author",
+                  ok=(200, 404))
+        ids = r.sample(self.m["post_ids"], min(10, len(self.m["post_ids"])))
+        self.call("api_posts", "GET", "/api/v1/posts?ids=" + ",".join(map(str, ids)))
+        self.call("api_post_replies", "GET", f"/api/v1/posts/{ids[0]}/replies", ok=(200, 404))
+        if self.role == "anon":
+            return
+        self.call("api_lol", "GET", "/api/v1/lol?include=replies,author")
+        self.call("api_lol_replies", "GET", f"/api/v1/lol/{r.choice(self.m['lol_post_ids'])}/replies", ok=(200, 404))
+        spotted = self.m["spotted_ids"].get(str(self.school_id)) or []
+        if self.role in ("uczen", "nauczyciel"):
+            self.call("api_spotted", "GET", "/api/v1/spotted?include=replies")
+            if spotted:
+                self.call("api_spotted_replies", "GET", f"/api/v1/spotted/{r.choice(spotted)}/replies", ok=(200, 404))
+
+    def teach(self):
+        tok = self.token()
+        self.call("teacher_panel", "GET", "/teacher/panel")
+        self.call("teacher_add_student", "POST", "/teacher/add_student", {"stu_login": tok, "stu_pass": "x"}, ok=(302,))
+        self.call("teacher_add_teacher", "POST", "/teacher/add_teacher", {"t_login": f"t{tok}", "t_pass": "x"}, ok=(302,))
+        for login, role in ((tok, "uczen"), (f"t{tok}", "nauczyciel")):
+            body = self.call("teacher_panel", "GET", "/teacher/panel?" + urllib.parse.urlencode({"role": role, "q": login}))
+            found = re.search(r'(?<!\w)' + re.escape(login) + r'\b.*?/teacher/delete_user/(\d+)', body, re.S)
+            if not found:
+                continue
+            user_id = found.group(1)
+            if login == tok:
+                self.call("teacher_reset_password", "GET", f"/teacher/reset/{user_id}")
+                self.call("teacher_reset_password", "POST", f"/teacher/reset/{user_id}", {"password": "y"}, ok=(302,))
+            self.call("teacher_delete_user", "GET", f"/teacher/delete_user/{user_id}", ok=(302,))
+
+    def scenarios(self):
+        common = [(self.browse_public, 6), (self.open_forms, 1), (self.api, 1)]
+        if self.role == "anon":
+            return common + [(self.sign_up, 0.2)]
+        mine = common + [(self.lol, 3), (self.discuss, 1)]
+        if self.role in ("uczen", "nauczyciel"):
+            mine.append((self.spotted, 3))
+        if self.role == "nauczyciel":
+            mine.append((self.teach, 1))
+        return mine
+
+    def run(self, deadline):
+        self.login()
+        scenarios = self.scenarios()
+        fns, weights = [s for s, _ in scenarios], [w for _, w in scenarios]
+        while time.monotonic() < deadline:
+            self.rng.choices(fns, weights)[0]()
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(int(len(sorted_values) * p), len(sorted_values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--in-process", action="store_true", help="use the Flask test client instead of --url")
+    parser.add_argument("--users", type=int, default=10, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run")
+    parser.add_argument("--manifest", default="bench_manifest.json")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    if args.in_process:
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from app import create_app
+        app = create_app()
+        make_client = lambda: InProcessClient(app)  # noqa: E731
+    else:
+        make_client = lambda: Client(args.url)  # noqa: E731
+
+    samples, errors, lock = defaultdict(list), defaultdict(int), threading.Lock()
+
+    def record(endpoint, ms, ok):
+        with lock:
+            samples[endpoint].append(ms)
+            errors[endpoint] += not ok
+
+    rng = random.Random(args.seed)
+    roles = [r for r in rng.choices(list(ROLE_MIX), list(ROLE_MIX.values()), k=args.users)
+             if r == "anon" or manifest["users"].get(r)]
+    vusers = [VirtualUser(make_client(), role, manifest, random.Random(rng.random()), record) for role in roles]
+    deadline = time.monotonic() + args.duration
+    started = time.perf_counter()
+    threads = [threading.Thread(target=v.run, args=(deadline,), daemon=True) for v in vusers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    results = {}
+    print(f"{len(vusers)} virtual users ({', '.join(f'{r}={roles.count(r)}' for r in ROLE_MIX)}) for {elapsed:.1f} s "
+          f"against {'in-process app' if args.in_process else args.url} [{manifest.get('database', '?')}]")
+    print(f"{'endpoint':<26}{'reqs':>7}{'err':>6}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for endpoint in sorted(samples):
+        values = sorted(samples[endpoint])
+        row = {"requests": len(values), "errors": errors[endpoint], "rps": len(values) / elapsed,
+               "p50": percentile(values, 0.5), "p95": percentile(values, 0.95), "p99": percentile(values, 0.99),
+               "mean": statistics.mean(values)}
+        results[endpoint] = row
+        print(f"{endpoint:<26}{row['requests']:>7}{row['errors']:>6}{row['rps']:>9.1f}"
+              f"{row['p50']:>9.1f}{row['p95']:>9.1f}{row['p99']:>9.1f}")
+    everything = sorted(v for values in samples.values() for v in values)
+    if everything:
+        total = {"requests": len(everything), "errors": sum(errors.values()), "rps": len(everything) / elapsed,
+                 "p50": percentile(everything, 0.5), "p95": percentile(everything, 0.95),
+                 "p99": percentile(everything, 0.99)}
+        results["TOTAL"] = total
+        print(f"{'TOTAL':<26}{total['requests']:>7}{total['errors']:>6}{total['rps']:>9.1f}"
+              f"{total['p50']:>9.1f}{total['p95']:>9.1f}{total['p99']:>9.1f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"users": len(vusers), "duration": elapsed, "database": manifest.get("database"),
+                       "endpoints": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
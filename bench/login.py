@@ -0,0 +1,86 @@
+"""Log in as many manifest users at once and report logins per second per core.
+
+    python bench/generate.py --scale 0.1                      # once, writes bench_manifest.json
+    gunicorn -c gunicorn.conf.py &
+    python bench/login.py --url http://127.0.0.1:8000 --concurrency 32 --duration 20
+    python bench/login.py --in-process --concurrency 8        # no server, Flask test client
+
+Each of --concurrency clients logs in and out in a loop as a different user
+from the manifest, like a class signing in at the start of the day; with
+--bad a share of the attempts use a wrong password. Every status is counted:
+302 is a login, 429 a throttled attempt, 503 a full hashing queue. The rate
+is divided by --cores (the server's cores, by default this machine's).
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from load import Client, InProcessClient, percentile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--in-process", action="store_true", help="use the Flask test client instead of --url")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20, help="seconds to run")
+    parser.add_argument("--bad", type=float, default=0.0, help="share of attempts with a wrong password")
+    parser.add_argument("--cores", type=int, default=os.cpu_count())
+    parser.add_argument("--manifest", default="bench_manifest.json")
+    args = parser.parse_args()
+
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    if args.in_process:
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from app import create_app
+        app = create_app()
+        make_client = lambda: InProcessClient(app)  # noqa: E731
+    else:
+        make_client = lambda: Client(args.url)  # noqa: E731
+    logins = [name for users in manifest["users"].values() for name, _ in users]
+
+    statuses, latencies, lock = Counter(), [], threading.Lock()
+    deadline = time.monotonic() + args.duration
+
+    def run(n):
+        client, rng = make_client(), random.Random(n)
+        username = logins[n % len(logins)]
+        while time.monotonic() < deadline:
+            password = "wrong" if rng.random() < args.bad else manifest["password"]
+            start = time.perf_counter()
+            try:
+                status, _ = client.request("POST", "/login", {"username": username, "password": password})
+            except Exception:  # noqa: BLE001 - connection errors are counted as status 0
+                status = 0
+            with lock:
+                statuses[status] += 1
+                latencies.append((time.perf_counter() - start) * 1000)
+            if status == 302:
+                client.request("GET", "/logout")
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=run, args=(n,), daemon=True) for n in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    rate = statuses[302] / elapsed
+    print(f"{args.concurrency} clients for {elapsed:.1f} s against {'in-process app' if args.in_process else args.url}")
+    print("statuses: " + ", ".join(f"{code}={count}" for code, count in sorted(statuses.items())))
+    print(f"logins/s {rate:.1f}  per core {rate / args.cores:.1f}  ({args.cores} cores)")
+    if latencies:
+        print(f"latency ms: p50 {percentile(latencies, .5):.0f}  p95 {percentile(latencies, .95):.0f}  "
+              f"p99 {percentile(latencies, .99):.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Micro-benchmark: time to render a 1,000-post /lol page.
+
+    python bench/render_lol.py [posts] [rounds]
+
+Runs against a throwaway SQLite file with PAGE_SIZE set to the post count, so
+the whole feed goes through one render and the numbers compare across commits.
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+POSTS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+ROUNDS = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+tmp = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+os.environ["PAGE_SIZE"] = str(POSTS)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.security import generate_password_hash  # noqa: E402
+from app import create_app, db, User, LOLPost  # noqa: E402
+
+app = create_app()
+
+with app.app_context():
+    users = [User(username=f"u{i}", password=generate_password_hash("x", "pbkdf2:sha256:1"), role="user") for i in range(50)]
+    db.session.add_all(users); db.session.commit()
+    db.session.add_all(LOLPost(content=f"post <{i}> & stuff", user_id=users[i % 50].id) for i in range(POSTS))
+    db.session.commit()
+
+client = app.test_client()
+client.post("/login", data={"username": "u0", "password": "x"})
+client.get("/lol")  # warm up template and query caches
+
+timings = []
+for _ in range(ROUNDS):
+    start = time.perf_counter()
+    resp = client.get("/lol")
+    timings.append((time.perf_counter() - start) * 1000)
+    assert resp.status_code == 200
+
+print(f"/lol with {POSTS} posts, {ROUNDS} rounds, {len(resp.data)} bytes")
+print(f"  mean {statistics.mean(timings):.1f} ms  median {statistics.median(timings):.1f} ms  min {min(timings):.1f} ms")
@@ -0,0 +1,78 @@
+"""Benchmark forum search on a synthetic corpus.
+
+    python bench/search.py [posts] [database_url]
+
+Defaults to 1,000,000 posts in a throwaway SQLite file; pass a Postgres URL to
+measure the tsvector/GIN path instead. Words follow a Zipf-like distribution
+so there are both very common and very rare terms to look up.
+"""
+import itertools
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+POSTS = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+if len(sys.argv) > 2:
+    os.environ["DATABASE_URL"] = sys.argv[2]
+else:
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'search.db')}"
+os.environ["PAGE_SIZE"] = "20"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db, search  # noqa: E402
+
+app = create_app()
+
+rng = random.Random(42)
+VOCAB = ["".join(rng.choice("abcdefghijklmnoprstuwyz") for _ in range(rng.randint(3, 10))) for _ in range(20000)]
+CUM_WEIGHTS = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(VOCAB))))
+THREADS = max(POSTS // 200, 1)
+CHUNK = 10000
+
+
+def sentence(lo, hi):
+    return " ".join(rng.choices(VOCAB, cum_weights=CUM_WEIGHTS, k=rng.randint(lo, hi)))
+
+
+def timed(label, fn, rounds=20):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    print(f"  {label:<38} median {statistics.median(samples):8.2f} ms  max {max(samples):8.2f} ms")
+    return result
+
+
+with app.app_context():
+    start = time.perf_counter()
+    with db.engine.begin() as conn:
+        conn.execute(db.text('INSERT INTO "user" (id, username, password, role) VALUES (1, \'bench\', \'x\', \'user\')'))
+        conn.execute(db.text("INSERT INTO thread (id, title) VALUES (:id, :title)"),
+                     [{"id": i + 1, "title": sentence(3, 8)} for i in range(THREADS)])
+        for first in range(0, POSTS, CHUNK):
+            conn.execute(db.text("INSERT INTO post (id, content, thread_id, user_id) VALUES (:id, :content, :thread_id, 1)"),
+                         [{"id": i + 1, "content": sentence(8, 30), "thread_id": rng.randint(1, THREADS)}
+                          for i in range(first, min(first + CHUNK, POSTS))])
+    print(f"{db.engine.dialect.name}: {POSTS} posts, {THREADS} threads indexed in {time.perf_counter() - start:.1f} s")
+
+    common, mid, rare = VOCAB[0], VOCAB[200], VOCAB[15000]
+    timed(f"search common term '{common}'", lambda: search(common))
+    timed(f"search mid term '{mid}'", lambda: search(mid))
+    timed(f"search rare term '{rare}'", lambda: search(rare))
+    timed("search two terms", lambda: search(f"{mid} {VOCAB[300]}"))
+    timed("search common term, page 50", lambda: search(common, 50))
+    past = app.config["SEARCH_WINDOW"] // 20 + 10
+    timed(f"search common term, page {past}", lambda: search(common, past))
+    like = db.text("SELECT count(*) FROM post WHERE lower(content) LIKE :q")
+    timed(f"old-style LIKE scan for '{rare}'", lambda: db.session.execute(like, {"q": f"%{rare}%"}).all(), rounds=3)
+
+    def write_cycle():
+        with db.engine.begin() as conn:
+            conn.execute(db.text("INSERT INTO post (id, content, thread_id, user_id) VALUES (:id, :c, 1, 1)"),
+                         {"id": POSTS + 1, "c": sentence(8, 30)})
+            conn.execute(db.text("DELETE FROM post WHERE id = :id"), {"id": POSTS + 1})
+    timed("insert + delete one post (index sync)", write_cycle)
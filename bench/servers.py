@@ -0,0 +1,104 @@
+"""Run bench/load.py against the production gunicorn profile in each worker mode.
+
+    python bench/generate.py --scale 0.1                      # once, writes bench_manifest.json
+    python bench/servers.py --users 50 --duration 30 --streams 20
+
+For every mode in --modes the script starts `gunicorn -c gunicorn.conf.py`
+with GUNICORN_MODE set, waits until it answers, optionally parks --streams
+open /feed/lol event streams on it (the way idle browser tabs do), runs the
+load test and stops the server again. The server gets the same environment
+as this script, so DATABASE_URL and the WEB_CONCURRENCY / GUNICORN_* knobs
+apply to every run. The summary compares the totals side by side.
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_ready(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url + "/", timeout=2):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def open_streams(port, count):
+    """Open `count` anonymous /feed/lol streams and leave them hanging."""
+    streams = []
+    for _ in range(count):
+        try:
+            sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+            sock.sendall(b"GET /feed/lol HTTP/1.1\r\nHost: 127.0.0.1\r\nAccept: text/event-stream\r\n\r\n")
+            streams.append(sock)
+        except OSError:
+            break
+    return streams
+
+
+def run_mode(mode, args):
+    env = dict(os.environ, GUNICORN_MODE=mode, PORT=str(args.port))
+    server = subprocess.Popen(["gunicorn", "-c", "gunicorn.conf.py"], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{args.port}"
+    streams = []
+    try:
+        if not wait_ready(url, args.boot_timeout):
+            return None
+        streams = open_streams(args.port, args.streams)
+        with tempfile.NamedTemporaryFile(suffix=".json") as out:
+            subprocess.run([sys.executable, os.path.join(ROOT, "bench", "load.py"), "--url", url,
+                            "--users", str(args.users), "--duration", str(args.duration),
+                            "--manifest", args.manifest, "--json", out.name], check=True)
+            with open(out.name) as f:
+                return json.load(f)["endpoints"].get("TOTAL")
+    finally:
+        for sock in streams:
+            sock.close()
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default="sync,gthread,gevent", help="comma separated GUNICORN_MODE values")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--users", type=int, default=50, help="concurrent virtual users per run")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per run")
+    parser.add_argument("--streams", type=int, default=0, help="idle /feed/lol streams held open during the run")
+    parser.add_argument("--manifest", default="bench_manifest.json")
+    parser.add_argument("--boot-timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    totals = {}
+    for mode in args.modes.split(","):
+        print(f"== {mode} ==", flush=True)
+        totals[mode] = run_mode(mode, args)
+
+    print(f"\n{args.users} users, {args.streams} idle streams, {args.duration:.0f} s per mode")
+    print(f"{'mode':<10}{'reqs':>8}{'err':>6}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for mode, total in totals.items():
+        if not total:
+            print(f"{mode:<10}{'did not start or served nothing':>50}")
+            continue
+        print(f"{mode:<10}{total['requests']:>8}{total['errors']:>6}{total['rps']:>9.1f}"
+              f"{total['p50']:>9.1f}{total['p95']:>9.1f}{total['p99']:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
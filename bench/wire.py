@@ -0,0 +1,68 @@
+"""Bytes on the wire and server render time for /lol and a thread page.
+
+    python bench/generate.py --scale 0.1                      # once, writes bench_manifest.json
+    python bench/wire.py --repeat 50
+
+Runs in-process against DATABASE_URL as a logged-in user. Every page is
+fetched --repeat times per Accept-Encoding; the report gives the body size
+on the wire and the median and p95 of the app time from Server-Timing (so
+compression cost is included). "first visit" adds the stylesheets served by
+the app itself, as a browser with an empty cache downloads them once.
+"""
+import argparse
+import itertools
+import json
+import os
+import re
+import statistics
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+
+ENCODINGS = ["identity", "gzip", "br"]
+BUST = itertools.count()
+
+
+def app_ms(response):
+    found = re.search(r"app;dur=([\d.]+)", response.headers.get("Server-Timing", ""))
+    return float(found.group(1)) if found else 0.0
+
+
+def measure(client, path, encoding, repeat):
+    sizes, times = [], []
+    for _ in range(repeat):
+        # a fresh query string every time, so the page cache cannot hide the render
+        response = client.get(f"{path}?bench={next(BUST)}", headers={"Accept-Encoding": encoding})
+        sizes.append(len(response.data))
+        times.append(app_ms(response))
+    times.sort()
+    return statistics.median(sizes), statistics.median(times), times[int(len(times) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--manifest", default="bench_manifest.json")
+    parser.add_argument("--repeat", type=int, default=30)
+    args = parser.parse_args()
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+
+    client = create_app().test_client()
+    username, _ = manifest["users"]["user"][0]
+    client.post("/login", data={"username": username, "password": manifest["password"]})
+    pages = {"/lol": "/lol", "/threads/<id>": f"/threads/{manifest['thread_ids'][0]}"}
+
+    print(f"{'page':<16}{'encoding':<10}{'bytes':>9}{'first visit':>13}{'p50 ms':>9}{'p95 ms':>9}")
+    for label, path in pages.items():
+        # same-origin stylesheets a cold browser fetches alongside the page
+        links = re.findall(r'<link href="(/[^"]+)"', client.get(path, headers={"Accept-Encoding": "identity"}).text)
+        for encoding in ENCODINGS:
+            size, p50, p95 = measure(client, path, encoding, args.repeat)
+            assets = sum(len(client.get(href, headers={"Accept-Encoding": encoding}).data) for href in links)
+            print(f"{label:<16}{encoding:<10}{size:>9.0f}{size + assets:>13.0f}{p50:>9.1f}{p95:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Sustained posting rate with and without write coalescing.
+
+    python bench/generate.py --scale 0.1                      # once, writes bench_manifest.json
+    python bench/writes.py --coalesce 0,5,20 --concurrency 64 --duration 20
+    DATABASE_URL=postgresql://localhost/lol python bench/writes.py --manifest pg_manifest.json
+
+For every WRITE_COALESCE_MS value in --coalesce the script starts
+`gunicorn -c gunicorn.conf.py` with it (GUNICORN_MODE, WEB_CONCURRENCY and the
+other knobs come from this environment) and --concurrency clients, each logged
+in as a different manifest user, post as fast as the server takes them: new
+LOL entries, and with --replies that share of replies under manifest posts. A
+SQLite DATABASE_URL is switched to WAL mode first. The summary gives committed
+posts per second (302 answers) and latency for each setting.
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+
+from load import Client, percentile
+from servers import ROOT, wait_ready
+
+sys.path.insert(0, ROOT)
+
+from app import create_app, db  # noqa: E402
+
+
+def prepare_database():
+    """The database URL for the report; a SQLite file is switched to WAL mode (it stays so)."""
+    with create_app().app_context():
+        url = db.engine.url.render_as_string(hide_password=True)
+        if db.engine.dialect.name == "sqlite":
+            mode = db.session.execute(db.text("PRAGMA journal_mode=WAL")).scalar()
+            url += f" (journal_mode={mode})"
+    return url
+
+
+def run_setting(coalesce_ms, logins, args, password, post_ids):
+    env = dict(os.environ, WRITE_COALESCE_MS=str(coalesce_ms), PORT=str(args.port))
+    server = subprocess.Popen(["gunicorn", "-c", "gunicorn.conf.py"], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{args.port}"
+    statuses, latencies, lock = Counter(), [], threading.Lock()
+    try:
+        if not wait_ready(url, args.boot_timeout):
+            return None
+        clients = []
+        for n in range(args.concurrency):
+            client = Client(url)
+            client.request("POST", "/login", {"username": logins[n % len(logins)], "password": password})
+            clients.append(client)
+        deadline = time.monotonic() + args.duration
+
+        def post(n, client):
+            sent = 0
+            while time.monotonic() < deadline:
+                sent += 1
+                text = f"bench{n}x{sent}"
+                if post_ids and sent % 100 < args.replies * 100:
+                    path, data = f"/lol/{post_ids[(n + sent) % len(post_ids)]}", {"reply": text}
+                else:
+                    path, data = "/lol", {"content": text}
+                start = time.perf_counter()
+                try:
+                    status, _ = client.request("POST", path, data)
+                except Exception:  # noqa: BLE001 - connection errors are counted as status 0
+                    status = 0
+                with lock:
+                    statuses[status] += 1
+                    latencies.append((time.perf_counter() - start) * 1000)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=post, args=(n, c), daemon=True) for n, c in enumerate(clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+    latencies.sort()
+    return {"posts": statuses[302], "errors": sum(v for k, v in statuses.items() if k != 302),
+            "rate": statuses[302] / elapsed, "p50": percentile(latencies, .5), "p99": percentile(latencies, .99)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--coalesce", default="0,5,20", help="comma separated WRITE_COALESCE_MS values, 0 = off")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=20, help="seconds per setting")
+    parser.add_argument("--replies", type=float, default=0.5, help="share of the posts that are replies")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--manifest", default="bench_manifest.json")
+    parser.add_argument("--boot-timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    database = prepare_database()
+    logins = [name for users in manifest["users"].values() for name, _ in users]
+
+    results = {}
+    for value in args.coalesce.split(","):
+        print(f"== WRITE_COALESCE_MS={value} ==", flush=True)
+        results[value] = run_setting(float(value), logins, args, manifest["password"], manifest["lol_post_ids"])
+
+    print(f"\n{database}, GUNICORN_MODE={os.environ.get('GUNICORN_MODE', 'gevent')}, {args.concurrency} clients, {args.duration:.0f} s each")
+    print(f"{'coalesce ms':<13}{'posts':>8}{'err':>6}{'posts/s':>9}{'p50 ms':>9}{'p99 ms':>9}")
+    for value, result in results.items():
+        if not result:
+            print(f"{value:<13}{'did not start':>41}")
+            continue
+        print(f"{value:<13}{result['posts']:>8}{result['errors']:>6}{result['rate']:>9.1f}"
+              f"{result['p50']:>9.1f}{result['p99']:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
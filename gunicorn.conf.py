@@ -0,0 +1,130 @@
+"""Production server profile: gunicorn -c gunicorn.conf.py
+
+The app is built once in the master by app.create_app(), which creates and
+upgrades the schema, and the workers are forked from it (preload_app).
+GUNICORN_MODE picks the worker type:
+
+  gevent   (default) one process per core, each serving up to
+           GUNICORN_CONNECTIONS clients as greenlets; slow clients and open
+           /feed streams cost memory, not request capacity
+  gthread  one process per core with GUNICORN_THREADS threads each
+  sync     2 * cores + 1 single-request processes (an open /feed stream
+           holds a whole worker, so only use this without live feeds)
+
+"Cores" are the CPUs this container may use: the affinity mask, capped by a
+cgroup CPU quota, not the host's count. WEB_CONCURRENCY overrides the process
+count. The database pool of every worker is sized to its concurrency unless
+DB_POOL_SIZE is set, and all workers together never open more than
+DB_CONNECTIONS (default 20) connections: pool_size + max_overflow is cut to
+each worker's share. Each worker also gets its share of the cores for its
+password threads (AUTH_THREADS) and import processes (IMPORT_PROCESSES). With more than
+one worker the response cache keeps its version counters in the database
+(CACHE_BACKEND=database), so a write in one worker invalidates the pages the
+others have cached; CACHE_BACKEND=memory is refused there. METRICS_DIR
+defaults to a fresh folder per master so /metrics sums all workers; the files
+of exited workers are folded into one retired.json there.
+"""
+import math
+import os
+import tempfile
+
+
+def usable_cpus():
+    """CPUs this process may run on, capped by a cgroup (v2 or v1) CPU quota."""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    for quota_file, period_file in (("/sys/fs/cgroup/cpu.max", None),
+                                    ("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu/cpu.cfs_period_us")):
+        try:
+            with open(quota_file) as f:
+                quota, *period = f.read().split()
+            if period_file:
+                with open(period_file) as f:
+                    period = f.read().split()
+        except OSError:
+            continue
+        if quota in ("max", "-1"):
+            return cpus
+        return max(1, min(cpus, math.ceil(int(quota) / int(period[0]))))
+    return cpus
+
+
+mode = os.environ.get("GUNICORN_MODE", "gevent")
+cores = usable_cpus()
+
+if mode == "gevent":
+    # patch before the app is preloaded, so its locks and sockets are cooperative
+    from gevent import monkey
+    monkey.patch_all()
+    worker_class = "gevent"
+    worker_connections = int(os.environ.get("GUNICORN_CONNECTIONS", 1000))
+    workers = cores
+    # greenlets queue for a connection instead of each opening one
+    pool_size = 10
+elif mode == "gthread":
+    worker_class = "gthread"
+    threads = int(os.environ.get("GUNICORN_THREADS", 8))
+    workers = cores
+    pool_size = threads
+elif mode == "sync":
+    worker_class = "sync"
+    workers = 2 * cores + 1
+    pool_size = 2
+else:
+    raise RuntimeError(f"GUNICORN_MODE must be gevent, gthread or sync, not {mode!r}")
+
+workers = int(os.environ.get("WEB_CONCURRENCY", workers))
+if workers > 1:
+    if os.environ.get("CACHE_BACKEND", "database") != "database":
+        raise RuntimeError("CACHE_BACKEND=memory keeps stale pages in the other workers; use it with WEB_CONCURRENCY=1 only")
+    os.environ["CACHE_BACKEND"] = "database"
+connections = int(os.environ.get("DB_CONNECTIONS", 20)) // workers
+if connections < 1:
+    raise RuntimeError(f"DB_CONNECTIONS is below one connection for each of the {workers} workers")
+pool_size = min(int(os.environ.get("DB_POOL_SIZE", pool_size)), connections)
+overflow = min(int(os.environ.get("DB_MAX_OVERFLOW", pool_size)), connections - pool_size)
+os.environ["DB_POOL_SIZE"], os.environ["DB_MAX_OVERFLOW"] = str(pool_size), str(overflow)
+share = str(max(cores // workers, 1))
+os.environ.setdefault("AUTH_THREADS", share)
+os.environ.setdefault("IMPORT_PROCESSES", share)
+# every worker's counters go here so /metrics can sum them; one folder per
+# master, so a deploy starts from zero
+os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), f"lol-metrics-{os.getpid()}"))
+
+wsgi_app = "app:create_app()"
+preload_app = True
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+graceful_timeout = 20
+keepalive = 5
+# recycle workers now and then so slow leaks cannot pile up
+max_requests = 5000
+max_requests_jitter = 500
+accesslog = "-" if os.environ.get("GUNICORN_ACCESS_LOG") == "1" else None
+
+
+def on_starting(server):
+    # counters of an earlier run in the same folder would be summed forever
+    folder = os.environ["METRICS_DIR"]
+    os.makedirs(folder, exist_ok=True)
+    for name in os.listdir(folder):
+        if name.endswith((".json", ".json.tmp")):
+            os.remove(os.path.join(folder, name))
+
+
+def worker_exit(server, worker):
+    from app import metrics
+    metrics.flush(force=True)
+
+
+def child_exit(server, worker):
+    # fold the dead worker's counters into one file instead of keeping one per pid
+    from app import metrics
+    metrics.retire(worker.pid)
+
+
+def post_fork(server, worker):
+    # the master disposed its pools after create_app(); make sure nothing leaked through
+    from app import db, app
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
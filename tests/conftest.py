@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# app.py reads DATABASE_URL at import time: point it at a throwaway file first
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="lol-tests-"), "test.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
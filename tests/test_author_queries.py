@@ -0,0 +1,73 @@
+import re
+
+import pytest
+
+from app import LOLPost, LOLReply, Post, PostReply, School, Thread, User, app, db, init_db
+
+N = 3  # N and 10·N rows both fit on one page, so every row is rendered
+
+
+@pytest.fixture(scope="module")
+def client():
+    with app.app_context():
+        init_db()
+        school = School(name="Szkoła zapytań")
+        db.session.add(school); db.session.flush()
+        viewer = User(username="czytelnik", password="-", role="uczen", school_id=school.id)
+        db.session.add(viewer); db.session.commit()
+        values = dict(user_id=viewer.id, username=viewer.username, role=viewer.role,
+                      school_id=school.id, school_name=school.name)
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess.update(values)
+    client.get("/")  # one-off lookups happen before anything is counted
+    yield client
+    with app.app_context():
+        db.drop_all()
+
+
+def authors(prefix, count):
+    """`count` new users, so no author name can come from an earlier row."""
+    users = [User(username=f"{prefix}{n}", password="-", role="uczen") for n in range(count)]
+    db.session.add_all(users); db.session.flush()
+    return users
+
+
+def queries(client, path):
+    response = client.get(path)
+    assert response.status_code == 200
+    return int(re.search(r'(\d+) queries', response.headers["Server-Timing"]).group(1))
+
+
+def add_lol_posts(count):
+    with app.app_context():
+        for user, replier in zip(authors(f"lol{count}_", count), authors(f"lolre{count}_", count)):
+            post = LOLPost(content="wpis", user_id=user.id)
+            db.session.add(post); db.session.flush()
+            db.session.add(LOLReply(content="odp", post_id=post.id, user_id=replier.id))
+        db.session.commit()
+
+
+def thread_with_posts(count):
+    with app.app_context():
+        thread = Thread(title=f"Wątek {count}")
+        db.session.add(thread); db.session.flush()
+        for user, replier in zip(authors(f"th{count}_", count), authors(f"thre{count}_", count)):
+            post = Post(content="post", thread_id=thread.id, user_id=user.id)
+            db.session.add(post); db.session.flush()
+            db.session.add(PostReply(content="odp", post_id=post.id, user_id=replier.id))
+        db.session.commit()
+        return thread.id
+
+
+def test_lol_page_queries_do_not_grow_with_rows(client):
+    add_lol_posts(N)
+    small = queries(client, "/lol")
+    add_lol_posts(9 * N)
+    assert queries(client, "/lol") == small
+
+
+def test_thread_page_queries_do_not_grow_with_rows(client):
+    # every thread is its own cache key, so the first request renders the page
+    small = queries(client, f"/threads/{thread_with_posts(N)}")
+    assert queries(client, f"/threads/{thread_with_posts(10 * N)}") == small
@@ -0,0 +1,28 @@
+import pytest
+
+from app import REJECTED_TEXT, WordMatcher, clean_text, normalize
+
+
+@pytest.mark.parametrize("text", [
+    "Daję słowo, że przyjdę",      # the placeholder "słowo2" must not turn into "slowo"
+    "Ich ujęcie było dobre",       # "ich ujecie" must not match "chuj" across the space
+    "kur wadliwy",                 # nor "kurwa"
+    "Jestem w domu i z kotem",
+    "Mam 2 koty i 10 rybek",
+])
+def test_innocent_text_is_kept(text):
+    assert clean_text(text) == text
+
+
+@pytest.mark.parametrize("text", [
+    "kurwa", "KURWA!", "k.u.r.w.a", "k u r w a", "G ł u p 1", "GŁUUUPI", "skurwany", "ty chuju",
+])
+def test_disguised_terms_are_rejected(text):
+    assert clean_text(text) == REJECTED_TEXT
+
+
+def test_digits_in_terms_are_kept():
+    matcher = WordMatcher(["słowo2"])
+    assert normalize("słowo2") == "slowo2"
+    assert matcher.search("to słowo2 tutaj")
+    assert not matcher.search("Daję słowo, że przyjdę")